@@ -6,12 +6,19 @@ FastAPIを使用したREST API
 
 from fastapi import FastAPI, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Dict, Any, List, Optional
+import asyncio
 import logging
 import traceback
 import uvicorn
-from bedrock_qa_system import BedrockKnowledgeBaseQA
+from async_qa_system import AsyncBedrockKnowledgeBaseQA
+from batch_qa import ask_questions_batch
+from hedging import hedge_stats
+from metrics import RequestMetrics
+from resilience import Deadline
+from streaming import SSE_HEADERS, iter_sse
 
 # ログ設定
 logging.basicConfig(level=logging.INFO)
@@ -37,12 +44,26 @@ app.add_middleware(
 class QuestionRequest(BaseModel):
     question: str
     max_results: Optional[int] = 3
+    debug: Optional[bool] = False
 
 class QuestionResponse(BaseModel):
     answer: str
     confidence: float
     sources: List[Dict[str, Any]]
     success: bool = True
+    degraded: bool = False
+    degraded_reason: Optional[str] = None
+    cache_hit: Optional[bool] = None
+
+class BatchQuestionRequest(BaseModel):
+    questions: List[str]
+    max_concurrency: Optional[int] = None
+
+class BatchQuestionResponse(BaseModel):
+    results: List[Dict[str, Any]]
+    total: int
+    unique: int
+    success: bool = True
 
 class ErrorResponse(BaseModel):
     error: str
@@ -57,12 +78,18 @@ async def startup_event():
     """アプリケーション開始時にQ&Aシステムを初期化"""
     global qa_system
     try:
-        qa_system = BedrockKnowledgeBaseQA()
+        qa_system = AsyncBedrockKnowledgeBaseQA()
         logger.info("Q&Aシステムが正常に初期化されました")
     except Exception as e:
         logger.error(f"Q&Aシステムの初期化に失敗: {e}")
         raise
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """アプリケーション終了時にQ&Aシステムのスレッドプールを終了"""
+    if qa_system is not None:
+        qa_system.close()
+
 @app.get("/")
 async def root():
     """ルートエンドポイント"""
@@ -77,7 +104,9 @@ async def health_check():
     """ヘルスチェックエンドポイント"""
     return {
         "status": "healthy",
-        "qa_system_ready": qa_system is not None
+        "qa_system_ready": qa_system is not None,
+        "generation_breaker": qa_system.qa_system.generation_breaker.stats() if qa_system else None,
+        "hedging": hedge_stats()
     }
 
 @app.post("/ask", response_model=QuestionResponse)
@@ -98,13 +127,19 @@ async def ask_question(request: QuestionRequest):
         
         logger.info(f"質問を受信: {request.question}")
         
-        # Q&Aシステムで回答を生成
-        result = qa_system.ask_question(request.question)
+        # Q&Aシステムで回答を生成（Bedrockの応答を待つ間も他のリクエストを処理できる）
+        request_metrics = RequestMetrics()
+        with request_metrics.activate():
+            result = await qa_system.ask_question(request.question)
         
         response = QuestionResponse(
             answer=result['answer'],
             confidence=result['confidence'],
-            sources=result['sources']
+            sources=result['sources'],
+            degraded=result.get('degraded', False),
+            degraded_reason=result.get('degraded_reason'),
+            # debug を指定した場合はキャッシュヒットの有無を返す（負荷試験の集計用）
+            cache_hit=request_metrics.cache_hit if request.debug else None
         )
         
         logger.info(f"回答を生成: 信頼度={result['confidence']:.3f}, ソース数={len(result['sources'])}")
@@ -121,6 +156,53 @@ async def ask_question(request: QuestionRequest):
             detail=f"内部サーバーエラー: {str(e)}"
         )
 
+@app.post("/ask/batch", response_model=BatchQuestionResponse)
+async def ask_questions(request: BatchQuestionRequest):
+    """複数の質問にまとめて回答するエンドポイント（重複する質問は1回だけ処理）"""
+    if qa_system is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Q&Aシステムが初期化されていません"
+        )
+    
+    logger.info(f"バッチ質問を受信: {len(request.questions)}件")
+    
+    # バッチは専用のスレッドプールで同時実行数を制限して処理されるため、完了をスレッドで待つ
+    # （ほかのエンドポイントと同じく REQUEST_DEADLINE_SECONDS の時間予算で打ち切り、ワーカーを占有し続けない）
+    loop = asyncio.get_running_loop()
+    try:
+        batch = await loop.run_in_executor(
+            None, ask_questions_batch, qa_system.qa_system, request.questions, request.max_concurrency, Deadline()
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    return BatchQuestionResponse(**batch)
+
+@app.post("/ask/stream")
+async def ask_question_stream(request: QuestionRequest):
+    """質問に回答するエンドポイント（Server-Sent Eventsで回答を逐次返す）"""
+    if qa_system is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Q&Aシステムが初期化されていません"
+        )
+    
+    if not request.question.strip():
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="質問が空です"
+        )
+    
+    logger.info(f"質問を受信（ストリーミング）: {request.question}")
+    
+    # 同期ジェネレーターはスレッドプールで実行されるためイベントループをブロックしない
+    return StreamingResponse(
+        iter_sse(qa_system.qa_system.ask_question_stream(request.question)),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     """グローバル例外ハンドラー"""
@@ -10,6 +10,7 @@ from http.server import HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 import traceback
 from bedrock_qa_system import BedrockKnowledgeBaseQA
+from metrics import RequestMetrics
 
 # ログ設定
 logging.basicConfig(level=logging.INFO)
@@ -69,7 +70,9 @@ class APIHandler(BaseHTTPRequestHandler):
                 self.server.qa_system = BedrockKnowledgeBaseQA()
                 logger.info("Q&Aシステムを初期化しました")
             
-            result = self.server.qa_system.ask_question(question)
+            request_metrics = RequestMetrics()
+            with request_metrics.activate():
+                result = self.server.qa_system.ask_question(question)
             
             # 成功レスポンスを返す
             response_data = {
@@ -78,6 +81,10 @@ class APIHandler(BaseHTTPRequestHandler):
                 'confidence': result['confidence'],
                 'sources': result['sources']
             }
+            if data.get('debug') is True:
+                # {"debug": true} の場合は各段の処理時間とキャッシュヒットの有無を返す
+                response_data['timings'] = request_metrics.timings()
+                response_data['cache_hit'] = request_metrics.cache_hit
             
             self.send_json_response(200, response_data)
             logger.info(f"回答を生成: 信頼度={result['confidence']:.3f}")
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Lambdaのコールドスタート計測
+
+新しいPythonプロセスで Lambda 環境（AWS_LAMBDA_FUNCTION_NAME 設定済み）を模して
+ハンドラーモジュールを読み込み、次の値を計測する（ネットワークには接続しない）。
+
+- init_ms: モジュールの読み込みから INIT フェーズの初期化完了まで
+- first_invoke_ms: 初回呼び出し（CORS preflight）の処理時間
+- warmup_invoke_ms: ウォームアップ呼び出しの処理時間
+- 読み込みに時間のかかったモジュール（python -X importtime）
+
+--baseline で指定したJSONと比べて中央値が許容範囲を超えて遅くなった場合は終了コード1を返す。
+
+使い方:
+    python scripts/benchmark_cold_start.py                # 計測して基準値と比較
+    python scripts/benchmark_cold_start.py --update       # 基準値を更新
+    python scripts/benchmark_cold_start.py --handler lambda_function
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cold_start_baseline.json')
+METRICS = ['init_ms', 'first_invoke_ms', 'warmup_invoke_ms']
+
+# 子プロセスで実行する計測コード
+CHILD_CODE = '''
+import json, sys, time
+start = time.perf_counter()
+handler = __import__(sys.argv[1])
+init_done = time.perf_counter()
+handler.lambda_handler({'httpMethod': 'OPTIONS'}, None)
+first_done = time.perf_counter()
+handler.lambda_handler({'source': 'aws.events', 'detail-type': 'Scheduled Event'}, None)
+warmup_done = time.perf_counter()
+print(json.dumps({
+    'init_ms': (init_done - start) * 1000,
+    'first_invoke_ms': (first_done - init_done) * 1000,
+    'warmup_invoke_ms': (warmup_done - first_done) * 1000,
+}))
+'''
+
+
+def child_env():
+    """Lambda 実行環境を模した環境変数（認証情報はダミー）"""
+    env = dict(os.environ)
+    env.update({
+        'AWS_LAMBDA_FUNCTION_NAME': 'cold-start-benchmark',
+        'AWS_REGION': env.get('AWS_REGION', 'us-east-1'),
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'KNOWLEDGE_BASE_ID': 'BENCHMARK',
+        'WARMUP_PRIME_CONNECTIONS': 'false',
+        'PYTHONDONTWRITEBYTECODE': '1',
+    })
+    return env
+
+
+def parse_importtime(stderr, limit):
+    """-X importtime の出力から、累積時間の長いトップレベルに近いモジュールを返す"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth <= 2:
+            modules.append((int(cumulative) / 1000, name.strip()))
+    return sorted(modules, reverse=True)[:limit]
+
+
+def run_once(handler):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD_CODE, handler],
+        cwd=SRC_DIR, env=child_env(), capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lambdaのコールドスタート計測')
+    parser.add_argument('--handler', default='lambda_handler', help='計測するハンドラーモジュール')
+    parser.add_argument('--runs', type=int, default=5, help='計測回数（中央値を使用）')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='基準値のJSONファイル')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='基準値に対して許容する増加率')
+    parser.add_argument('--slack-ms', type=float, default=20.0, help='計測の揺らぎとして許容する増加量（ミリ秒）')
+    parser.add_argument('--update', action='store_true', help='計測結果で基準値を更新する')
+    args = parser.parse_args()
+
+    samples = []
+    stderr = ''
+    for _ in range(args.runs):
+        sample, stderr = run_once(args.handler)
+        samples.append(sample)
+    result = {metric: statistics.median(s[metric] for s in samples) for metric in METRICS}
+
+    print(f"{args.handler}（{args.runs}回の中央値）")
+    for metric in METRICS:
+        print(f"  {metric:>18}: {result[metric]:9.2f} ms")
+    print("読み込みに時間のかかったモジュール（累積）:")
+    for cumulative_ms, name in parse_importtime(stderr, 8):
+        print(f"  {cumulative_ms:9.2f} ms  {name}")
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baselines = json.load(f)
+
+    if args.update:
+        baselines[args.handler] = {metric: round(result[metric], 2) for metric in METRICS}
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f"基準値を更新しました: {args.baseline}")
+        return 0
+
+    baseline = baselines.get(args.handler)
+    if baseline is None:
+        print(f"基準値がありません（--update で作成してください）: {args.baseline}")
+        return 0
+
+    regressions = []
+    for metric in METRICS:
+        limit = baseline[metric] * (1 + args.tolerance) + args.slack_ms
+        if result[metric] > limit:
+            regressions.append(f"{metric}: {result[metric]:.2f} ms > 許容値 {limit:.2f} ms（基準 {baseline[metric]:.2f} ms）")
+
+    if regressions:
+        print("コールドスタートが基準値より遅くなっています:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("基準値の範囲内です")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+回答フォーマット処理のマイクロベンチマーク
+
+回答の長さごとに format_answer と IncrementalAnswerFormatter の1回あたりの処理時間と、
+tracemalloc で計測したメモリ確保量（ピーク）を表示する。
+
+使い方:
+    python scripts/benchmark_formatter.py [--repeat 2000]
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+from answer_formatter import IncrementalAnswerFormatter, format_answer
+
+# 実際の回答に近い構成（見出し・句点・リスト・注意書き・コードブロック）の段落
+PARAGRAPH = (
+    "サイト内検索の設定方法についてご説明します。## 基本設定\n"
+    "管理画面の「検索設定」から対象ドメインを登録します。登録後、クローラーが自動的にページを収集します。"
+    "- 対象URLの追加\n- 除外URLの設定\n1. コードをコピーする 2. ページに貼り付ける\n"
+    "**注意**: robots.txtでブロックされたページは収集されません。```html\n<script src=\"widget.js\"></script>\n```"
+)
+# ベンチマークする回答の長さ（段落の繰り返し回数）
+SIZES = [1, 4, 16, 64]
+# 逐次フォーマットで1回に渡すトークンの長さ
+TOKEN_LENGTH = 4
+
+
+def format_incrementally(text):
+    formatter = IncrementalAnswerFormatter()
+    output = [formatter.feed(text[i:i + TOKEN_LENGTH]) for i in range(0, len(text), TOKEN_LENGTH)]
+    output.append(formatter.finish())
+    return ''.join(output)
+
+
+def measure(func, text, repeat):
+    """1回あたりの処理時間（マイクロ秒）とメモリ確保量のピーク（バイト）を返す"""
+    func(text)  # ウォームアップ
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(text)
+    elapsed = (time.perf_counter() - start) / repeat * 1e6
+
+    tracemalloc.start()
+    func(text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='回答フォーマット処理のベンチマーク')
+    parser.add_argument('--repeat', type=int, default=2000, help='計測の繰り返し回数')
+    args = parser.parse_args()
+
+    print(f"{'chars':>7} {'format_answer(us)':>18} {'peak(B)':>9} {'incremental(us)':>16} {'peak(B)':>9}")
+    for size in SIZES:
+        text = PARAGRAPH * size
+        repeat = max(1, args.repeat // size)
+        batch_time, batch_peak = measure(format_answer, text, repeat)
+        stream_time, stream_peak = measure(format_incrementally, text, max(1, repeat // 10))
+        print(f"{len(text):>7} {batch_time:>18.1f} {batch_peak:>9} {stream_time:>16.1f} {stream_peak:>9}")
+
+
+if __name__ == "__main__":
+    main()
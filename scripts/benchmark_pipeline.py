@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+質問応答パイプラインのCPU処理のマイクロベンチマーク
+
+AWSには接続せず、次の処理の1回あたりの処理時間（マイクロ秒）を計測する。
+
+- translate_ja / translate_en: 日本語・英語の質問の英語翻訳（translate_query_to_english）
+- translate_large_dictionary: 5万語の対訳辞書での長い質問（約300文字）の英語翻訳
+- extract_article_id: URIからの記事IDの抽出（30件）
+- rank_results_{6,15,30}: 検索結果の重複排除・スコアボーナス・データソース別の並べ替え
+- build_prompt_{3,10}: 回答生成のプロンプト組み立て（参考情報の文の選択を含む）とリクエストボディのJSON化
+- pack_context_cold: 文の分割のキャッシュがない状態での参考情報の組み立て（10件）
+- format_answer_{short,long}: 回答のフォーマット
+- create_response: Lambdaのレスポンス（JSONシリアライズ）の作成
+- keyword_search_{term,ja}: キーワード索引（BM25）の完全一致の語・日本語の質問の検索
+- rrf_fusion: ベクトル検索とキーワード検索の結果の統合（Reciprocal Rank Fusion）
+- vector_search_{1000,5000}: ローカルのベクトル索引（1536次元、int8）の上位10件の検索（NumPyがある場合のみ）
+
+検索結果のフィクスチャは scripts/fixtures/kb_corpus.json から、1件1〜5KBのチャンクを
+乱数のシードを固定して生成する（サブクエリ間の重複も含む）。
+
+全体を --passes 回繰り返して計測し、処理ごとに各回の中央値の中央値を使う（実行中の一時的な
+揺らぎが1回分の計測だけに出るようにするため）。計測結果は --baseline のJSONと比べ、
+中央値が許容範囲を超えて遅くなった処理があれば終了コード1を返す。
+
+使い方:
+    python scripts/benchmark_pipeline.py                       # 計測して基準値と比較
+    python scripts/benchmark_pipeline.py --update              # 基準値を更新
+    python scripts/benchmark_pipeline.py --filter rank         # 名前に rank を含む処理だけ計測
+    python scripts/benchmark_pipeline.py --output after.json   # 計測結果を保存
+    python scripts/benchmark_pipeline.py --compare before.json after.json  # 保存した結果同士を比較
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(SCRIPTS_DIR, '..', 'src'))
+
+# boto3 クライアントの作成に必要なダミーの設定（ネットワークには接続しない）
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.setdefault('KNOWLEDGE_BASE_ID', 'BENCHMARK')
+os.environ['ANSWER_CACHE_BACKEND'] = 'none'
+
+DEFAULT_BASELINE = os.path.join(SCRIPTS_DIR, 'pipeline_benchmark_baseline.json')
+CORPUS_PATH = os.path.join(SCRIPTS_DIR, 'fixtures', 'kb_corpus.json')
+
+JAPANESE_QUESTIONS = [
+    'ウィジェットの設置方法を教えてください',
+    'クローラーを手動で実行するにはどうすればいいですか？',
+    'プロキシ設定でSSL証明書は自動発行されますか',
+    'アクティベーターが表示されない場合の対処法',
+    'APIキーを再発行したい',
+    'サイト内検索で翻訳後のページを検索対象にする方法',
+    '用語集をCSVで一括登録できますか',
+    '料金プランを変更すると請求はどうなりますか',
+]
+ENGLISH_QUESTIONS = [
+    'How do I install the widget?',
+    'How can I trigger the crawler through the API?',
+    'How long is the proxy cache TTL?',
+    'The activator Chrome extension does not show the toolbar',
+    'How do I exclude content from translation?',
+    'Does the proxy configuration support hreflang tags?',
+]
+SHORT_ANSWER = (
+    "ウィジェットは管理画面から設置できます。## 設置手順\n"
+    "1. 「設定」から「ウィジェット」を開く 2. スクリプトタグをコピーする 3. </body>の直前に貼り付ける\n"
+    "**注意**: 設置後はブラウザのキャッシュを削除してください。"
+)
+LONG_ANSWER = SHORT_ANSWER + (
+    "## 詳細設定\n表示位置は右下・左下から選択できます。スマートフォンでは小さいボタンで表示されます。"
+    "- 表示言語の選択\n- 国旗の表示\n- カスタムCSS\n"
+    "```html\n<script src=\"https://example.com/widget.js\" async></script>\n```"
+    "**推奨**: プレビューで表示を確認してから保存してください。"
+) * 6
+
+
+def build_retrieval_payload(corpus, count, rng):
+    """サブクエリを合わせた検索結果（count件、1件1〜5KB、約3割はほかの結果と重複）"""
+    results = []
+    for i in range(count):
+        if results and rng.random() < 0.3:
+            results.append(dict(rng.choice(results), score=round(rng.uniform(0.3, 0.8), 4)))
+            continue
+        doc = corpus[i % len(corpus)]
+        target_bytes = rng.randint(1024, 5 * 1024)
+        text = doc['text']
+        while len(text.encode('utf-8')) < target_bytes:
+            text += '\n\n' + doc['text']
+        results.append({
+            'content': {'text': text.encode('utf-8')[:target_bytes].decode('utf-8', 'ignore')},
+            'location': {'type': 'S3', 's3Location': {'uri': doc['uri']}},
+            'score': round(rng.uniform(0.3, 0.8), 4),
+            'metadata': {'x-amz-bedrock-kb-data-source-id': doc['data_source_id']},
+        })
+    return results
+
+
+def build_benchmarks():
+    """計測する処理の名前と、引数なしで1回実行する関数の一覧"""
+    import context_packer
+    from bedrock_qa_system import BedrockKnowledgeBaseQA
+    from keyword_index import KeywordIndex, split_chunks
+    from lambda_handler import create_response
+    from retrieval_fanout import reciprocal_rank_fusion
+    from term_translator import TermTranslator, translate_query_to_english
+
+    qa = BedrockKnowledgeBaseQA()
+    rng = random.Random(0)
+    with open(CORPUS_PATH, encoding='utf-8') as f:
+        corpus = json.load(f)
+
+    payloads = {count: build_retrieval_payload(corpus, count, rng) for count in (6, 15, 30)}
+    uris = [result['location']['s3Location']['uri'] for result in payloads[30]]
+    contexts = {count: qa._rank_results(payloads[30], count) for count in (3, 10)}
+    result = qa._build_answer_result(JAPANESE_QUESTIONS[0], contexts[3], LONG_ANSWER)
+    keyword_index = KeywordIndex.build(
+        {'uri': doc['uri'], 'data_source_id': doc['data_source_id'], 'text': chunk}
+        for doc in corpus for chunk in split_chunks(doc['text'])
+    )
+    keyword_results = keyword_index.search(JAPANESE_QUESTIONS[0], 6)
+    large_translator = TermTranslator((f'用語{i:05d}', f'term{i}') for i in range(50000))
+    large_translator.add('クローラー', 'crawler')
+    long_question = 'クローラーの用語00042と用語49999について教えてください' * 10
+
+    benchmarks = {
+        'translate_ja': lambda: [translate_query_to_english(q) for q in JAPANESE_QUESTIONS],
+        'translate_en': lambda: [translate_query_to_english(q) for q in ENGLISH_QUESTIONS],
+        'translate_large_dictionary': lambda: large_translator.translate(long_question),
+        'extract_article_id': lambda: [qa._extract_article_id(uri) for uri in uris],
+        'format_answer_short': lambda: qa.format_answer(SHORT_ANSWER),
+        'format_answer_long': lambda: qa.format_answer(LONG_ANSWER),
+        'create_response': lambda: create_response(200, result),
+        'keyword_search_term': lambda: keyword_index.search('Activator', 6),
+        'keyword_search_ja': lambda: keyword_index.search(JAPANESE_QUESTIONS[0], 6),
+        'rrf_fusion': lambda: reciprocal_rank_fusion([payloads[15], keyword_results]),
+        'pack_context_cold': lambda: (context_packer._analyze.cache_clear(),
+                                      context_packer.pack_context(JAPANESE_QUESTIONS[0], contexts[10])),
+    }
+    for count, payload in payloads.items():
+        benchmarks[f'rank_results_{count}'] = lambda payload=payload: qa._rank_results(payload, 3)
+    for count, context in contexts.items():
+        benchmarks[f'build_prompt_{count}'] = (
+            lambda context=context: json.dumps(qa._build_request_body(JAPANESE_QUESTIONS[0], context))
+        )
+    benchmarks.update(build_vector_benchmarks(corpus))
+    return benchmarks
+
+
+def build_vector_benchmarks(corpus):
+    """ローカルのベクトル索引の検索（埋め込みは乱数、索引は一時ファイルに書き出す）"""
+    try:
+        import numpy as np
+    except ImportError:
+        return {}
+    import tempfile
+    from vector_index import VectorIndex, write_vector_index
+
+    rng = np.random.default_rng(0)
+    query = rng.standard_normal(1536).astype(np.float32)
+    benchmarks = {}
+    for count in (1000, 5000):
+        documents = [corpus[i % len(corpus)] for i in range(count)]
+        # 索引はメモリマップしたまま検索するため、一時ディレクトリは計測が終わるまで残す
+        tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp.name, 'vector_index.bin')
+        write_vector_index(path, documents, rng.standard_normal((count, 1536)).astype(np.float32))
+        index = VectorIndex(path)
+        benchmarks[f'vector_search_{count}'] = lambda index=index, tmp=tmp: index.search(query, 10)
+    return benchmarks
+
+
+def measure(func, rounds, min_round_seconds):
+    """1回あたりの処理時間（マイクロ秒）の中央値と最小値
+
+    1ラウンドが min_round_seconds 以上になるよう実行回数を決め、rounds ラウンド計測する。
+    """
+    func()  # ウォームアップ
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start >= min_round_seconds:
+            break
+        number *= 2
+
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number * 1e6)
+    return {'median_us': round(statistics.median(samples), 3), 'min_us': round(min(samples), 3)}
+
+
+def combine(passes):
+    """各回の計測結果をまとめる（中央値は各回の中央値の中央値、最小値は全体の最小値）"""
+    return {name: {'median_us': round(statistics.median(p[name]['median_us'] for p in passes), 3),
+                   'min_us': min(p[name]['min_us'] for p in passes)}
+            for name in passes[0]}
+
+
+def compare(baseline, results, tolerance, slack_us):
+    """基準値より遅くなった処理の説明の一覧（中央値で比較）"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]['median_us']
+        limit = base * (1 + tolerance) + slack_us
+        if result['median_us'] > limit:
+            regressions.append(
+                f"{name}: {result['median_us']:.2f} us > 許容値 {limit:.2f} us"
+                f"（基準 {base:.2f} us、{(result['median_us'] / base - 1) * 100:+.0f}%）"
+            )
+    return regressions
+
+
+def print_table(results, baseline):
+    print(f"{'benchmark':<22} {'median(us)':>12} {'min(us)':>10} {'baseline(us)':>13} {'change':>8}")
+    for name, result in results.items():
+        base = baseline.get(name, {}).get('median_us')
+        change = f"{(result['median_us'] / base - 1) * 100:+.0f}%" if base else '-'
+        base_text = f"{base:.2f}" if base else '-'
+        print(f"{name:<22} {result['median_us']:>12.2f} {result['min_us']:>10.2f} {base_text:>13} {change:>8}")
+
+
+def load_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='質問応答パイプラインのCPU処理のベンチマーク')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='基準値のJSONファイル')
+    parser.add_argument('--filter', default='', help='名前にこの文字列を含む処理だけ計測する')
+    parser.add_argument('--rounds', type=int, default=7, help='計測のラウンド数（中央値を使用）')
+    parser.add_argument('--min-round-ms', type=float, default=20.0, help='1ラウンドの最短時間（ミリ秒）')
+    parser.add_argument('--passes', type=int, default=3, help='全体を繰り返して計測する回数（中央値を使用）')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='基準値に対して許容する増加率')
+    # 100マイクロ秒未満の処理は実行ごとの揺らぎが20%を超えるため、増加率とは別に一定の増加量を許容する
+    parser.add_argument('--slack-us', type=float, default=10.0, help='計測の揺らぎとして許容する増加量（マイクロ秒）')
+    parser.add_argument('--output', help='計測結果を保存するJSONファイル')
+    parser.add_argument('--update', action='store_true', help='計測結果で基準値を更新する')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='保存した計測結果同士を比較する')
+    args = parser.parse_args()
+
+    if args.compare:
+        before, after = load_json(args.compare[0]), load_json(args.compare[1])
+        print_table(after, before)
+    else:
+        # パイプライン内のログ出力は計測対象外にする
+        logging.disable(logging.INFO)
+        benchmarks = build_benchmarks()
+        before = load_json(args.baseline)
+        passes = []
+        for _ in range(max(1, args.passes)):
+            passes.append({name: measure(func, args.rounds, args.min_round_ms / 1000)
+                           for name, func in benchmarks.items() if args.filter in name})
+        after = combine(passes)
+        print_table(after, before)
+
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(after, f, indent=2, ensure_ascii=False)
+                f.write('\n')
+        if args.update:
+            before.update(after)
+            with open(args.baseline, 'w', encoding='utf-8') as f:
+                json.dump(before, f, indent=2, ensure_ascii=False)
+                f.write('\n')
+            print(f"基準値を更新しました: {args.baseline}")
+            return 0
+        if not before:
+            print(f"基準値がありません（--update で作成してください）: {args.baseline}")
+            return 0
+
+    regressions = compare(before, after, args.tolerance, args.slack_us)
+    if regressions:
+        print(f"基準値より{args.tolerance * 100:.0f}%以上遅くなっている処理があります:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("基準値の範囲内です")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
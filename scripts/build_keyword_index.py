@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+キーワード索引（BM25）の作成
+
+crawl_urls.py が crawled_html/ に保存したヘルプページからタグを除いた本文を取り出し、
+チャンクに分けて src/keyword_index.py の索引ファイルを作る。URI は S3 に同期した場所
+（--s3-prefix + ファイル名）とし、Knowledge Base の検索結果と同じ文書として統合できるようにする。
+
+使い方:
+    python scripts/build_keyword_index.py                              # crawled_html/ から src/keyword_index.bin を作成
+    python scripts/build_keyword_index.py --corpus scripts/fixtures/kb_corpus.json --output /tmp/kw.bin
+    python scripts/build_keyword_index.py --query "Activator"          # 作成後に検索を試す
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+from keyword_index import DEFAULT_CHUNK_CHARS, DEFAULT_INDEX_PATH, KeywordIndex, html_to_text, split_chunks
+
+DEFAULT_S3_PREFIX = 's3://bedrock-kb-qa-data-f501c9ff647296c6/html/'
+# ヘルプページのデータソース
+DEFAULT_DATA_SOURCE_ID = 'VO92FYFPG6'
+
+
+def documents_from_html(html_dir, s3_prefix, data_source_id, chunk_chars):
+    for path in sorted(Path(html_dir).glob('*.html')):
+        text = html_to_text(path.read_text(encoding='utf-8', errors='ignore'))
+        for chunk in split_chunks(text, chunk_chars):
+            yield {'uri': f"{s3_prefix}{path.name}", 'data_source_id': data_source_id, 'text': chunk}
+
+
+def documents_from_corpus(corpus_path, chunk_chars):
+    """Bedrock代替サーバーのコーパス（scripts/fixtures/kb_corpus.json 形式）から作る"""
+    with open(corpus_path, encoding='utf-8') as f:
+        corpus = json.load(f)
+    for doc in corpus:
+        for chunk in split_chunks(doc['text'], chunk_chars):
+            yield {'uri': doc['uri'], 'data_source_id': doc['data_source_id'], 'text': chunk}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='キーワード索引（BM25）の作成')
+    parser.add_argument('--html-dir', default='crawled_html', help='クロール済みHTMLのディレクトリ')
+    parser.add_argument('--corpus', help='HTMLの代わりに使うコーパスのJSONファイル')
+    parser.add_argument('--output', default=DEFAULT_INDEX_PATH, help='索引ファイルの出力先')
+    parser.add_argument('--s3-prefix', default=DEFAULT_S3_PREFIX, help='HTMLを同期したS3の場所')
+    parser.add_argument('--data-source-id', default=DEFAULT_DATA_SOURCE_ID, help='HTMLのデータソースID')
+    parser.add_argument('--chunk-chars', type=int, default=DEFAULT_CHUNK_CHARS, help='チャンクの目安の長さ（文字数）')
+    parser.add_argument('--query', action='append', default=[], help='作成後に試す検索（複数指定可）')
+    args = parser.parse_args()
+
+    if args.corpus:
+        documents = documents_from_corpus(args.corpus, args.chunk_chars)
+    else:
+        if not os.path.isdir(args.html_dir):
+            print(f"HTMLのディレクトリがありません（crawl_urls.py を実行してください）: {args.html_dir}")
+            return 1
+        documents = documents_from_html(args.html_dir, args.s3_prefix, args.data_source_id, args.chunk_chars)
+
+    index = KeywordIndex.build(documents)
+    index.save(args.output)
+    size_kb = os.path.getsize(args.output) / 1024
+    print(f"索引を作成しました: {args.output}（{len(index)}チャンク, {len(index.terms)}語, {size_kb:.0f} KB）")
+
+    index = KeywordIndex.load(args.output)
+    for query in args.query:
+        start = time.perf_counter()
+        results = index.search(query, 5)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print(f"\n'{query}'（{elapsed_ms:.3f} ms）")
+        for result in results:
+            print(f"  {result['score']:7.3f}  {result['location']['s3Location']['uri']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,6 +14,34 @@ echo "一時ディレクトリ: $TEMP_DIR"
 # 必要なファイルをコピー（新しいsrcディレクトリから）
 cp src/lambda_handler.py "$TEMP_DIR/"
 cp src/bedrock_qa_system.py "$TEMP_DIR/"
+cp src/retrieval_fanout.py "$TEMP_DIR/"
+cp src/retrieval_depth.py "$TEMP_DIR/"
+cp src/qa_cache.py "$TEMP_DIR/"
+cp src/answer_formatter.py "$TEMP_DIR/"
+cp src/context_packer.py "$TEMP_DIR/"
+cp src/generation_prompt.py "$TEMP_DIR/"
+cp src/model_router.py "$TEMP_DIR/"
+cp src/near_duplicates.py "$TEMP_DIR/"
+cp src/batch_qa.py "$TEMP_DIR/"
+cp src/resilience.py "$TEMP_DIR/"
+cp src/hedging.py "$TEMP_DIR/"
+cp src/metrics.py "$TEMP_DIR/"
+cp src/term_translator.py "$TEMP_DIR/"
+cp src/translation_terms.tsv "$TEMP_DIR/"
+cp src/keyword_index.py "$TEMP_DIR/"
+cp src/vector_index.py "$TEMP_DIR/"
+
+# キーワード索引（scripts/build_keyword_index.py で作成）がある場合は同梱する
+if [ -f "src/keyword_index.bin" ]; then
+    cp src/keyword_index.bin "$TEMP_DIR/"
+fi
+
+# ベクトル索引（scripts/export_vector_index.py で作成）がある場合は同梱する（RETRIEVAL_ENGINE=local で使用）
+VECTOR_INDEX_INCLUDED=false
+if [ -f "src/vector_index.bin" ]; then
+    cp src/vector_index.bin "$TEMP_DIR/"
+    VECTOR_INDEX_INCLUDED=true
+fi
 
 # .envファイルが存在する場合はコピー（オプション）
 if [ -f ".env" ]; then
@@ -35,6 +63,11 @@ EOF
 # 依存関係をインストール
 pip install -r requirements.txt -t .
 
+# ベクトル索引の検索に使う NumPy は Lambda（Python 3.9, x86_64）用のバイナリを入れる
+if [ "$VECTOR_INDEX_INCLUDED" = true ]; then
+    pip install numpy==1.26.4 -t . --platform manylinux2014_x86_64 --python-version 3.9 --only-binary=:all:
+fi
+
 # デプロイパッケージを作成
 echo "デプロイパッケージを作成しています..."
 zip -r lambda_deployment.zip .
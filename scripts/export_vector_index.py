@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+ローカルのベクトル索引（src/vector_index.py）の作成
+
+Knowledge Base のベクトルストア（OpenSearch Serverless のインデックス）から、チャンクの本文・
+メタデータ・Titan の埋め込みをそのまま書き出す。--corpus / --html-dir を指定した場合は、
+チャンクに分けて Titan（bedrock-runtime の invoke_model）で埋め込みを求める。
+BEDROCK_ENDPOINT_URL に scripts/local_bedrock_server.py を指定すれば AWS に接続せずに作れる。
+
+作成した索引は RETRIEVAL_ENGINE=local と VECTOR_INDEX_PATH（既定は src/vector_index.bin）で使う。
+1チャンクあたりの大きさは 1536次元で int8（既定）が約1.5KB、float16 が約3KB。
+
+使い方:
+    python scripts/export_vector_index.py                                   # OpenSearch Serverless から作成
+    python scripts/export_vector_index.py --dtype float16 --output /tmp/vec.bin
+    BEDROCK_ENDPOINT_URL=http://127.0.0.1:8010 python scripts/export_vector_index.py \\
+        --corpus scripts/fixtures/kb_corpus.json --query "ウィジェットの設置方法"
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import boto3
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+from build_keyword_index import DEFAULT_DATA_SOURCE_ID, DEFAULT_S3_PREFIX, documents_from_corpus, documents_from_html
+from keyword_index import DEFAULT_CHUNK_CHARS
+from vector_index import DEFAULT_EMBEDDING_MODEL_ID, DEFAULT_INDEX_PATH, TitanEmbedder, VectorIndex, write_vector_index
+
+DEFAULT_COLLECTION_HOST = 'wcl8a3afcpsydoomrhg2.us-east-1.aoss.amazonaws.com'
+DEFAULT_INDEX_NAME = 'bedrock-knowledge-base-default-index'
+VECTOR_FIELD = 'bedrock-knowledge-base-default-vector'
+TEXT_FIELD = 'AMAZON_BEDROCK_TEXT_CHUNK'
+METADATA_FIELD = 'AMAZON_BEDROCK_METADATA'
+# from/size で取得できる上限（これを超える規模は Knowledge Base で検索する）
+MAX_DOCUMENTS = 10000
+PAGE_SIZE = 500
+
+
+def export_from_opensearch(host, index_name, region):
+    """ベクトルストアのチャンクと埋め込みの一覧"""
+    from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+
+    credentials = boto3.Session().get_credentials()
+    client = OpenSearch(
+        hosts=[{'host': host, 'port': 443}],
+        http_auth=AWSV4SignerAuth(credentials, region, 'aoss'),
+        use_ssl=True,
+        verify_certs=True,
+        connection_class=RequestsHttpConnection,
+    )
+
+    documents, embeddings = [], []
+    while len(documents) < MAX_DOCUMENTS:
+        response = client.search(index=index_name, body={
+            'from': len(documents),
+            'size': min(PAGE_SIZE, MAX_DOCUMENTS - len(documents)),
+            'query': {'match_all': {}},
+        })
+        hits = response['hits']['hits']
+        if not hits:
+            break
+        for hit in hits:
+            source = hit['_source']
+            metadata = json.loads(source.get(METADATA_FIELD) or '{}')
+            uri = source.get('x-amz-bedrock-kb-source-uri') or metadata.get('source', '')
+            documents.append({
+                'uri': uri,
+                'data_source_id': source.get('x-amz-bedrock-kb-data-source-id', ''),
+                'text': source[TEXT_FIELD],
+            })
+            embeddings.append(source[VECTOR_FIELD])
+    else:
+        print(f"チャンクが{MAX_DOCUMENTS}件を超えています（先頭の{MAX_DOCUMENTS}件だけ書き出します）")
+    return documents, embeddings
+
+
+def embed_documents(documents, model_id, endpoint_url, region):
+    """Titan で各チャンクの埋め込みを求める"""
+    runtime = boto3.client('bedrock-runtime', region_name=region, endpoint_url=endpoint_url)
+    embed = TitanEmbedder(runtime, model_id=model_id, cache_size=0)
+    embeddings = []
+    for i, doc in enumerate(documents, 1):
+        embeddings.append(embed(doc['text']))
+        if i % 100 == 0:
+            print(f"  {i}/{len(documents)} チャンクの埋め込みを作成しました")
+    return embeddings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ローカルのベクトル索引の作成')
+    parser.add_argument('--collection-host', default=DEFAULT_COLLECTION_HOST, help='OpenSearch Serverless のホスト名')
+    parser.add_argument('--index-name', default=DEFAULT_INDEX_NAME, help='ベクトルストアのインデックス名')
+    parser.add_argument('--corpus', help='ベクトルストアの代わりに使うコーパスのJSONファイル')
+    parser.add_argument('--html-dir', help='ベクトルストアの代わりに使うクロール済みHTMLのディレクトリ')
+    parser.add_argument('--s3-prefix', default=DEFAULT_S3_PREFIX, help='HTMLを同期したS3の場所')
+    parser.add_argument('--data-source-id', default=DEFAULT_DATA_SOURCE_ID, help='HTMLのデータソースID')
+    parser.add_argument('--chunk-chars', type=int, default=DEFAULT_CHUNK_CHARS, help='チャンクの目安の長さ（文字数）')
+    parser.add_argument('--model-id', default=os.getenv('EMBEDDING_MODEL_ID', DEFAULT_EMBEDDING_MODEL_ID),
+                        help='埋め込みモデル（Knowledge Base と同じモデルを指定）')
+    parser.add_argument('--dtype', choices=['int8', 'float16'], default='int8', help='埋め込みの保存形式')
+    parser.add_argument('--output', default=DEFAULT_INDEX_PATH, help='索引ファイルの出力先')
+    parser.add_argument('--query', action='append', default=[], help='作成後に試す検索（複数指定可）')
+    args = parser.parse_args()
+
+    region = os.getenv('AWS_REGION', 'us-east-1')
+    endpoint_url = os.getenv('BEDROCK_ENDPOINT_URL') or None
+
+    if args.corpus or args.html_dir:
+        if args.corpus:
+            documents = list(documents_from_corpus(args.corpus, args.chunk_chars))
+        else:
+            documents = list(documents_from_html(args.html_dir, args.s3_prefix, args.data_source_id,
+                                                 args.chunk_chars))
+        print(f"{len(documents)}チャンクの埋め込みを作成します（{args.model_id}）")
+        embeddings = embed_documents(documents, args.model_id, endpoint_url, region)
+    else:
+        documents, embeddings = export_from_opensearch(args.collection_host, args.index_name, region)
+    if not documents:
+        print("書き出すチャンクがありません")
+        return 1
+
+    write_vector_index(args.output, documents, embeddings, dtype=args.dtype, model_id=args.model_id)
+    index = VectorIndex(args.output)
+    size_kb = os.path.getsize(args.output) / 1024
+    print(f"索引を作成しました: {args.output}（{len(index)}チャンク, {index.dimension}次元, {index.dtype}, {size_kb:.0f} KB）")
+
+    if args.query:
+        runtime = boto3.client('bedrock-runtime', region_name=region, endpoint_url=endpoint_url)
+        embed = TitanEmbedder(runtime, model_id=args.model_id)
+        for query in args.query:
+            query_vector = embed(query)
+            start = time.perf_counter()
+            results = index.search(query_vector, 5)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            print(f"\n'{query}'（{elapsed_ms:.3f} ms）")
+            for result in results:
+                print(f"  {result['score']:7.3f}  {result['location']['s3Location']['uri']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+質問応答APIの負荷試験
+
+lambda_handler（同じプロセス内で呼び出す）または HTTP サーバー（examples/api_server.py /
+examples/local_api_server.py の /ask）に、目標QPSまたは同時実行数で質問を送り、次の値を表示する。
+
+- スループット（件/秒）、応答時間の p50 / p95 / p99 / 最大（ミリ秒）
+- エラー率（HTTP 2xx 以外と例外）、縮退応答（degraded）の割合
+- キャッシュヒット率（{"debug": true} で返る cache_hit から集計）
+- 質問あたりのBedrock呼び出し回数（retrieve / invoke_model、リトライとヘッジを含む）
+
+質問は --questions のファイル（1行1問）または組み込みの日本語・英語の質問から選ぶ。
+--repeat-ratio の割合でそれまでに送った質問を繰り返し、残りは未送信の質問を送る
+（組み込みの質問を使い切った後は番号を付けて別の質問にする）。
+
+Bedrockの呼び出し回数は、lambda ターゲットでは boto3 クライアントの呼び出しを数えて求める。
+HTTP ターゲットでは --stand-in-url に指定した代替サーバー（scripts/local_bedrock_server.py）の
+GET /_admin/stats から求める（実際のBedrockを使う場合は表示しない）。
+
+--qps は一定間隔で送信し、応答時間は送信予定時刻から計測する（送信の遅れも応答時間に含める）。
+--concurrency は各ワーカーが応答を受け取るとすぐ次の質問を送る。
+
+使い方:
+    # 代替サーバーを同じプロセスで起動し、lambda_handler に 20 QPS で60秒間送る
+    python scripts/load_test.py --target lambda --stand-in --qps 20 --duration 60 --repeat-ratio 0.5
+
+    # 起動済みの FastAPI サーバーに同時実行数10で500件送る
+    python scripts/load_test.py --target http://127.0.0.1:8000 --concurrency 10 --requests 500 \\
+        --stand-in-url http://127.0.0.1:8010
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(SCRIPTS_DIR, '..', 'src'))
+
+BEDROCK_OPERATIONS = ('retrieve', 'invoke_model', 'invoke_model_with_response_stream')
+
+DEFAULT_QUESTIONS = [
+    'ウィジェットの設置方法を教えてください',
+    'クローラーを手動で実行するにはどうすればいいですか？',
+    'プロキシ設定でSSL証明書は自動発行されますか',
+    'アクティベーターが表示されない場合の対処法',
+    'APIキーを再発行したい',
+    'サイト内検索で翻訳後のページを検索対象にする方法',
+    '用語集をCSVで一括登録できますか',
+    '料金プランを変更すると請求はどうなりますか',
+    '言語の自動切り替えを有効にしたい',
+    '画像を言語ごとに差し替える方法',
+    'How do I install the widget?',
+    'How can I trigger the crawler through the API?',
+    'How long is the proxy cache TTL?',
+    'The activator Chrome extension does not show the toolbar',
+    'How do I exclude content from translation?',
+    'Does the proxy configuration support hreflang tags?',
+]
+
+
+class QuestionMix:
+    """繰り返しの割合に従って送る質問を選ぶ"""
+
+    def __init__(self, questions, repeat_ratio, seed=None):
+        self.questions = list(questions)
+        self.repeat_ratio = repeat_ratio
+        self._random = random.Random(seed)
+        self._sent = []
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            if self._sent and self._random.random() < self.repeat_ratio:
+                return self._random.choice(self._sent)
+            index = len(self._sent)
+            question = self.questions[index % len(self.questions)]
+            if index >= len(self.questions):
+                question = f"{question}（{index // len(self.questions) + 1}）"
+            self._sent.append(question)
+            return question
+
+
+class CountingClient:
+    """boto3 クライアントのBedrock呼び出し回数を数えるラッパー"""
+
+    def __init__(self, client, counts, lock):
+        self._client = client
+        self._counts = counts
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name not in BEDROCK_OPERATIONS:
+            return attribute
+
+        def call(*args, **kwargs):
+            with self._lock:
+                self._counts[name] = self._counts.get(name, 0) + 1
+            return attribute(*args, **kwargs)
+        return call
+
+
+class LambdaTarget:
+    """lambda_handler を同じプロセス内で呼び出す（全リクエストで1つの実行環境を共有する）"""
+
+    def __init__(self):
+        import lambda_handler
+        lambda_handler.initialize_qa_system()
+        qa = lambda_handler.qa_system
+        self._handler = lambda_handler.lambda_handler
+        self._counts = {}
+        lock = threading.Lock()
+        qa.bedrock_agent_runtime = CountingClient(qa.bedrock_agent_runtime, self._counts, lock)
+        qa.bedrock_runtime = CountingClient(qa.bedrock_runtime, self._counts, lock)
+
+    def ask(self, question):
+        event = {'httpMethod': 'POST', 'body': json.dumps({'question': question, 'debug': True})}
+        response = self._handler(event, None)
+        return response['statusCode'], json.loads(response['body'])
+
+    def bedrock_calls(self):
+        return sum(self._counts.values())
+
+
+class HttpTarget:
+    """HTTP サーバーの /ask に送る"""
+
+    def __init__(self, base_url, stand_in_url=None, timeout=60):
+        self.url = base_url.rstrip('/') + '/ask'
+        self.stand_in_url = stand_in_url.rstrip('/') if stand_in_url else None
+        self.timeout = timeout
+
+    def ask(self, question):
+        data = json.dumps({'question': question, 'debug': True}).encode('utf-8')
+        request = urllib.request.Request(self.url, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, {}
+
+    def bedrock_calls(self):
+        if self.stand_in_url is None:
+            return None
+        with urllib.request.urlopen(f"{self.stand_in_url}/_admin/stats", timeout=5) as response:
+            stats = json.loads(response.read())
+        return stats['retrieve'] + stats['invoke_model'] + stats['invoke_model_stream']
+
+
+class Recorder:
+    """リクエストごとの結果を集計する"""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.degraded = 0
+        self.cache_hits = 0
+        self.cache_reported = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency, status, body):
+        with self._lock:
+            self.latencies.append(latency)
+            if status is None or not 200 <= status < 300:
+                self.errors += 1
+                return
+            if body.get('degraded'):
+                self.degraded += 1
+            if body.get('cache_hit') is not None:
+                self.cache_reported += 1
+                self.cache_hits += bool(body['cache_hit'])
+
+
+def send(target, mix, recorder, scheduled):
+    """質問を1件送り、scheduled（送信予定時刻）からの応答時間を記録する"""
+    question = mix.next()
+    try:
+        status, body = target.ask(question)
+    except Exception:
+        status, body = None, {}
+    recorder.record(time.perf_counter() - scheduled, status, body)
+
+
+def run_open_loop(target, mix, recorder, qps, duration, total, max_in_flight):
+    """一定間隔（1/qps 秒ごと）で送信する"""
+    interval = 1 / qps
+    count = total if total else int(qps * duration)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='load') as executor:
+        for i in range(count):
+            scheduled = start + i * interval
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, target, mix, recorder, scheduled)
+
+
+def run_closed_loop(target, mix, recorder, concurrency, duration, total):
+    """concurrency 個のワーカーがそれぞれ応答を受け取るとすぐ次を送る"""
+    end = time.perf_counter() + duration
+    remaining = [total] if total else None
+    lock = threading.Lock()
+
+    def worker():
+        while time.perf_counter() < end or remaining is not None:
+            if remaining is not None:
+                with lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+            send(target, mix, recorder, time.perf_counter())
+
+    threads = [threading.Thread(target=worker, name=f'load-{i}') for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def percentile(sorted_values, value):
+    index = min(int(len(sorted_values) * value / 100), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def summarize(recorder, elapsed, bedrock_calls):
+    latencies = sorted(recorder.latencies)
+    count = len(latencies)
+    summary = {
+        'requests': count,
+        'elapsed_s': round(elapsed, 2),
+        'throughput_rps': round(count / elapsed, 2) if elapsed else 0.0,
+        'error_rate': round(recorder.errors / count, 4) if count else 0.0,
+        'degraded_rate': round(recorder.degraded / count, 4) if count else 0.0,
+        'cache_hit_ratio': round(recorder.cache_hits / recorder.cache_reported, 4) if recorder.cache_reported else None,
+        'bedrock_calls_per_question': round(bedrock_calls / count, 3) if count and bedrock_calls is not None else None,
+    }
+    if latencies:
+        summary.update({
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+            'max_ms': round(latencies[-1] * 1000, 1),
+            'mean_ms': round(statistics.mean(latencies) * 1000, 1),
+        })
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='質問応答APIの負荷試験')
+    parser.add_argument('--target', default='lambda', help='lambda または HTTP サーバーのURL（例: http://127.0.0.1:8000）')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--qps', type=float, help='目標の送信レート（件/秒）')
+    mode.add_argument('--concurrency', type=int, default=4, help='同時実行数（--qps を指定しない場合）')
+    parser.add_argument('--duration', type=float, default=30.0, help='実行時間（秒）')
+    parser.add_argument('--requests', type=int, help='送信件数（指定した場合は --duration より優先）')
+    parser.add_argument('--max-in-flight', type=int, default=64, help='--qps で同時に処理中にできる上限')
+    parser.add_argument('--repeat-ratio', type=float, default=0.3, help='送信済みの質問を繰り返す割合（0〜1）')
+    parser.add_argument('--questions', help='質問のファイル（1行1問）')
+    parser.add_argument('--seed', type=int, default=0, help='質問の選択に使う乱数のシード')
+    parser.add_argument('--stand-in', action='store_true',
+                        help='Bedrockの代替サーバーを同じプロセスで起動して使う（lambda ターゲットのみ）')
+    parser.add_argument('--stand-in-config', help='代替サーバーの設定のJSONファイル')
+    parser.add_argument('--stand-in-url', help='HTTP ターゲットが使っている代替サーバーのURL（呼び出し回数の集計用）')
+    parser.add_argument('--output', help='結果を保存するJSONファイル')
+    args = parser.parse_args()
+
+    if args.questions:
+        with open(args.questions, encoding='utf-8') as f:
+            questions = [line.strip() for line in f if line.strip()]
+    else:
+        questions = DEFAULT_QUESTIONS
+
+    stand_in = None
+    if args.target == 'lambda':
+        if args.stand_in:
+            from local_bedrock_server import start_server
+            config = None
+            if args.stand_in_config:
+                with open(args.stand_in_config, encoding='utf-8') as f:
+                    config = json.load(f)
+            stand_in = start_server(config=config, seed=args.seed)
+            os.environ['BEDROCK_ENDPOINT_URL'] = f"http://127.0.0.1:{stand_in.server_port}"
+            os.environ.setdefault('KNOWLEDGE_BASE_ID', 'LOCAL')
+        target = LambdaTarget()
+    else:
+        target = HttpTarget(args.target, args.stand_in_url)
+
+    mix = QuestionMix(questions, args.repeat_ratio, args.seed)
+    recorder = Recorder()
+    calls_before = target.bedrock_calls()
+    start = time.perf_counter()
+    if args.qps:
+        run_open_loop(target, mix, recorder, args.qps, args.duration, args.requests, args.max_in_flight)
+    else:
+        run_closed_loop(target, mix, recorder, args.concurrency, args.duration, args.requests)
+    elapsed = time.perf_counter() - start
+    calls_after = target.bedrock_calls()
+    bedrock_calls = calls_after - calls_before if calls_before is not None else None
+
+    summary = summarize(recorder, elapsed, bedrock_calls)
+    summary.update(target=args.target, qps=args.qps, concurrency=None if args.qps else args.concurrency,
+                   repeat_ratio=args.repeat_ratio)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+    if stand_in is not None:
+        stand_in.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+Bedrockのローカル代替サーバー（負荷試験・性能回帰テスト用）
+
+bedrock-agent-runtime の retrieve と bedrock-runtime の invoke_model /
+invoke_model_with_response_stream を、boto3 から同じAPIとして呼び出せる形で提供する。
+BedrockKnowledgeBaseQA は BEDROCK_ENDPOINT_URL（または endpoint_url 引数）に
+このサーバーのURLを指定すると、AWSに接続せずにこのサーバーを使う。
+
+- retrieve: フィクスチャのコーパス（既定は scripts/fixtures/kb_corpus.json）から
+  質問との語の重なりが多い順に返す
+- invoke_model: プロンプトの参考情報から回答を組み立てて返す（Claude / Titan 形式）。
+  埋め込みモデル（モデルIDに embed を含む）には語のハッシュによる決まった埋め込みを返す
+- プロンプトキャッシュ: system の cache_control までの部分を覚え、2回目以降の使用量を
+  cache_read_input_tokens、初回を cache_creation_input_tokens として返す
+- ストリーミング: 同じ回答を AWS event stream 形式で tokens_per_second の速度で返す
+
+呼び出しの種類（retrieve / invoke_model）ごとに次の値を設定できる。
+
+- latency_ms, latency_sigma: 応答までの時間の中央値（ミリ秒）と対数正規分布のσ（0で固定値）
+- slow_rate, slow_ms: 極端に遅い応答の割合と追加の遅延（テールレイテンシの再現）
+- throttle_rate: ThrottlingException（429）を返す割合
+- error_rate: InternalServerException（500）を返す割合
+- tokens_per_second: 回答の出力速度（invoke_model のみ）
+
+設定は起動時の引数・--config のJSONのほか、実行中に POST /_admin/config で変更できる。
+GET /_admin/stats で呼び出し回数を、POST /_admin/reset で回数のリセットができる。
+
+使い方:
+    python scripts/local_bedrock_server.py --port 8010 --throttle-rate 0.05
+    BEDROCK_ENDPOINT_URL=http://127.0.0.1:8010 KNOWLEDGE_BASE_ID=LOCAL python examples/local_api_server.py
+"""
+
+import argparse
+import base64
+import copy
+import json
+import logging
+import math
+import os
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'kb_corpus.json')
+
+DEFAULT_CONFIG = {
+    'retrieve': {
+        'latency_ms': 80, 'latency_sigma': 0.3, 'slow_rate': 0.0, 'slow_ms': 1000,
+        'throttle_rate': 0.0, 'error_rate': 0.0,
+    },
+    'invoke_model': {
+        'latency_ms': 300, 'latency_sigma': 0.3, 'slow_rate': 0.0, 'slow_ms': 3000,
+        'throttle_rate': 0.0, 'error_rate': 0.0, 'tokens_per_second': 200,
+    },
+}
+
+RETRIEVE_PATH = re.compile(r'^/knowledgebases/([^/]+)/retrieve$')
+INVOKE_PATH = re.compile(r'^/model/(.+)/(invoke|invoke-with-response-stream)$')
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+NON_ASCII_RUN_PATTERN = re.compile(r'[^\x00-\x7f、。「」（）・\s]+')
+# Titan Embeddings G1 - Text と同じ次元数
+EMBEDDING_DIMENSION = 1536
+
+
+def tokenize(text: str) -> set:
+    """英数字は単語、日本語は2文字ずつ（bigram）に分けた語の集合"""
+    text = text.lower()
+    tokens = set(WORD_PATTERN.findall(text))
+    for run in NON_ASCII_RUN_PATTERN.findall(text):
+        if len(run) == 1:
+            tokens.add(run)
+        tokens.update(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def embed_text(text: str, dimension: int = EMBEDDING_DIMENSION) -> List[float]:
+    """語のハッシュで次元を決めた埋め込み（同じ語を含む文ほど内積が大きくなる）"""
+    vector = [0.0] * dimension
+    for token in tokenize(text):
+        hashed = zlib.crc32(token.encode('utf-8'))
+        vector[hashed % dimension] += 1.0 if hashed & 0x80000000 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（日本語を含むため文字数の1/2とする）"""
+    return max(1, len(text) // 2)
+
+
+def encode_event(payload: bytes, event_type: str = 'chunk') -> bytes:
+    """AWS event stream（application/vnd.amazon.eventstream）のメッセージ1件"""
+    headers = b''
+    for name, value in ((':event-type', event_type), (':content-type', 'application/json'),
+                        (':message-type', 'event')):
+        name_bytes, value_bytes = name.encode(), value.encode()
+        # ヘッダー値の型 7 は文字列
+        headers += struct.pack('!B', len(name_bytes)) + name_bytes + struct.pack('!BH', 7, len(value_bytes)) + value_bytes
+    total_length = 12 + len(headers) + len(payload) + 4
+    prelude = struct.pack('!II', total_length, len(headers))
+    prelude += struct.pack('!I', zlib.crc32(prelude) & 0xffffffff)
+    message = prelude + headers + payload
+    return message + struct.pack('!I', zlib.crc32(message) & 0xffffffff)
+
+
+class StandInState:
+    """コーパス・設定・呼び出し回数（全リクエストで共有）"""
+
+    def __init__(self, corpus: List[Dict[str, Any]], config: Dict[str, Any] = None, seed: int = None):
+        self.corpus = corpus
+        self._corpus_tokens = [tokenize(doc['text']) for doc in corpus]
+        self.config = copy.deepcopy(DEFAULT_CONFIG)
+        self.update_config(config or {})
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._cached_prompts = set()
+        self.reset_stats()
+
+    def update_config(self, config: Dict[str, Any]) -> None:
+        """呼び出しの種類ごとに、指定された項目だけを上書きする"""
+        for operation, values in config.items():
+            if operation not in self.config:
+                raise ValueError(f"不明な呼び出しの種類です: {operation}")
+            unknown = set(values) - set(self.config[operation])
+            if unknown:
+                raise ValueError(f"不明な設定項目です: {', '.join(sorted(unknown))}")
+            self.config[operation].update(values)
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats = {'retrieve': 0, 'invoke_model': 0, 'invoke_model_stream': 0,
+                           'throttled': 0, 'errors': 0, 'in_flight': 0, 'max_in_flight': 0}
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def count(self, name: str, delta: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += delta
+            if name == 'in_flight':
+                self._stats['max_in_flight'] = max(self._stats['max_in_flight'], self._stats['in_flight'])
+
+    def prompt_usage(self, request: Dict[str, Any], input_tokens: int) -> Dict[str, int]:
+        """Claude の入力トークンの使用量（cache_control を付けた system ブロックまでをキャッシュする）"""
+        cached_text = ''
+        for block in request.get('system') or []:
+            if isinstance(block, dict):
+                cached_text += block.get('text', '')
+                if 'cache_control' in block:
+                    break
+        else:
+            return {'input_tokens': input_tokens}
+        cached_tokens = min(estimate_tokens(cached_text), input_tokens)
+        with self._lock:
+            hit = cached_text in self._cached_prompts
+            self._cached_prompts.add(cached_text)
+        key = 'cache_read_input_tokens' if hit else 'cache_creation_input_tokens'
+        return {'input_tokens': input_tokens - cached_tokens, key: cached_tokens}
+
+    def draw_fault(self, operation: str) -> Optional[str]:
+        """この呼び出しで返す障害（'throttle' / 'error' / None）"""
+        profile = self.config[operation]
+        with self._lock:
+            value = self._random.random()
+        if value < profile['throttle_rate']:
+            return 'throttle'
+        if value < profile['throttle_rate'] + profile['error_rate']:
+            return 'error'
+        return None
+
+    def draw_latency(self, operation: str) -> float:
+        """応答までの時間（秒）"""
+        profile = self.config[operation]
+        with self._lock:
+            noise = self._random.gauss(0, 1)
+            slow = self._random.random() < profile['slow_rate']
+        milliseconds = profile['latency_ms'] * math.exp(profile['latency_sigma'] * noise)
+        if slow:
+            milliseconds += profile['slow_ms']
+        return milliseconds / 1000
+
+    def search(self, text: str, number_of_results: int) -> List[Dict[str, Any]]:
+        """語の重なりが多い順にコーパスの文書を返す（重なりがなくても件数分は返す）"""
+        query_tokens = tokenize(text)
+        scored = []
+        for doc, doc_tokens in zip(self.corpus, self._corpus_tokens):
+            overlap = len(query_tokens & doc_tokens) / len(query_tokens) if query_tokens else 0.0
+            scored.append((overlap, doc))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [{
+            'content': {'text': doc['text']},
+            'location': {'type': 'S3', 's3Location': {'uri': doc['uri']}},
+            'score': round(0.3 + 0.6 * overlap, 4),
+            'metadata': {
+                'x-amz-bedrock-kb-source-uri': doc['uri'],
+                'x-amz-bedrock-kb-data-source-id': doc['data_source_id'],
+            },
+        } for overlap, doc in scored[:number_of_results]]
+
+
+def build_answer(prompt: str) -> str:
+    """プロンプトの質問と参考情報から、回答生成の形式に沿った回答を組み立てる"""
+    question_match = re.search(r'【質問】\s*(.+?)\s*(?:【|$)', prompt, re.S)
+    question = question_match.group(1).strip() if question_match else '質問'
+    excerpts = []
+    for match in re.finditer(r'関連情報 \d+:\n(.+?)(?:\n\n|$)', prompt, re.S):
+        sentence = match.group(1).strip().split('\n')[0]
+        excerpts.append(sentence[:80])
+    lines = [f'## {question}', f'**{question}** について、参考情報に基づいて回答します。']
+    lines.extend(f'- {excerpt}' for excerpt in excerpts[:3])
+    lines.append('**注意**: これはローカルの代替サーバーが生成した回答です。')
+    return '\n\n'.join(lines)
+
+
+def extract_prompt(request: Dict[str, Any]) -> str:
+    """Claude（Messages API）と Titan のリクエストからプロンプトの文字列を取り出す"""
+    if 'inputText' in request:
+        return request['inputText']
+    parts = []
+    for block in _text_blocks(request.get('system')):
+        parts.append(block)
+    for message in request.get('messages', []):
+        parts.extend(_text_blocks(message.get('content')))
+    return '\n\n'.join(parts)
+
+
+def _text_blocks(content: Any) -> List[str]:
+    if isinstance(content, str):
+        return [content]
+    if isinstance(content, list):
+        return [block.get('text', '') for block in content if isinstance(block, dict)]
+    return []
+
+
+class BedrockStandInHandler(BaseHTTPRequestHandler):
+    """boto3 が発行する REST リクエストを処理する"""
+
+    protocol_version = 'HTTP/1.1'
+    state: StandInState = None
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        if self.path == '/_admin/stats':
+            self._send_json(200, self.state.stats())
+        elif self.path == '/_admin/config':
+            self._send_json(200, self.state.config)
+        else:
+            self._send_json(404, {'message': f'Not found: {self.path}'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = self.path.split('?')[0]
+        if path == '/_admin/config':
+            try:
+                self.state.update_config(json.loads(body or b'{}'))
+            except ValueError as e:
+                self._send_json(400, {'message': str(e)})
+                return
+            self._send_json(200, self.state.config)
+            return
+        if path == '/_admin/reset':
+            self.state.reset_stats()
+            self._send_json(200, self.state.stats())
+            return
+
+        retrieve_match = RETRIEVE_PATH.match(path)
+        invoke_match = INVOKE_PATH.match(path)
+        if retrieve_match:
+            self._serve('retrieve', 'retrieve', lambda: self._retrieve(json.loads(body)))
+        elif invoke_match and invoke_match.group(2) == 'invoke':
+            self._serve('invoke_model', 'invoke_model',
+                        lambda: self._invoke(unquote(invoke_match.group(1)), json.loads(body)))
+        elif invoke_match:
+            self._serve('invoke_model', 'invoke_model_stream',
+                        lambda: self._invoke_stream(unquote(invoke_match.group(1)), json.loads(body)))
+        else:
+            self._send_error(404, 'ResourceNotFoundException', f'Not found: {path}')
+
+    def _serve(self, operation: str, counter: str, handler) -> None:
+        """遅延と障害を挟んで handler を実行する"""
+        self.state.count(counter)
+        self.state.count('in_flight')
+        try:
+            fault = self.state.draw_fault(operation)
+            if fault == 'throttle':
+                self.state.count('throttled')
+                self._send_error(429, 'ThrottlingException', 'Too many requests, please wait before trying again.')
+                return
+            if fault == 'error':
+                self.state.count('errors')
+                self._send_error(500, 'InternalServerException', 'Injected internal server error.')
+                return
+            time.sleep(self.state.draw_latency(operation))
+            handler()
+        finally:
+            self.state.count('in_flight', -1)
+
+    def _retrieve(self, request: Dict[str, Any]) -> None:
+        text = request.get('retrievalQuery', {}).get('text', '')
+        number_of_results = (request.get('retrievalConfiguration', {})
+                             .get('vectorSearchConfiguration', {}).get('numberOfResults', 5))
+        self._send_json(200, {'retrievalResults': self.state.search(text, number_of_results)})
+
+    def _generate(self, request: Dict[str, Any]) -> Tuple[str, int]:
+        """回答と入力トークン数"""
+        prompt = extract_prompt(request)
+        return build_answer(prompt), estimate_tokens(prompt)
+
+    def _invoke(self, model_id: str, request: Dict[str, Any]) -> None:
+        if 'embed' in model_id:
+            text = request.get('inputText', '')
+            self._send_json(200, {'embedding': embed_text(text), 'inputTextTokenCount': estimate_tokens(text)})
+            return
+        answer, input_tokens = self._generate(request)
+        output_tokens = estimate_tokens(answer)
+        time.sleep(output_tokens / self.state.config['invoke_model']['tokens_per_second'])
+        if 'inputText' in request:
+            body = {'inputTextTokenCount': input_tokens,
+                    'results': [{'tokenCount': output_tokens, 'outputText': answer, 'completionReason': 'FINISH'}]}
+        else:
+            body = {'id': 'msg_local', 'type': 'message', 'role': 'assistant', 'model': model_id,
+                    'content': [{'type': 'text', 'text': answer}], 'stop_reason': 'end_turn',
+                    'usage': dict(self.state.prompt_usage(request, input_tokens), output_tokens=output_tokens)}
+        self._send_json(200, body)
+
+    def _invoke_stream(self, model_id: str, request: Dict[str, Any]) -> None:
+        answer, input_tokens = self._generate(request)
+        # 2文字を1トークンとして送る
+        pieces = [answer[i:i + 2] for i in range(0, len(answer), 2)]
+        interval = 1 / self.state.config['invoke_model']['tokens_per_second']
+        if 'inputText' in request:
+            payloads = [{'outputText': piece, 'index': 0} for piece in pieces]
+        else:
+            payloads = [{'type': 'message_start', 'message': {'usage': self.state.prompt_usage(request, input_tokens)}},
+                        {'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}}]
+            payloads += [{'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': piece}}
+                         for piece in pieces]
+            payloads += [{'type': 'content_block_stop', 'index': 0},
+                         {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'},
+                          'usage': {'output_tokens': len(pieces)}},
+                         {'type': 'message_stop'}]
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.amazon.eventstream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for payload in payloads:
+            chunk = {'bytes': base64.b64encode(json.dumps(payload, ensure_ascii=False).encode()).decode()}
+            message = encode_event(json.dumps(chunk).encode())
+            self.wfile.write(f'{len(message):x}\r\n'.encode() + message + b'\r\n')
+            self.wfile.flush()
+            if payload.get('type', 'content_block_delta') == 'content_block_delta':
+                time.sleep(interval)
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _send_json(self, status: int, body: Dict[str, Any], headers: Dict[str, str] = None) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, error_type: str, message: str) -> None:
+        # botocore は x-amzn-ErrorType ヘッダーからエラーコードを判定する
+        self._send_json(status, {'message': message}, {'x-amzn-ErrorType': error_type})
+
+
+def load_corpus(path: str = None) -> List[Dict[str, Any]]:
+    with open(path or DEFAULT_CORPUS, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def start_server(port: int = 0, host: str = '127.0.0.1', config: Dict[str, Any] = None,
+                 corpus_path: str = None, seed: int = None) -> ThreadingHTTPServer:
+    """代替サーバーを別スレッドで起動する（port=0 の場合は空いているポートを使う）
+
+    URL は f"http://{host}:{server.server_port}"、設定と呼び出し回数は server.state で参照できる。
+    停止する場合は server.shutdown() を呼び出す。
+    """
+    state = StandInState(load_corpus(corpus_path), config, seed)
+    handler = type('BoundBedrockStandInHandler', (BedrockStandInHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, name='bedrock-stand-in', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bedrockのローカル代替サーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8010)
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help='コーパスのJSONファイル')
+    parser.add_argument('--config', help='呼び出しの種類ごとの設定を記述したJSONファイル')
+    parser.add_argument('--seed', type=int, help='遅延と障害の乱数のシード')
+    parser.add_argument('--retrieve-latency-ms', type=float)
+    parser.add_argument('--invoke-latency-ms', type=float)
+    parser.add_argument('--latency-sigma', type=float, help='対数正規分布のσ（全ての呼び出しに適用）')
+    parser.add_argument('--tokens-per-second', type=float)
+    parser.add_argument('--slow-rate', type=float, help='極端に遅い応答の割合（全ての呼び出しに適用）')
+    parser.add_argument('--throttle-rate', type=float, help='ThrottlingException を返す割合（全ての呼び出しに適用）')
+    parser.add_argument('--error-rate', type=float, help='500エラーを返す割合（全ての呼び出しに適用）')
+    args = parser.parse_args()
+
+    config = {'retrieve': {}, 'invoke_model': {}}
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            for operation, values in json.load(f).items():
+                config.setdefault(operation, {}).update(values)
+    for operation in ('retrieve', 'invoke_model'):
+        for option in ('latency_sigma', 'slow_rate', 'throttle_rate', 'error_rate'):
+            if getattr(args, option) is not None:
+                config[operation][option] = getattr(args, option)
+    if args.retrieve_latency_ms is not None:
+        config['retrieve']['latency_ms'] = args.retrieve_latency_ms
+    if args.invoke_latency_ms is not None:
+        config['invoke_model']['latency_ms'] = args.invoke_latency_ms
+    if args.tokens_per_second is not None:
+        config['invoke_model']['tokens_per_second'] = args.tokens_per_second
+
+    logging.basicConfig(level=logging.INFO)
+    server = start_server(args.port, args.host, config, args.corpus, args.seed)
+    print(f"Bedrock代替サーバーを起動しました: http://{args.host}:{server.server_port}")
+    print(f"  BEDROCK_ENDPOINT_URL=http://{args.host}:{server.server_port} を設定して利用してください")
+    print(json.dumps(server.state.config, ensure_ascii=False, indent=2))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,34 @@ Knowledge Baseのデータソース同期を開始するスクリプト
 """
 
 import boto3
+import os
+import sys
 import time
 from botocore.exceptions import ClientError
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+from qa_cache import create_answer_cache, create_retrieval_cache
+
+def invalidate_caches(knowledge_base_id):
+    """同期完了後に検索結果キャッシュと回答キャッシュを無効化（共有バックエンドの場合のみ全ワーカーに反映）"""
+    for name, ttl_name, create in (
+        ('Retrieval', 'RETRIEVAL_CACHE_TTL', lambda: create_retrieval_cache(knowledge_base_id)),
+        ('Answer', 'ANSWER_CACHE_TTL', lambda: create_answer_cache(knowledge_base_id=knowledge_base_id)),
+    ):
+        try:
+            cache = create()
+            if cache is None:
+                continue
+            if cache.backend.process_local:
+                # プロセス内メモリのキャッシュは Lambda のワーカーから参照できないため無効化できない
+                print(f"Warning: {name.lower()} cache backend is process-local (memory); skipped invalidation. "
+                      f"Workers keep cached entries until {ttl_name} expires. Use a shared backend (redis) to invalidate.")
+                continue
+            generation = cache.invalidate()
+            print(f"{name} cache invalidated (generation: {generation})")
+        except Exception as e:
+            print(f"Failed to invalidate {name.lower()} cache: {e}")
+
 def start_ingestion():
     """データソースの同期を開始"""
     
@@ -43,6 +68,7 @@ def start_ingestion():
                 # 統計情報を表示
                 statistics = job_response['ingestionJob'].get('statistics', {})
                 print(f"Statistics: {statistics}")
+                invalidate_caches(knowledge_base_id)
                 break
             elif status == 'FAILED':
                 print("Ingestion failed!")
@@ -0,0 +1,335 @@
+"""
+回答のフォーマット処理
+
+format_answer は BedrockKnowledgeBaseQA.format_answer の本体。正規表現はすべて
+モジュール読み込み時にコンパイルし、変換手順は発動条件となる文字列を含む場合だけ実行する。
+IncrementalAnswerFormatter は同じ変換を生成途中のテキスト断片に段階的に適用する。
+各変換段は後続のテキストによって結果が変わらない部分だけを確定して次の段へ渡すため、
+全断片の出力を連結すると format_answer(全文) とバイト単位で一致する。
+build_extractive_answer は回答を生成できない場合に、検索結果の抜粋から応答を組み立てる。
+"""
+
+import re
+from typing import Any, Callable, Dict, List
+
+# 見出し（## で始まる行）の前後に改行を追加
+HEADING_BREAK_PATTERN = re.compile(r'(?<!\n)(##\s[^\n]+)')
+# 句点の後に日本語文字、*、#、-が続く場合のみ改行を追加
+SENTENCE_BREAK_PATTERN = re.compile(r'。\s*(?=[あ-んア-ン一-龯ぁ-ゟ\*\#\-])')
+# 番号付きリストの開始の前に改行を追加
+NUMBERED_LIST_PATTERN = re.compile(r'(?<!\n)(\d+\.\s)')
+# 箇条書きの開始の前に改行を追加
+BULLET_LIST_PATTERN = re.compile(r'(?<!\n)(- [^\n]+)')
+# **注意**: や **推奨**: の前に改行を追加
+NOTE_PATTERN = re.compile(r'(?<!\n)(\*\*(?:注意|推奨|重要)\*\*:)')
+# コードブロックの前後に改行を追加
+CODE_FENCE_BEFORE_PATTERN = re.compile(r'(?<!\n)(```)')
+CODE_FENCE_AFTER_PATTERN = re.compile(r'(```)(?!\n)')
+# 連続する3つ以上の改行
+EXCESS_NEWLINES_PATTERN = re.compile(r'\n{3,}')
+# Markdownの太字・見出し
+BOLD_PATTERN = re.compile(r'\*\*([^*]+)\*\*')
+HEADING_PATTERN = re.compile(r'##\s+([^\n]+)')
+PARAGRAPH_BREAK_PATTERN = re.compile(r'\n\n')
+LINE_BREAK_PATTERN = re.compile(r'\n')
+HEADING_LEADING_BREAK_PATTERN = re.compile(r'<br><br><h3>')
+HEADING_TRAILING_BREAK_PATTERN = re.compile(r'</h3><br><br>')
+
+# 長い文章を分割する行の長さと、分割後の目安の長さ
+LONG_LINE_LENGTH = 100
+SPLIT_LINE_LENGTH = 80
+
+# 抜粋による応答の、検索結果1件あたりの最大文字数
+EXCERPT_LENGTH = 300
+DEGRADED_NOTICE = '**注意**: 現在、回答を生成できないため、関連する情報の抜粋を表示しています。'
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def split_long_line(line: str) -> List[str]:
+    """長い行（100文字以上で句点がある場合）を句点の位置で適度な長さに分割"""
+    if len(line) <= LONG_LINE_LENGTH or '。' not in line:
+        return [line]
+
+    processed_lines = []
+    parts = line.split('。')
+    current_part = ''
+    for i, part in enumerate(parts):
+        if i < len(parts) - 1:  # 最後の部分以外
+            current_part += part + '。'
+            if len(current_part) > SPLIT_LINE_LENGTH:  # 適度な長さになったら改行
+                processed_lines.append(current_part)
+                current_part = ''
+        else:
+            current_part += part
+    if current_part:
+        processed_lines.append(current_part)
+    return processed_lines
+
+
+# ---------------------------------------------------------------------------
+# 一括フォーマット
+#
+# 上の各パターンと同じ照合結果になるよう、後読みをパターン先頭の固定文字列の後ろへ移して
+# 先頭文字による高速な探索が効くようにしたもの（例: (?<!\n)## と ##(?<!\n##) は同じ位置に一致する）。
+# 置換はテンプレート展開を避けて関数または固定文字列で行う。
+# ---------------------------------------------------------------------------
+
+_HEADING_LINE_PATTERN = re.compile(r'##(?<!\n##)\s[^\n]+')
+_NUMBERED_ITEM_PATTERN = re.compile(r'\d(?<!\n\d)\d*\.\s')
+_BULLET_ITEM_PATTERN = re.compile(r'- (?<!\n- )[^\n]+')
+_NOTE_LABEL_PATTERN = re.compile(r'\*\*(?<!\n\*\*)(?:注意|推奨|重要)\*\*:')
+_CODE_FENCE_PATTERN = re.compile(r'```(?<!\n```)')
+_LONG_LINE_PATTERN = re.compile(r'[^\n]{%d,}' % (LONG_LINE_LENGTH + 1))
+
+
+def _break_around(match: 're.Match') -> str:
+    return '\n\n' + match.group() + '\n\n'
+
+
+def _break_before(match: 're.Match') -> str:
+    return '\n\n' + match.group()
+
+
+def _split_long_match(match: 're.Match') -> str:
+    return '\n'.join(split_long_line(match.group()))
+
+
+def _strong(match: 're.Match') -> str:
+    return '<strong>' + match.group(1) + '</strong>'
+
+
+def _heading(match: 're.Match') -> str:
+    return '<h3>' + match.group(1) + '</h3>'
+
+
+# (発動条件の文字列, パターン, 置換)。条件の文字列を含まないテキストにはパターンが一致しない
+_LAYOUT_STEPS = (
+    ('##', _HEADING_LINE_PATTERN, _break_around),       # 1. 見出しの前後
+    ('。', SENTENCE_BREAK_PATTERN, '。\n\n'),           # 2. 句点の後
+    ('.', _NUMBERED_ITEM_PATTERN, _break_before),       # 3. 番号付きリスト
+    ('- ', _BULLET_ITEM_PATTERN, _break_before),        # 4. 箇条書き
+    ('**', _NOTE_LABEL_PATTERN, _break_before),         # 5. **注意**: など
+    ('```', _CODE_FENCE_PATTERN, _break_before),        # 6. コードブロックの前
+    ('```', CODE_FENCE_AFTER_PATTERN, '```\n\n'),       #    コードブロックの後
+    ('。', _LONG_LINE_PATTERN, _split_long_match),      # 7. 長い行の分割
+    ('\n\n\n', EXCESS_NEWLINES_PATTERN, '\n\n'),        # 8. 3つ以上の改行
+)
+
+_MARKUP_STEPS = (
+    ('**', BOLD_PATTERN, _strong),                      # 10. 太字
+    ('##', HEADING_PATTERN, _heading),                  # 11. 見出し
+)
+
+
+def format_answer(answer: str) -> str:
+    """回答を読みやすい形式にフォーマットする
+
+    変換内容（番号は各手順のコメントと対応）:
+    1. 見出し（## で始まる行）の前後に改行を追加
+    2. 句点の後に日本語文字、*、#、-が続く場合のみ改行を追加（URLや英数字の途中を避ける）
+    3-6. 番号付きリスト、箇条書き、**注意**: など、コードブロックの前（後）に改行を追加
+    7. 長い文章の適度な改行（100文字以上で句点がある場合）
+    8. 連続する3つ以上の改行を2つに制限
+    9. 文頭と文末の不要な改行を除去
+    10-11. Markdownの太字と見出し（## ）をHTMLに変換
+    12. Web表示用に改行コードをHTMLブレークタグに変換
+    13. h3タグの前後の不要な<br>タグを除去
+    """
+    if not answer:
+        return answer
+
+    formatted = answer.strip()
+    for trigger, pattern, repl in _LAYOUT_STEPS:
+        if trigger in formatted:
+            formatted = pattern.sub(repl, formatted)
+
+    formatted = formatted.strip()
+    for trigger, pattern, repl in _MARKUP_STEPS:
+        if trigger in formatted:
+            formatted = pattern.sub(repl, formatted)
+
+    # 段落間の '\n\n' → '<br><br>' も1回の置換で同じ結果になる
+    formatted = formatted.replace('\n', '<br>')
+    if '<h3>' in formatted:
+        formatted = formatted.replace('<br><br><h3>', '<h3>')
+    if '</h3>' in formatted:
+        formatted = formatted.replace('</h3><br><br>', '</h3>')
+    return formatted
+
+
+def _excerpt(content: str, length: int = EXCERPT_LENGTH) -> str:
+    """空白をまとめ、length 文字以内の最後の句点（なければ length 文字）までを返す"""
+    text = WHITESPACE_PATTERN.sub(' ', content).strip()
+    if len(text) <= length:
+        return text
+    cut = text.rfind('。', 0, length)
+    return text[:cut + 1] if cut > 0 else text[:length] + '…'
+
+
+def build_extractive_answer(retrieved_context: List[Dict[str, Any]]) -> str:
+    """検索結果の抜粋から応答を組み立て、format_answer 済みのHTMLを返す"""
+    sections = [DEGRADED_NOTICE]
+    for i, item in enumerate(retrieved_context):
+        excerpt = _excerpt(item.get('content', ''))
+        if excerpt:
+            sections.append(f"## 関連情報 {i + 1}\n\n{excerpt}")
+    return format_answer('\n\n'.join(sections))
+
+
+# ---------------------------------------------------------------------------
+# 逐次フォーマット
+#
+# 各変換段は「未確定位置」（後続のテキスト次第で照合結果が変わりうる最初の位置）を
+# 求め、それより前で始まる照合だけを確定させる。未確定位置は、バッファ末尾が
+# パターンの途中まで一致している（またはさらに伸びうる）最左の位置として求める。
+# ---------------------------------------------------------------------------
+
+def _tail_limit(pattern: 're.Pattern') -> Callable[[str], int]:
+    """末尾に一致するパターン（照合途中の状態）の最左位置を未確定位置とする"""
+    def limit(buffer: str) -> int:
+        match = pattern.search(buffer)
+        return match.start() if match else len(buffer)
+    return limit
+
+
+def _literal_prefix_limit(*literals: str) -> Callable[[str], int]:
+    """末尾がいずれかの固定文字列の途中まで一致している場合、その開始位置を未確定位置とする"""
+    def limit(buffer: str) -> int:
+        for size in range(max(len(literal) for literal in literals) - 1, 0, -1):
+            tail = buffer[-size:]
+            if len(tail) == size and any(literal.startswith(tail) for literal in literals):
+                return len(buffer) - size
+        return len(buffer)
+    return limit
+
+
+class _SubStage:
+    """正規表現による置換を逐次適用する変換段（後読みは直前の1文字まで）"""
+
+    def __init__(self, pattern: 're.Pattern', repl: str, limit: Callable[[str], int]):
+        self.pattern = pattern
+        self.repl = repl
+        self.limit = limit
+        self.context = ''
+        self.buffer = ''
+
+    def feed(self, text: str) -> str:
+        if not text:
+            return ''
+        self.buffer += text
+        return self._drain(self.limit(self.buffer))
+
+    def finish(self) -> str:
+        return self._drain(len(self.buffer))
+
+    def _drain(self, limit: int) -> str:
+        full = self.context + self.buffer
+        offset = len(self.context)
+        limit += offset
+        pos = offset
+        output = []
+        while pos < limit:
+            match = self.pattern.search(full, pos)
+            if match is None or match.start() >= limit:
+                break
+            output.append(full[pos:match.start()])
+            output.append(match.expand(self.repl))
+            pos = match.end()
+        end = max(pos, limit)
+        output.append(full[pos:end])
+        self.context = full[max(offset, end - 1):end] or self.context
+        self.buffer = full[end:]
+        return ''.join(output)
+
+
+class _StripStage:
+    """先頭と末尾の空白を除去する変換段（str.strip と同じ判定）"""
+
+    def __init__(self):
+        self.started = False
+        self.pending = ''
+
+    def feed(self, text: str) -> str:
+        if not self.started:
+            text = text.lstrip()
+            if not text:
+                return ''
+            self.started = True
+        text = self.pending + text
+        body = text.rstrip()
+        self.pending = text[len(body):]
+        return body
+
+    def finish(self) -> str:
+        return ''
+
+
+class _LineStage:
+    """行単位で長い文章を分割する変換段"""
+
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, text: str) -> str:
+        self.buffer += text
+        if '\n' not in self.buffer:
+            return ''
+        *lines, self.buffer = self.buffer.split('\n')
+        return ''.join('\n'.join(split_long_line(line)) + '\n' for line in lines)
+
+    def finish(self) -> str:
+        return '\n'.join(split_long_line(self.buffer))
+
+
+class IncrementalAnswerFormatter:
+    """生成途中の回答テキストを逐次フォーマットする
+
+    feed() には新たに生成されたテキストを渡し、確定したHTML断片を受け取る。
+    生成完了後に finish() を呼ぶと残りの断片が返る。返された断片をすべて連結すると
+    format_answer(全文) と一致する。各段は未確定部分だけを保持するため、
+    全文を毎回フォーマットし直す場合と異なり処理量はテキスト長に比例する。
+    """
+
+    def __init__(self):
+        self._stages = [
+            _StripStage(),
+            _SubStage(HEADING_BREAK_PATTERN, r'\n\n\1\n\n', _tail_limit(re.compile(r'##?\Z|##\s[^\n]*\Z'))),
+            _SubStage(SENTENCE_BREAK_PATTERN, '。\n\n', _tail_limit(re.compile(r'。\s*\Z'))),
+            _SubStage(NUMBERED_LIST_PATTERN, r'\n\n\1', _tail_limit(re.compile(r'\d+\.?\Z'))),
+            _SubStage(BULLET_LIST_PATTERN, r'\n\n\1', _tail_limit(re.compile(r'-\Z|- [^\n]*\Z'))),
+            _SubStage(NOTE_PATTERN, r'\n\n\1', _literal_prefix_limit('**注意**:', '**推奨**:', '**重要**:')),
+            _SubStage(CODE_FENCE_BEFORE_PATTERN, r'\n\n\1', _literal_prefix_limit('```')),
+            _SubStage(CODE_FENCE_AFTER_PATTERN, r'\1\n\n', _tail_limit(re.compile(r'`{1,3}\Z'))),
+            _LineStage(),
+            _SubStage(EXCESS_NEWLINES_PATTERN, '\n\n', _tail_limit(re.compile(r'\n+\Z'))),
+            _StripStage(),
+            _SubStage(BOLD_PATTERN, r'<strong>\1</strong>', _tail_limit(re.compile(r'\*(?:\*(?:[^*]+\*?)?)?\Z'))),
+            _SubStage(HEADING_PATTERN, r'<h3>\1</h3>', _tail_limit(re.compile(r'##?\Z|##\s+[^\n]*\Z'))),
+            _SubStage(PARAGRAPH_BREAK_PATTERN, '<br><br>', _tail_limit(re.compile(r'\n\Z'))),
+            _SubStage(LINE_BREAK_PATTERN, '<br>', len),
+            _SubStage(HEADING_LEADING_BREAK_PATTERN, '<h3>', _literal_prefix_limit('<br><br><h3>')),
+            _SubStage(HEADING_TRAILING_BREAK_PATTERN, '</h3>', _literal_prefix_limit('</h3><br><br>')),
+        ]
+        self._finished = False
+
+    def feed(self, text: str) -> str:
+        """テキスト断片を追加し、確定したHTML断片を返す"""
+        if self._finished:
+            raise RuntimeError('finish() の後に feed() は呼べません')
+        if not text:
+            return ''
+        for stage in self._stages:
+            text = stage.feed(text)
+            if not text:
+                return ''
+        return text
+
+    def finish(self) -> str:
+        """残りのHTML断片を返す"""
+        if self._finished:
+            return ''
+        self._finished = True
+        output = ''
+        for stage in self._stages:
+            output = stage.feed(output) + stage.finish()
+        return output
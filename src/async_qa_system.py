@@ -0,0 +1,159 @@
+"""
+asyncio 対応の質問応答
+
+AsyncBedrockKnowledgeBaseQA は BedrockKnowledgeBaseQA と同じ検索・生成・キャッシュを使い、
+boto3 の呼び出し・キャッシュの入出力（Redis・SQLite ではブロックする）・検索結果の統合と並べ替えや
+回答のフォーマットなどの CPU 処理を専用のスレッドプールで実行する。サブクエリの同時実行は asyncio.gather、
+リトライ待ちは asyncio.sleep で行うため、FastAPI などのイベントループを止めずに
+複数のリクエストを同時に処理できる。同じ質問が処理中の場合は、そのタスクの完了を待って結果を共有する。
+リトライの条件と時間予算は同期版と同じ resilience の設定を使う。
+"""
+
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+from bedrock_qa_system import BedrockKnowledgeBaseQA
+from metrics import annotate
+from qa_cache import normalize_query
+from resilience import Deadline, call_with_retry_async
+from retrieval_fanout import SubQuery, fan_out_retrieve_async, run_blocking
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBedrockKnowledgeBaseQA:
+    """BedrockKnowledgeBaseQA の asyncio 版"""
+
+    def __init__(self, qa_system: BedrockKnowledgeBaseQA = None):
+        self.qa_system = qa_system or BedrockKnowledgeBaseQA()
+
+        # boto3 の呼び出しを実行するスレッドプール（同時に処理できるAPI呼び出し数の上限）
+        self.max_workers = int(os.getenv('ASYNC_QA_MAX_WORKERS', '16'))
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix='kb-async'
+        )
+
+        # 処理中の質問（正規化後）ごとのタスク
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+    async def retrieve_from_knowledge_base(self, query: str, max_results: int = 3,
+                                           deadline: Deadline = None) -> List[Dict[str, Any]]:
+        """Knowledge Baseから関連情報を取得（サブクエリは同時に実行）"""
+        qa = self.qa_system
+        sub_queries = await self._run(qa._build_sub_queries, query, max_results)
+        # 同期版（_retrieve_with_depth）と同じ RetrievalStages の順序で検索する（主クエリの並べ替えは executor で行う）
+        stages = qa.retrieval_depth.stages(query, sub_queries, max_results, qa._rank_results)
+        batch = stages.next_batch([])
+        while batch:
+            batch = await self._run(stages.next_batch, await self._fan_out(batch, deadline))
+        return await self._run(self._fuse_and_rank, stages.issued, stages.results, max_results)
+
+    def _fuse_and_rank(self, sub_queries: List[SubQuery], all_results: List[Dict[str, Any]],
+                       max_results: int) -> List[Dict[str, Any]]:
+        """キーワード索引の結果の統合と、重複除去・並べ替え（CPU処理のため executor で実行する）"""
+        qa = self.qa_system
+        all_results = qa._fuse_keyword_results(sub_queries, all_results, max_results)
+        return qa._rank_results(all_results, max_results)
+
+    async def _run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """ブロックする処理（キャッシュの入出力・CPU処理）をイベントループの外で実行する"""
+        return await run_blocking(self._executor, func, *args)
+
+    async def _fan_out(self, sub_queries: List[SubQuery], deadline: Deadline = None) -> List[Dict[str, Any]]:
+        """サブクエリを同時に実行"""
+        qa = self.qa_system
+        return await fan_out_retrieve_async(
+            qa.bedrock_agent_runtime,
+            qa.knowledge_base_id,
+            sub_queries,
+            executor=self._executor,
+            cache=qa.retrieval_cache,
+            deadline=deadline
+        )
+
+    async def generate_answer_with_bedrock(self, query: str, retrieved_context: List[Dict[str, Any]],
+                                           deadline: Deadline = None) -> str:
+        """取得したコンテキストを使ってBedrockで回答を生成（失敗した場合は例外を送出）
+
+        モデルの振り分けとエスカレーションは BedrockKnowledgeBaseQA.generate_answer_with_bedrock と同じ。
+        """
+        qa = self.qa_system
+        breaker = qa.generation_breaker
+        route, reason = qa.model_router.choose(query, retrieved_context)
+        annotate(model_route=route.name, model_route_reason=reason)
+        try:
+            answer = await call_with_retry_async(
+                functools.partial(qa._invoke_model, query, retrieved_context, route),
+                "回答生成", deadline, executor=self._executor
+            )
+        except Exception as e:
+            breaker.record_error(e)
+            raise
+        breaker.record_success()
+
+        if qa.model_router.should_escalate(route, reason, answer) and qa._generation_skip_reason(deadline) is None:
+            logger.info(f"小さいモデルの回答が不十分なため大きいモデルで生成し直します: {query}")
+            annotate(model_route='escalated')
+            try:
+                answer = await call_with_retry_async(
+                    functools.partial(qa._invoke_model, query, retrieved_context, qa.model_router.large),
+                    "回答生成", deadline, executor=self._executor
+                )
+            except Exception as e:
+                logger.warning(f"大きいモデルでの生成に失敗しました（小さいモデルの回答を使います）: {str(e)}")
+        return answer
+
+    async def ask_question(self, query: str, deadline: Deadline = None) -> Dict[str, Any]:
+        """質問応答の実行（deadline を省略した場合は REQUEST_DEADLINE_SECONDS 秒）"""
+        qa = self.qa_system
+        logger.info(f"質問を処理中: {query}")
+
+        # キャッシュ確認
+        if qa.answer_cache is not None:
+            cached_result = await self._run(qa.answer_cache.get, query)
+            if cached_result is not None:
+                logger.info("キャッシュから回答を返します")
+                annotate(cache_hit=True)
+                return cached_result
+
+        # 同じ質問を処理中なら、そのタスクの結果を共有する
+        key = normalize_query(query)
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._answer_question(query, deadline or Deadline()))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # 呼び出し元がキャンセルされても、同じ結果を待つ他の呼び出し元のために処理は続ける
+        return await asyncio.shield(task)
+
+    async def _answer_question(self, query: str, deadline: Deadline = None) -> Dict[str, Any]:
+        """検索と回答生成を行う（キャッシュ確認済みの質問に対して呼ぶ）"""
+        qa = self.qa_system
+
+        # Step 1: Knowledge Baseから関連情報を取得
+        retrieved_context = await self.retrieve_from_knowledge_base(query, deadline=deadline)
+
+        if not retrieved_context:
+            return await self._run(qa._no_information_result, query)
+
+        # Step 2: 取得した情報を使って回答を生成（生成できない場合は抜粋による縮退応答）
+        reason = qa._generation_skip_reason(deadline)
+        if reason is None:
+            try:
+                raw_answer = await self.generate_answer_with_bedrock(query, retrieved_context, deadline)
+            except Exception as e:
+                logger.error(f"回答生成の最大試行回数に達しました: {str(e)}")
+                reason = 'generation_failed'
+            else:
+                # 回答のフォーマットとキャッシュへの保存
+                return await self._run(qa._build_answer_result, query, retrieved_context, raw_answer)
+        return await self._run(qa._degraded_result, query, retrieved_context, reason)
+
+    def close(self) -> None:
+        """スレッドプールを終了"""
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,176 @@
+"""
+複数の質問の一括処理
+
+ask_questions_batch は質問の一覧を正規化して重複を除き、同時実行数を制限して回答を生成する。
+バッチ内の質問どうしで同じサブクエリ（英語翻訳や技術用語の文脈検索など）が現れた場合、
+Knowledge Base の検索は1回だけ行い、その結果を共有する。deadline を渡した場合はバッチ全体で
+同じ時間予算を使い、期限を過ぎた質問は失敗として返す。
+"""
+
+import contextvars
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from qa_cache import normalize_query
+from resilience import Deadline
+from retrieval_fanout import SubQuery, merge_results, retrieve_sub_queries
+
+logger = logging.getLogger(__name__)
+
+# 1回のバッチで受け付ける質問数の上限
+BATCH_MAX_QUESTIONS = int(os.getenv('BATCH_MAX_QUESTIONS', '200'))
+# 同時に回答を生成する質問数の上限（リクエストで指定された値もこれを超えない）
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '4'))
+
+# ask_question と同じ検索件数
+BATCH_MAX_RESULTS = 3
+
+
+class _SharedSubQueries:
+    """バッチ内で同じサブクエリの検索を1回にまとめる"""
+
+    def __init__(self, qa_system: Any, deadline: Deadline = None):
+        self.qa_system = qa_system
+        self.deadline = deadline
+        self.shared = 0  # 他の質問の検索結果を再利用したサブクエリ数
+        self._futures: Dict[SubQuery, Future] = {}
+        self._lock = threading.Lock()
+
+    def retrieve(self, sub_queries: List[SubQuery]) -> List[Dict[str, Any]]:
+        """サブクエリの検索結果を発行順にマージして返す（失敗したサブクエリは除外）"""
+        owned = []
+        futures = []
+        with self._lock:
+            for sub_query in sub_queries:
+                future = self._futures.get(sub_query)
+                if future is None:
+                    future = Future()
+                    self._futures[sub_query] = future
+                    owned.append(sub_query)
+                else:
+                    self.shared += 1
+                futures.append(future)
+
+        if owned:
+            qa = self.qa_system
+            results_by_index = {}
+            try:
+                results_by_index = retrieve_sub_queries(
+                    qa.bedrock_agent_runtime,
+                    qa.knowledge_base_id,
+                    owned,
+                    executor=qa._retrieval_executor,
+                    cache=qa.retrieval_cache,
+                    deadline=self.deadline
+                )
+            finally:
+                # 待っている他の質問を止めないよう、失敗しても必ず結果を確定させる
+                for index, sub_query in enumerate(owned):
+                    self._futures[sub_query].set_result(results_by_index.get(index, []))
+
+        return merge_results({index: future.result() for index, future in enumerate(futures)})
+
+
+def _answer(qa_system: Any, query: str, shared: _SharedSubQueries) -> Dict[str, Any]:
+    """1つの質問に回答する（検索は shared を通してバッチ内で共有）"""
+    if qa_system.answer_cache is not None:
+        cached_result = qa_system.answer_cache.get(query)
+        if cached_result is not None:
+            return cached_result
+
+    # バッチ外で同じ質問を処理中なら、その結果を共有する
+    return qa_system._in_flight.do(normalize_query(query), lambda: _answer_uncached(qa_system, query, shared),
+                                   shared.deadline)
+
+
+def _answer_uncached(qa_system: Any, query: str, shared: _SharedSubQueries) -> Dict[str, Any]:
+    if shared.deadline is not None:
+        shared.deadline.check(f"質問 '{query}' ")
+    sub_queries = qa_system._build_sub_queries(query, BATCH_MAX_RESULTS)
+    # retrieve_from_knowledge_base と同じく主クエリの確信度で拡張クエリを絞り、キーワード索引の結果を統合する
+    sub_queries, all_results = qa_system._retrieve_with_depth(query, sub_queries, BATCH_MAX_RESULTS, shared.retrieve)
+    all_results = qa_system._fuse_keyword_results(sub_queries, all_results, BATCH_MAX_RESULTS)
+    retrieved_context = qa_system._rank_results(all_results, BATCH_MAX_RESULTS)
+    if not retrieved_context:
+        return qa_system._no_information_result(query)
+
+    return qa_system._answer_with_context(query, retrieved_context, shared.deadline)
+
+
+def ask_questions_batch(qa_system: Any, questions: List[Any], max_concurrency: int = None,
+                        deadline: Deadline = None) -> Dict[str, Any]:
+    """質問の一覧に回答する
+
+    結果は入力と同じ順序で、質問ごとに成功（answer, confidence, sources）か
+    失敗（error）を返す。表記揺れのみ異なる質問は1回だけ処理し、同じ結果を返す。
+    質問数が上限を超える場合は ValueError。
+    """
+    if not isinstance(questions, list):
+        raise ValueError('questions は質問文字列の配列で指定してください')
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        raise ValueError(f'1回のバッチで送信できる質問は{BATCH_MAX_QUESTIONS}件までです')
+
+    concurrency = BATCH_MAX_CONCURRENCY
+    if isinstance(max_concurrency, int) and max_concurrency > 0:
+        concurrency = min(max_concurrency, BATCH_MAX_CONCURRENCY)
+
+    # 正規化した質問ごとに最初に現れた表記で処理する
+    unique_queries: Dict[str, str] = {}
+    normalized_keys: List[str] = []
+    for question in questions:
+        if not isinstance(question, str) or not question.strip():
+            normalized_keys.append(None)
+            continue
+        key = normalize_query(question)
+        unique_queries.setdefault(key, question.strip())
+        normalized_keys.append(key)
+
+    logger.info(f"バッチ処理を開始: {len(questions)}件（重複除外後 {len(unique_queries)}件）, 同時実行数={concurrency}")
+
+    shared = _SharedSubQueries(qa_system, deadline)
+    outcomes: Dict[str, Any] = {}
+    if unique_queries:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(unique_queries)),
+                                thread_name_prefix='kb-batch') as executor:
+            # 処理時間の計測（metrics）をスレッドに引き継ぐため、呼び出し元のコンテキストで実行する
+            futures = {
+                key: executor.submit(contextvars.copy_context().run, _answer, qa_system, query, shared)
+                for key, query in unique_queries.items()
+            }
+            for key, future in futures.items():
+                try:
+                    outcomes[key] = future.result()
+                except Exception as e:
+                    logger.error(f"バッチ内の質問の処理に失敗しました '{unique_queries[key]}': {str(e)}")
+                    outcomes[key] = e
+
+    results = []
+    for question, key in zip(questions, normalized_keys):
+        if key is None:
+            results.append({'question': question, 'success': False, 'error': '質問が空です'})
+            continue
+        outcome = outcomes[key]
+        if isinstance(outcome, Exception):
+            results.append({'question': question, 'success': False, 'error': str(outcome)})
+            continue
+        item = {
+            'question': question,
+            'success': True,
+            'answer': outcome['answer'],
+            'confidence': outcome['confidence'],
+            'sources': outcome['sources']
+        }
+        if outcome.get('degraded'):
+            item.update(degraded=True, degraded_reason=outcome['degraded_reason'])
+        results.append(item)
+
+    logger.info(f"バッチ処理が完了: 成功={sum(1 for r in results if r['success'])}/{len(results)}件, "
+                f"共有したサブクエリ={shared.shared}件")
+    return {
+        'results': results,
+        'total': len(questions),
+        'unique': len(unique_queries)
+    }
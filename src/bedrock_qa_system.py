@@ -1,279 +1,325 @@
 import boto3
 import json
 import os
-from typing import Dict, Any, List
+from typing import Callable, Dict, Any, Iterator, List, Optional, Tuple
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
+import answer_formatter
+import context_packer
+import generation_prompt
+import term_translator
+from keyword_index import load_keyword_index
+from qa_cache import CoalescedCallTimeout, SingleFlight, create_answer_cache, create_retrieval_cache, normalize_query
+from hedging import INVOKE_MODEL_HEDGER
+from metrics import annotate, stage
+from model_router import ModelRouter, Route
+from near_duplicates import relevance, select_diverse
+from resilience import CircuitBreaker, Deadline, RetryPolicy, call_with_retry, create_client_config, retry_delay
+from retrieval_depth import RetrievalDepthController
+from retrieval_fanout import SubQuery, fan_out_retrieve, reciprocal_rank_fusion, retrieve_single, rrf_bonus
 
-# ローカル環境でのみdotenvを読み込み
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except ImportError:
-    # Lambda環境ではdotenvが不要
-    pass
+# ローカル環境でのみdotenvを読み込み（Lambda環境では読み込み自体を省略して起動を速くする）
+if not os.getenv('AWS_LAMBDA_FUNCTION_NAME'):
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+NO_INFORMATION_ANSWER = '申し訳ございませんが、関連する情報が見つかりませんでした。'
+
+# 回答生成に必要な残り時間（秒）。これより短い場合は生成せずに検索結果の抜粋で応答する
+GENERATION_MIN_SECONDS = float(os.getenv('GENERATION_MIN_SECONDS', '3'))
+
 class BedrockKnowledgeBaseQA:
-    def __init__(self):
+    def __init__(self, endpoint_url: Optional[str] = None):
         self.aws_region = os.getenv('AWS_REGION', 'us-east-1')
         self.knowledge_base_id = os.getenv('KNOWLEDGE_BASE_ID')
         self.model_id = os.getenv('BEDROCK_MODEL_ID', 'anthropic.claude-3-5-sonnet-20241022-v2:0')
         
-        # 簡単なクエリキャッシュ（同じ質問の連続実行を防ぐ）
-        self._query_cache = {}
-        self._cache_max_size = 10
+        # 簡単な質問は小さく速いモデル（FAST_MODEL_ID）で生成する
+        self.model_router = ModelRouter(self.model_id)
+        
+        # 主クエリの検索結果の確信度が高い場合は拡張クエリの検索を省く
+        self.retrieval_depth = RetrievalDepthController()
+        
+        # 回答キャッシュ（バックエンドは ANSWER_CACHE_BACKEND で選択、noneで無効）
+        # （Knowledge Baseの同期完了時に検索結果キャッシュとあわせて無効化される）
+        self.answer_cache = create_answer_cache(namespace=f"{self.knowledge_base_id}:{self.model_id}",
+                                                knowledge_base_id=self.knowledge_base_id)
+        
+        # 同じ質問の同時実行を1回にまとめる（回答がキャッシュに載るまでの間の重複呼び出し対策）
+        self._in_flight = SingleFlight()
+        
+        # 回答生成の失敗が続いた場合は一定時間生成を止め、検索結果の抜粋で応答する
+        self.generation_breaker = CircuitBreaker('回答生成')
+        
+        # サブクエリ並列検索用のスレッドプール（同時実行数を制限）
+        self.retrieval_max_workers = int(os.getenv('RETRIEVAL_MAX_WORKERS', '4'))
+        self._retrieval_executor = ThreadPoolExecutor(
+            max_workers=self.retrieval_max_workers,
+            thread_name_prefix='kb-retrieve'
+        )
+        
+        # 検索結果キャッシュ（Knowledge Baseの同期完了時に無効化される）。このクラスの拡張クエリは
+        # 質問ごとの英語翻訳で固定のものがないため、常駐させる検索は RETRIEVAL_CACHE_PINNED_QUERIES で指定する
+        self.retrieval_cache = create_retrieval_cache(self.knowledge_base_id)
+        
+        # 語の完全一致を補うローカルのキーワード索引（索引ファイルがなければ None）
+        self.keyword_index = load_keyword_index()
+        
+        # 接続プール数とタイムアウト（リトライは resilience で行うため botocore のリトライは無効）
+        client_config = create_client_config()
+        
+        # Bedrockのエンドポイント（scripts/local_bedrock_server.py などの代替サーバーを使う場合に指定）
+        self.endpoint_url = endpoint_url or os.getenv('BEDROCK_ENDPOINT_URL') or None
         
         # Lambda環境ではIAMロールを使用、ローカルでは認証情報を使用
         if os.getenv('AWS_LAMBDA_FUNCTION_NAME'):
             # Lambda環境: IAMロールを使用
             self.bedrock_agent_runtime = boto3.client(
                 'bedrock-agent-runtime',
-                region_name=self.aws_region
+                region_name=self.aws_region,
+                endpoint_url=self.endpoint_url,
+                config=client_config
             )
             
             self.bedrock_runtime = boto3.client(
                 'bedrock-runtime',
-                region_name=self.aws_region
+                region_name=self.aws_region,
+                endpoint_url=self.endpoint_url,
+                config=client_config
             )
         else:
             # ローカル環境: 認証情報を使用
             self.aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
             self.aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
             
+            # 代替サーバーは署名を検証しないため、認証情報がなければダミーを使う
+            if self.endpoint_url and not self.aws_access_key_id:
+                self.aws_access_key_id, self.aws_secret_access_key = 'local', 'local'
+            
             self.bedrock_agent_runtime = boto3.client(
                 'bedrock-agent-runtime',
                 aws_access_key_id=self.aws_access_key_id,
                 aws_secret_access_key=self.aws_secret_access_key,
-                region_name=self.aws_region
+                region_name=self.aws_region,
+                endpoint_url=self.endpoint_url,
+                config=client_config
             )
             
             self.bedrock_runtime = boto3.client(
                 'bedrock-runtime',
                 aws_access_key_id=self.aws_access_key_id,
                 aws_secret_access_key=self.aws_secret_access_key,
-                region_name=self.aws_region
+                region_name=self.aws_region,
+                endpoint_url=self.endpoint_url,
+                config=client_config
             )
-    
-    def translate_query_to_english(self, query: str) -> str:
-        """日本語クエリを英語に翻訳"""
-        # 一般的な日本語-英語技術用語マッピング
-        translation_map = {
-            'クローラー': 'crawler',
-            'クローラートリガー': 'crawler trigger',
-            'ウィジェット': 'widget',
-            'ウィジェット設定': 'widget settings',
-            'プロキシ': 'proxy',
-            'プロキシ設定': 'proxy settings',
-            'トリガー': 'trigger',
-            'アクティベーター': 'activator',
-            'アクティベータ': 'activator',
-            'API': 'API',
-            'SDK': 'SDK',
-            'ライブラリ': 'library',
-            'ライブラリー': 'library',
-            'フレームワーク': 'framework',
-            'プラグイン': 'plugin',
-            'コンフィグ': 'config',
-            '設定': 'settings',
-            '機能': 'feature',
-            'ドキュメント': 'documentation',
-            'ドキュメンテーション': 'documentation',
-            'サポート': 'support',
-            'デバッグ': 'debug',
-            'エラー': 'error',
-            'ログ': 'log',
-            'ログイン': 'login',
-            'ユーザー': 'user',
-            'アカウント': 'account',
-            'プロジェクト': 'project',
-            'ダッシュボード': 'dashboard',
-            'レポート': 'report',
-            'レポーティング': 'reporting',
-            'インテグレーション': 'integration',
-            'セットアップ': 'setup',
-            'インストール': 'install',
-            'コンフィギュレーション': 'configuration',
-            'カスタマイズ': 'customize',
-            'カスタマイゼーション': 'customization'
-        }
         
-        # 完全一致での変換
-        if query in translation_map:
-            return translation_map[query]
+        # 小規模なコーパスではローカルのベクトル索引で検索する（retrieve と同じ形で呼び出せる）
+        if os.getenv('RETRIEVAL_ENGINE', 'knowledge_base').lower() == 'local':
+            # NumPy の読み込みに時間がかかるため、使う場合のみ読み込む
+            from vector_index import create_local_retriever
+            local_retriever = create_local_retriever(self.bedrock_runtime)
+            if local_retriever is not None:
+                self.bedrock_agent_runtime = local_retriever
+    
+    def warm_up(self, prime_connections: bool = False) -> None:
+        """初回リクエストで発生する準備処理を先に済ませる（Lambdaのコールドスタート対策）
         
-        # 部分一致での変換（大文字小文字を区別しない）
-        translated_query = query
-        for jp_term, en_term in translation_map.items():
-            if jp_term in query:
-                translated_query = translated_query.replace(jp_term, en_term)
+        prime_connections=True の場合は Knowledge Base を1件だけ検索し、
+        エンドポイントへの接続（TLSハンドシェイク）を確立しておく。
+        """
+        self._build_sub_queries('ウィジェット設定の確認', 3)
+        self.format_answer('## 準備\n\n**確認**しました。- 完了')
         
-        # 英語単語の検出と処理
-        import re
-        # 「Activator」「Widget」などの英語単語を検出
-        english_words = re.findall(r'\b[A-Z][a-z]+(?:[A-Z][a-z]+)*\b', query)
-        for word in english_words:
-            if word.lower() not in translated_query.lower():
-                translated_query += f" {word.lower()}"
+        if prime_connections:
+            try:
+                retrieve_single(self.bedrock_agent_runtime, self.knowledge_base_id, 'warm up', 1,
+                                policy=RetryPolicy(max_attempts=1))
+            except Exception as e:
+                logger.warning(f"接続の事前確立に失敗しました（初回リクエストで再接続します）: {str(e)}")
+    
+    def translate_query_to_english(self, query: str) -> str:
+        """日本語クエリを英語に翻訳（対訳辞書は translation_terms.tsv）"""
+        return term_translator.translate_query_to_english(query)
+
+    def _build_sub_queries(self, query: str, max_results: int) -> List[SubQuery]:
+        """検索に使用するサブクエリ（検索テキスト, 取得件数）の一覧を組み立てる"""
+        # 多言語検索：元のクエリと英語翻訳版の両方で検索
+        # 1. 元のクエリで検索
+        sub_queries = [(query, max_results * 2)]
+        
+        # 2. 英語翻訳版で検索（元のクエリと異なる場合のみ。英語のクエリは翻訳しない）
+        if term_translator.is_english_query(query):
+            english_query = query
+        else:
+            with stage('translate'):
+                english_query = self.translate_query_to_english(query)
+        if english_query != query:
+            logger.info(f"英語翻訳クエリで追加検索: '{query}' → '{english_query}'")
+            sub_queries.append((english_query, max_results * 2))
         
-        return translated_query
+        return sub_queries
 
-    def retrieve_from_knowledge_base(self, query: str, max_results: int = 3) -> List[Dict[str, Any]]:
+    def retrieve_from_knowledge_base(self, query: str, max_results: int = 3,
+                                     deadline: Deadline = None) -> List[Dict[str, Any]]:
         """Knowledge Baseから関連情報を取得（多言語検索対応・重複排除機能付き）"""
-        import time
+        sub_queries = self._build_sub_queries(query, max_results)
+        sub_queries, all_results = self._retrieve_with_depth(
+            query, sub_queries, max_results, lambda issued: self._fan_out(issued, deadline)
+        )
+        all_results = self._fuse_keyword_results(sub_queries, all_results, max_results)
+        with stage('rerank'):
+            return self._rank_results(all_results, max_results)
+    
+    def _retrieve_with_depth(self, query: str, sub_queries: List[SubQuery], max_results: int,
+                             fan_out: Callable[[List[SubQuery]], List[Dict[str, Any]]]
+                             ) -> Tuple[List[SubQuery], List[Dict[str, Any]]]:
+        """サブクエリを fan_out で検索し、検索したサブクエリと結果を返す
+        
+        主クエリを先に検索し、結果の確信度から拡張クエリの検索の要否と取得件数を決める（retrieval_depth）。
+        """
+        stages = self.retrieval_depth.stages(query, sub_queries, max_results, self._rank_results)
+        batch = stages.next_batch([])
+        while batch:
+            batch = stages.next_batch(fan_out(batch))
+        return stages.issued, stages.results
+    
+    def _fan_out(self, sub_queries: List[SubQuery], deadline: Deadline = None) -> List[Dict[str, Any]]:
+        """サブクエリを並列に実行（失敗したサブクエリ以外の結果は保持する）"""
+        with stage('fan_out'):
+            return fan_out_retrieve(
+                self.bedrock_agent_runtime,
+                self.knowledge_base_id,
+                sub_queries,
+                executor=self._retrieval_executor,
+                cache=self.retrieval_cache,
+                deadline=deadline
+            )
+    
+    def _fuse_keyword_results(self, sub_queries: List[SubQuery], vector_results: List[Dict[str, Any]],
+                              max_results: int) -> List[Dict[str, Any]]:
+        """キーワード索引の検索結果をベクトル検索の結果と Reciprocal Rank Fusion で統合する（索引がなければそのまま返す）"""
+        if self.keyword_index is None:
+            return vector_results
+        with stage('keyword_search'):
+            keyword_results = self.keyword_index.search(' '.join(text for text, _ in sub_queries), max_results * 2)
+        if not keyword_results:
+            return vector_results
+        vector_ranking = sorted(vector_results, key=lambda result: result.get('score', 0), reverse=True)
+        return reciprocal_rank_fusion([vector_ranking, keyword_results])
+    
+    def _rank_results(self, all_results: List[Dict[str, Any]], max_results: int) -> List[Dict[str, Any]]:
+        """検索結果の重複（同じ記事・近似重複の本文）を除き、データソースの優先度とスコアで上位max_results件に絞る"""
+        if not all_results:
+            return []
         
-        max_retries = 3
-        retry_delay = 1
+        response = {'retrievalResults': all_results}
         
-        for attempt in range(max_retries):
-            try:
-                # 多言語検索：元のクエリと英語翻訳版の両方で検索
-                all_results = []
-                
-                # 1. 元のクエリで検索
-                response_original = self.bedrock_agent_runtime.retrieve(
-                    knowledgeBaseId=self.knowledge_base_id,
-                    retrievalQuery={
-                        'text': query
-                    },
-                    retrievalConfiguration={
-                        'vectorSearchConfiguration': {
-                            'numberOfResults': max_results * 2
-                        }
-                    }
-                )
-                all_results.extend(response_original.get('retrievalResults', []))
-                
-                # 2. 英語翻訳版で検索（元のクエリと異なる場合のみ）
-                english_query = self.translate_query_to_english(query)
-                if english_query != query:
-                    logger.info(f"英語翻訳クエリで追加検索: '{query}' → '{english_query}'")
-                    response_english = self.bedrock_agent_runtime.retrieve(
-                        knowledgeBaseId=self.knowledge_base_id,
-                        retrievalQuery={
-                            'text': english_query
-                        },
-                        retrievalConfiguration={
-                            'vectorSearchConfiguration': {
-                                'numberOfResults': max_results * 2
-                            }
-                        }
-                    )
-                    all_results.extend(response_english.get('retrievalResults', []))
-                
-                # 結果をマージ
-                response = {'retrievalResults': all_results}
-                
-                results = []
-                seen_content = set()
-                seen_articles = set()
-                
-                # データソース優先順位の定義とスコアボーナス
-                data_source_priority = {
-                    '9JIZ7NR5GM': 1,  # technical-docs (最高優先度)
-                    'BCI4SYCYPF': 2,  # confluence-docs
-                    'VO92FYFPG6': 3   # helppage (最低優先度)
-                }
+        results = []
+        seen_articles = set()
+        
+        # データソース優先順位の定義とスコアボーナス
+        data_source_priority = {
+            '9JIZ7NR5GM': 1,  # technical-docs (最高優先度)
+            'BCI4SYCYPF': 2,  # confluence-docs
+            'VO92FYFPG6': 3   # helppage (最低優先度)
+        }
+        
+        # 技術文書のスコアにボーナスを追加（優先順位を高める）
+        score_bonus = {
+            '9JIZ7NR5GM': 0.15,  # technical-docs に +0.15 ボーナス
+            'BCI4SYCYPF': 0.08,  # confluence に +0.08 ボーナス
+            'VO92FYFPG6': 0.0   # help page はボーナスなし
+        }
+        
+        # 結果をデータソース別に分類
+        results_by_source = {}
+        
+        for result in response.get('retrievalResults', []):
+            content = result.get('content', {}).get('text', '')
+            location = result.get('location', {})
+            uri = location.get('s3Location', {}).get('uri', '')
+            metadata = result.get('metadata', {})
+            data_source_id = metadata.get('x-amz-bedrock-kb-data-source-id', '')
+            
+            # 記事IDを抽出（URLから）
+            article_id = self._extract_article_id(uri)
+            
+            # 同じ記事の重複チェック（本文の近似重複は最終結果の選択時に除く）
+            if article_id not in seen_articles:
+                # スコアにボーナスを追加
+                original_score = result.get('score', 0)
+                bonus = score_bonus.get(data_source_id, 0.0)
+                adjusted_score = original_score + bonus
                 
-                # 技術文書のスコアにボーナスを追加（優先順位を高める）
-                score_bonus = {
-                    '9JIZ7NR5GM': 0.15,  # technical-docs に +0.15 ボーナス
-                    'BCI4SYCYPF': 0.08,  # confluence に +0.08 ボーナス
-                    'VO92FYFPG6': 0.0   # help page はボーナスなし
+                result_item = {
+                    'content': content,
+                    'score': adjusted_score,
+                    'original_score': original_score,
+                    'location': location,
+                    'metadata': metadata,
+                    'article_id': article_id,
+                    'data_source_id': data_source_id,
+                    'priority': data_source_priority.get(data_source_id, 99)
                 }
+                if 'rrf_score' in result:
+                    # キーワード索引と統合した結果は統合後の順位で並べる（score は類似度のまま）。
+                    # ボーナスは rrf_score の尺度に換算し、統合後の値がほぼ同じ結果の並びだけに効かせる
+                    result_item['rrf_score'] = result['rrf_score'] + rrf_bonus(bonus)
                 
-                # 結果をデータソース別に分類
-                results_by_source = {}
-                
-                for result in response.get('retrievalResults', []):
-                    content = result.get('content', {}).get('text', '')
-                    location = result.get('location', {})
-                    uri = location.get('s3Location', {}).get('uri', '')
-                    metadata = result.get('metadata', {})
-                    data_source_id = metadata.get('x-amz-bedrock-kb-data-source-id', '')
-                    
-                    # 記事IDを抽出（URLから）
-                    article_id = self._extract_article_id(uri)
-                    
-                    # コンテンツのハッシュを生成（重複チェック用）
-                    content_hash = hash(content[:500])  # 最初の500文字でハッシュ
-                    
-                    # 重複チェック
-                    if content_hash not in seen_content and article_id not in seen_articles:
-                        # スコアにボーナスを追加
-                        original_score = result.get('score', 0)
-                        bonus = score_bonus.get(data_source_id, 0.0)
-                        adjusted_score = original_score + bonus
-                        
-                        result_item = {
-                            'content': content,
-                            'score': adjusted_score,
-                            'original_score': original_score,
-                            'location': location,
-                            'metadata': metadata,
-                            'article_id': article_id,
-                            'data_source_id': data_source_id,
-                            'priority': data_source_priority.get(data_source_id, 99)
-                        }
-                        
-                        logger.info(f"結果追加: データソース={data_source_id}, 元スコア={original_score:.4f}, 調整後スコア={adjusted_score:.4f}")
-                        
-                        if data_source_id not in results_by_source:
-                            results_by_source[data_source_id] = []
-                        results_by_source[data_source_id].append(result_item)
-                        
-                        seen_content.add(content_hash)
-                        seen_articles.add(article_id)
-                
-                # Technical-docsの結果を上位3位以内に強制表示
-                tech_results = results_by_source.get('9JIZ7NR5GM', [])
-                non_tech_results = []
-                for source_id, source_results in results_by_source.items():
-                    if source_id != '9JIZ7NR5GM':
-                        non_tech_results.extend(source_results)
-                
-                # 各グループをスコア順にソート
-                tech_results = sorted(tech_results, key=lambda x: x['score'], reverse=True)
-                non_tech_results = sorted(non_tech_results, key=lambda x: x['score'], reverse=True)
-                
-                # 最終結果を組み立て
-                final_results = []
+                logger.debug(f"結果追加: データソース={data_source_id}, 元スコア={original_score:.4f}, 調整後スコア={adjusted_score:.4f}")
                 
-                # Technical-docsの結果があれば、上位3位以内に必ず含める
-                if tech_results:
-                    # 最大3つまでのTechnical-docs結果を取得
-                    top_tech = tech_results[:min(3, len(tech_results))]
-                    final_results.extend(top_tech)
-                    logger.info(f"Technical-docs結果を上位に配置: {len(top_tech)}件")
+                if data_source_id not in results_by_source:
+                    results_by_source[data_source_id] = []
+                results_by_source[data_source_id].append(result_item)
                 
-                # 残りの枠をnon-tech結果で埋める
-                remaining_slots = max_results - len(final_results)
-                if remaining_slots > 0:
-                    final_results.extend(non_tech_results[:remaining_slots])
-                
-                # 最終結果
-                results = final_results[:max_results]
-                
-                logger.info(f"データソース別結果数: {[(k, len(v)) for k, v in results_by_source.items()]}")
-                logger.info(f"最終結果 (上位{len(results)}件):")
-                for i, result in enumerate(results):
-                    logger.info(f"  {i+1}. データソース={result['data_source_id']}, 元スコア={result.get('original_score', 0):.4f}, 調整後スコア={result['score']:.4f}")
-                
-                # 最終的に必要な件数に制限
-                results = results[:max_results]
-                
-                return results
-                
-            except Exception as e:
-                logger.error(f"Knowledge Base検索エラー (試行 {attempt + 1}/{max_retries}): {str(e)}")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # 指数バックオフ
-                else:
-                    logger.error("Knowledge Base検索の最大試行回数に達しました")
-                    return []
+                seen_articles.add(article_id)
+        
+        # Technical-docsの結果を上位3位以内に強制表示
+        tech_results = results_by_source.get('9JIZ7NR5GM', [])
+        non_tech_results = []
+        for source_id, source_results in results_by_source.items():
+            if source_id != '9JIZ7NR5GM':
+                non_tech_results.extend(source_results)
+        
+        # 各グループをスコア順にソート
+        tech_results = sorted(tech_results, key=relevance, reverse=True)
+        non_tech_results = sorted(non_tech_results, key=relevance, reverse=True)
+        
+        # 最終結果を組み立て
+        final_results = []
+        
+        # Technical-docsの結果があれば、上位3位以内に必ず含める
+        if tech_results:
+            # 最大3つまでのTechnical-docs結果を取得
+            top_tech = select_diverse(tech_results, min(3, max_results))
+            final_results.extend(top_tech)
+            logger.info(f"Technical-docs結果を上位に配置: {len(top_tech)}件")
+        
+        # 残りの枠をnon-tech結果で埋める（選択済みの結果と近似重複するものは除き、多様性を考慮して選ぶ）
+        remaining_slots = max_results - len(final_results)
+        if remaining_slots > 0:
+            final_results.extend(select_diverse(non_tech_results, remaining_slots, selected=final_results))
+        
+        # 最終結果
+        results = final_results[:max_results]
+        
+        logger.debug(f"データソース別結果数: {[(k, len(v)) for k, v in results_by_source.items()]}")
+        logger.debug(f"最終結果 (上位{len(results)}件):")
+        for i, result in enumerate(results):
+            logger.debug(f"  {i+1}. データソース={result['data_source_id']}, 元スコア={result.get('original_score', 0):.4f}, 調整後スコア={result['score']:.4f}")
+        
+        # 最終的に必要な件数に制限
+        results = results[:max_results]
+        
+        return results
     
     def _extract_article_id(self, uri: str) -> str:
         """URIから記事IDを抽出"""
@@ -289,212 +335,159 @@ class BedrockKnowledgeBaseQA:
         return filename.split('.')[0]
     
     def format_answer(self, answer: str) -> str:
-        """回答を読みやすい形式にフォーマットする"""
+        """回答を読みやすい形式にフォーマットする（変換内容は answer_formatter を参照）"""
         if not answer:
             return answer
             
-        logger.info(f"フォーマット開始: {answer[:50]}")
-        
-        # より精密でバランスの取れた改行処理
-        formatted = answer.strip()
-        
-        # 1. 見出し（## で始まる行）の前後に改行を追加
-        formatted = re.sub(r'(?<!\n)(##\s[^\n]+)', r'\n\n\1\n\n', formatted)
-        
-        # 2. 句点の後に改行を追加（ただし、適切な文脈のみ）
-        # 句点の後に日本語文字、*、#、-が続く場合のみ改行を追加
-        # 数字やアルファベットの後は改行しない（URLや英数字の途中を避ける）
-        formatted = re.sub(r'。\s*(?=[あ-んア-ン一-龯ぁ-ゟ\*\#\-])', '。\n\n', formatted)
-        
-        # 3. 番号付きリスト項目の処理（より精密に）
-        # 番号付きリストの開始の前に改行を追加
-        formatted = re.sub(r'(?<!\n)(\d+\.\s)', r'\n\n\1', formatted)
-        
-        # 4. 箇条書き（- で始まる行）の処理
-        # 箇条書きの開始の前に改行を追加
-        formatted = re.sub(r'(?<!\n)(- [^\n]+)', r'\n\n\1', formatted)
-        
-        # 5. **注意**: や **推奨**: の前後に改行を追加
-        formatted = re.sub(r'(?<!\n)(\*\*(?:注意|推奨|重要)\*\*:)', r'\n\n\1', formatted)
-        
-        # 6. コードブロックの前後に改行を追加
-        formatted = re.sub(r'(?<!\n)(```)', r'\n\n\1', formatted)
-        formatted = re.sub(r'(```)(?!\n)', r'\1\n\n', formatted)
-        
-        # 7. 長い文章の適度な改行（100文字以上で句点がある場合）
-        # 長い段落を適度に分割するが、単語の途中で切らないように注意
-        lines = formatted.split('\n')
-        processed_lines = []
-        for line in lines:
-            if len(line) > 100 and '。' in line:
-                # 句点の位置で改行を検討
-                parts = line.split('。')
-                current_part = ''
-                for i, part in enumerate(parts):
-                    if i < len(parts) - 1:  # 最後の部分以外
-                        current_part += part + '。'
-                        if len(current_part) > 80:  # 適度な長さになったら改行
-                            processed_lines.append(current_part)
-                            current_part = ''
-                    else:
-                        current_part += part
-                if current_part:
-                    processed_lines.append(current_part)
-            else:
-                processed_lines.append(line)
-        formatted = '\n'.join(processed_lines)
+        logger.debug("フォーマット開始: %s", answer[:50])
         
-        # 8. 連続する3つ以上の改行を2つに制限
-        formatted = re.sub(r'\n{3,}', '\n\n', formatted)
+        formatted = answer_formatter.format_answer(answer)
         
-        # 9. 文頭と文末の不要な改行を除去
-        formatted = formatted.strip()
-        
-        # 10. Markdownの太字をHTMLに変換
-        formatted = re.sub(r'\*\*([^*]+)\*\*', r'<strong>\1</strong>', formatted)
-        
-        # 11. Markdownの見出し（## ）をHTMLに変換
-        formatted = re.sub(r'##\s+([^\n]+)', r'<h3>\1</h3>', formatted)
-        
-        # 12. Web表示用に改行コードをHTMLブレークタグに変換
-        formatted = formatted.replace('\n\n', '<br><br>')  # 段落間
-        formatted = formatted.replace('\n', '<br>')        # 単一改行
-        
-        # 13. h3タグの前後の不要な<br>タグを除去
-        formatted = re.sub(r'<br><br><h3>', r'<h3>', formatted)  # 見出し前の改行除去
-        formatted = re.sub(r'</h3><br><br>', r'</h3>', formatted)  # 見出し後の改行除去
-        
-        logger.info(f"フォーマット完了: {formatted[:100]}")
+        logger.debug("フォーマット完了: %s", formatted[:100])
         
         return formatted
     
-    def generate_answer_with_bedrock(self, query: str, retrieved_context: List[Dict[str, Any]]) -> str:
-        """取得したコンテキストを使ってBedrockで回答を生成"""
+    def _build_request_body(self, query: str, retrieved_context: List[Dict[str, Any]],
+                            route: Route = None) -> Dict[str, Any]:
+        """Bedrockモデル呼び出し用のリクエストボディを組み立てる（route を省略した場合は BEDROCK_MODEL_ID）"""
+        route = route or self.model_router.large
+        # 質問に関係する文を優先して CONTEXT_TOKEN_BUDGET トークンまで詰める
+        context_text, packed = context_packer.pack_context(query, retrieved_context)
+        annotate(context_tokens=sum(chunk['tokens'] for chunk in packed),
+                 context_sentences=sum(chunk['sentences'] for chunk in packed))
+        logger.debug("参考情報に入れた文: %s", packed)
+        
+        # 毎回同じ指示は system（プロンプトキャッシュの対象）、参考情報と質問は user メッセージに分ける
+        return generation_prompt.build_request_body(route.model_id, context_text, query, route.max_tokens)
+    
+    def _invoke_model(self, query: str, retrieved_context: List[Dict[str, Any]], route: Route = None) -> str:
+        """Bedrockモデルを1回呼び出して回答テキストを返す（リトライは呼び出し側で行う）"""
+        route = route or self.model_router.large
+        with stage('prompt_build'):
+            body = json.dumps(self._build_request_body(query, retrieved_context, route))
+        
+        def invoke():
+            response = self.bedrock_runtime.invoke_model(
+                body=body,
+                modelId=route.model_id,
+                accept='application/json',
+                contentType='application/json'
+            )
+            return json.loads(response.get('body').read())
+        
+        # 最近の応答時間より大幅に遅い場合はヘッジする（HEDGE_ENABLED=true の場合のみ）
+        with stage('invoke_model'):
+            response_body = INVOKE_MODEL_HEDGER.call(invoke)
+        
+        # Claudeモデルの場合（Messages API）
+        if 'anthropic.claude' in route.model_id:
+            generation_prompt.record_usage(response_body.get('usage', {}))
+            content = response_body.get('content', [])
+            if content and len(content) > 0:
+                return content[0].get('text', '')
+            return ''
+        else:
+            # Titanモデルの場合
+            return response_body.get('results', [{}])[0].get('outputText', '')
+    
+    def generate_answer_with_bedrock(self, query: str, retrieved_context: List[Dict[str, Any]],
+                                     deadline: Deadline = None) -> str:
+        """取得したコンテキストを使ってBedrockで回答を生成
+        
+        スロットリングと一時的な障害のみ、deadline の残り時間の範囲でリトライする。
+        失敗した場合は例外を送出する。結果は generation_breaker に記録する。
+        簡単な質問は小さいモデルで生成し、回答が不十分な場合は大きいモデルで生成し直す。
+        """
+        route, reason = self.model_router.choose(query, retrieved_context)
+        annotate(model_route=route.name, model_route_reason=reason)
+        try:
+            answer = call_with_retry(lambda: self._invoke_model(query, retrieved_context, route), "回答生成", deadline)
+        except Exception as e:
+            self.generation_breaker.record_error(e)
+            raise
+        self.generation_breaker.record_success()
+        
+        if self.model_router.should_escalate(route, reason, answer) and self._generation_skip_reason(deadline) is None:
+            logger.info(f"小さいモデルの回答が不十分なため大きいモデルで生成し直します: {query}")
+            annotate(model_route='escalated')
+            large = self.model_router.large
+            try:
+                answer = call_with_retry(lambda: self._invoke_model(query, retrieved_context, large), "回答生成", deadline)
+            except Exception as e:
+                # 生成し直せなかった場合は小さいモデルの回答を使う
+                logger.warning(f"大きいモデルでの生成に失敗しました（小さいモデルの回答を使います）: {str(e)}")
+        return answer
+    
+    def generate_answer_stream_with_bedrock(self, query: str, retrieved_context: List[Dict[str, Any]],
+                                            deadline: Deadline = None) -> Iterator[str]:
+        """取得したコンテキストを使ってBedrockで回答を生成し、生成されたテキストを逐次返す
+        
+        リトライは最初のテキストを返す前に失敗した場合のみ行う（途中まで返した回答は再生成できないため）。
+        失敗した場合は例外を送出する。結果は generation_breaker に記録する。
+        """
         import time
         
-        max_retries = 3
-        retry_delay = 1
+        # ストリーミングでは途中まで返した回答を生成し直せないため、エスカレーションは行わない
+        route, reason = self.model_router.choose(query, retrieved_context)
+        annotate(model_route=route.name, model_route_reason=reason)
         
-        for attempt in range(max_retries):
+        attempt = 0
+        while True:
+            attempt += 1
+            emitted = False
             try:
-                context_text = "\n\n".join([
-                    f"関連情報 {i+1}:\n{item['content'][:1000]}..." if len(item['content']) > 1000 else f"関連情報 {i+1}:\n{item['content']}" 
-                    for i, item in enumerate(retrieved_context)
-                ])
-                
-                prompt = f"""あなたは多言語化サービスの専門カスタマーサポートAIです。以下の公式ヘルプページ情報を参考にして、ユーザーの質問に正確で詳細な回答を提供してください。
-
-【参考情報】
-{context_text}
-
-【質問】
-{query}
-
-【回答ガイドライン】
-- 必ず日本語で回答する（英語の質問であっても日本語で回答する）
-- 多言語化サービスの機能や設定について正確な情報を提供する
-- 具体的な手順や設定方法がある場合は、ステップバイステップで説明する
-- 技術的な内容も分かりやすく説明する
-- 参考情報に基づいて回答し、推測や憶測は避ける
-- 日本語で自然で読みやすい文章で回答する
-
-【回答形式】
-- 必ず各文章の後に2回改行する（空行を1行入れる）
-- 箇条書きの各項目の後も必ず2回改行する
-- 番号付きリストの各項目の後も必ず2回改行する
-- 見出しは「## 」で始め、見出しの前後に必ず2回改行する
-- 重要なポイントは**太字**で強調する
-- コードブロックは「```」で囲み、前後に必ず2回改行する
-- 注意事項は「**注意**:」で始め、前後に必ず2回改行する
-- 結論や推奨事項は「**推奨**:」で始め、前後に必ず2回改行する
-- 文章が長い場合は適度に改行して読みやすくする
-
-【回答】"""
+                if deadline is not None:
+                    deadline.check("回答生成")
+                body = self._build_request_body(query, retrieved_context, route)
                 
-                # Claudeモデル用のMessages API形式
-                if 'anthropic.claude' in self.model_id:
-                    body = {
-                        "anthropic_version": "bedrock-2023-05-31",
-                        "max_tokens": 1000,
-                        "temperature": 0.3,
-                        "top_p": 0.9,
-                        "messages": [
-                            {
-                                "role": "user",
-                                "content": prompt
-                            }
-                        ]
-                    }
-                else:
-                    # Titanモデル用のリクエスト形式
-                    body = {
-                        "inputText": prompt,
-                        "textGenerationConfig": {
-                            "maxTokenCount": 1000,
-                            "temperature": 0.3,
-                            "topP": 0.9
-                        }
-                    }
-                
-                response = self.bedrock_runtime.invoke_model(
+                response = self.bedrock_runtime.invoke_model_with_response_stream(
                     body=json.dumps(body),
-                    modelId=self.model_id,
+                    modelId=route.model_id,
                     accept='application/json',
                     contentType='application/json'
                 )
                 
-                response_body = json.loads(response.get('body').read())
-                
-                # Claudeモデルの場合（Messages API）
-                if 'anthropic.claude' in self.model_id:
-                    content = response_body.get('content', [])
-                    if content and len(content) > 0:
-                        return content[0].get('text', '')
-                    return ''
-                else:
-                    # Titanモデルの場合
-                    return response_body.get('results', [{}])[0].get('outputText', '')
+                for event in response.get('body'):
+                    chunk = event.get('chunk')
+                    if not chunk:
+                        continue
+                    payload = json.loads(chunk.get('bytes'))
+                    
+                    # Claudeモデルの場合（Messages APIのストリーミングイベント）
+                    if 'anthropic.claude' in route.model_id:
+                        # 使用量は message_start（入力とキャッシュ）と message_delta（出力）で届く
+                        if payload.get('type') == 'message_start':
+                            generation_prompt.record_usage(payload.get('message', {}).get('usage', {}))
+                        elif payload.get('type') == 'message_delta':
+                            generation_prompt.record_usage(payload.get('usage', {}))
+                        if payload.get('type') != 'content_block_delta':
+                            continue
+                        text = payload.get('delta', {}).get('text', '')
+                    else:
+                        # Titanモデルの場合
+                        text = payload.get('outputText', '')
+                    
+                    if text:
+                        emitted = True
+                        yield text
+                self.generation_breaker.record_success()
+                return
                 
             except Exception as e:
-                logger.error(f"回答生成エラー (試行 {attempt + 1}/{max_retries}): {str(e)}")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # 指数バックオフ
-                else:
-                    logger.error("回答生成の最大試行回数に達しました")
-                    return f"回答の生成中にエラーが発生しました: {str(e)}"
+                if emitted:
+                    # 途中まで返した回答はやり直せないため、エラーを通知して終了
+                    logger.error(f"回答生成エラー（ストリーミング中）: {str(e)}")
+                    self.generation_breaker.record_error(e)
+                    raise
+                try:
+                    delay = retry_delay(e, attempt, "回答生成", deadline)
+                except Exception:
+                    self.generation_breaker.record_error(e)
+                    raise
+                time.sleep(delay)
     
-    def ask_question(self, query: str) -> Dict[str, Any]:
-        """質問応答の実行"""
-        logger.info(f"質問を処理中: {query}")
-        
-        # キャッシュ確認
-        query_hash = hash(query.strip().lower())
-        if query_hash in self._query_cache:
-            logger.info("キャッシュから回答を返します")
-            return self._query_cache[query_hash]
-        
-        # Step 1: Knowledge Baseから関連情報を取得
-        retrieved_context = self.retrieve_from_knowledge_base(query)
-        
-        if not retrieved_context:
-            result = {
-                'answer': '申し訳ございませんが、関連する情報が見つかりませんでした。',
-                'sources': [],
-                'confidence': 0
-            }
-            self._add_to_cache(query_hash, result)
-            return result
-        
-        # Step 2: 取得した情報を使って回答を生成
-        raw_answer = self.generate_answer_with_bedrock(query, retrieved_context)
-        
-        # Step 2.5: 回答をフォーマットして読みやすくする
-        answer = self.format_answer(raw_answer)
-        logger.info(f"フォーマット前: {repr(raw_answer[:100])}")
-        logger.info(f"フォーマット後: {repr(answer[:100])}")
-        
-        # Step 3: ソース情報を整理
+    def _build_sources(self, retrieved_context: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """検索結果から回答のソース情報を整理"""
         sources = []
         for item in retrieved_context:
             uri = ''
@@ -516,6 +509,94 @@ class BedrockKnowledgeBaseQA:
                 'uri': uri,
                 'score': item['score']
             })
+        return sources
+    
+    def ask_question(self, query: str, deadline: Deadline = None) -> Dict[str, Any]:
+        """質問応答の実行（deadline を省略した場合は REQUEST_DEADLINE_SECONDS 秒）"""
+        logger.info(f"質問を処理中: {query}")
+        
+        # キャッシュ確認
+        if self.answer_cache is not None:
+            cached_result = self.answer_cache.get(query)
+            if cached_result is not None:
+                logger.info("キャッシュから回答を返します")
+                annotate(cache_hit=True)
+                return cached_result
+        
+        # 同じ質問（正規化後）を処理中なら、この呼び出しの時間予算内で、その結果を待って共有する
+        deadline = deadline or Deadline()
+        try:
+            return self._in_flight.do(normalize_query(query), lambda: self._answer_question(query, deadline), deadline)
+        except CoalescedCallTimeout:
+            return self._degraded_result(query, [], 'deadline')
+    
+    def _answer_question(self, query: str, deadline: Deadline = None) -> Dict[str, Any]:
+        """検索と回答生成を行う（キャッシュ確認済みの質問に対して呼ぶ）"""
+        # Step 1: Knowledge Baseから関連情報を取得
+        retrieved_context = self.retrieve_from_knowledge_base(query, deadline=deadline)
+        
+        if not retrieved_context:
+            return self._no_information_result(query)
+        
+        # Step 2: 取得した情報を使って回答を生成
+        return self._answer_with_context(query, retrieved_context, deadline)
+    
+    def _answer_with_context(self, query: str, retrieved_context: List[Dict[str, Any]],
+                             deadline: Deadline = None) -> Dict[str, Any]:
+        """検索結果を使って回答を生成する（生成できない場合は抜粋による縮退応答を返す）"""
+        reason = self._generation_skip_reason(deadline)
+        if reason is None:
+            try:
+                raw_answer = self.generate_answer_with_bedrock(query, retrieved_context, deadline)
+            except Exception as e:
+                logger.error(f"回答生成の最大試行回数に達しました: {str(e)}")
+                reason = 'generation_failed'
+            else:
+                return self._build_answer_result(query, retrieved_context, raw_answer)
+        return self._degraded_result(query, retrieved_context, reason)
+    
+    def _generation_skip_reason(self, deadline: Deadline = None) -> Optional[str]:
+        """回答生成を行わずに抜粋で応答する理由（生成する場合は None）"""
+        if deadline is not None and deadline.remaining() < GENERATION_MIN_SECONDS:
+            return 'deadline'
+        if not self.generation_breaker.allow():
+            return 'circuit_open'
+        return None
+    
+    def _degraded_result(self, query: str, retrieved_context: List[Dict[str, Any]], reason: str) -> Dict[str, Any]:
+        """検索結果の抜粋による縮退応答（完全な回答ではないためキャッシュしない）"""
+        logger.warning(f"縮退応答を返します（理由: {reason}）: {query}")
+        annotate(degraded_reason=reason)
+        return {
+            'answer': answer_formatter.build_extractive_answer(retrieved_context),
+            'sources': self._build_sources(retrieved_context),
+            'confidence': max([item['score'] for item in retrieved_context], default=0),
+            'retrieved_context': retrieved_context,
+            'degraded': True,
+            'degraded_reason': reason
+        }
+    
+    def _no_information_result(self, query: str) -> Dict[str, Any]:
+        """関連情報が見つからなかった場合の結果（短いTTLでキャッシュ）"""
+        result = {
+            'answer': NO_INFORMATION_ANSWER,
+            'sources': [],
+            'confidence': 0
+        }
+        # 「情報なし」の結果は短いTTLでキャッシュ
+        self._add_to_cache(query, result, negative=True)
+        return result
+    
+    def _build_answer_result(self, query: str, retrieved_context: List[Dict[str, Any]], raw_answer: str) -> Dict[str, Any]:
+        """生成した回答をフォーマットし、ソース情報と合わせた結果をキャッシュして返す"""
+        # Step 2.5: 回答をフォーマットして読みやすくする
+        with stage('format_answer'):
+            answer = self.format_answer(raw_answer)
+        logger.debug("フォーマット前: %r", raw_answer[:100])
+        logger.debug("フォーマット後: %r", answer[:100])
+        
+        # Step 3: ソース情報を整理
+        sources = self._build_sources(retrieved_context)
         
         result = {
             'answer': answer,
@@ -525,16 +606,83 @@ class BedrockKnowledgeBaseQA:
         }
         
         # 結果をキャッシュに保存
-        self._add_to_cache(query_hash, result)
+        self._add_to_cache(query, result)
         
         return result
     
-    def _add_to_cache(self, query_hash: int, result: Dict[str, Any]):
+    def ask_question_stream(self, query: str, deadline: Deadline = None) -> Iterator[Dict[str, Any]]:
+        """質問応答をストリーミングで実行
+        
+        以下のイベントを順に返す:
+        - {'type': 'sources', 'sources': [...], 'confidence': ...}  検索完了時
+        - {'type': 'token', 'text': '...', 'html': '...'}  生成されたテキストと、確定したフォーマット済みHTML断片
+        - {'type': 'done', 'answer': '...', 'html': '...', 'sources': [...], 'confidence': ...}  フォーマット済みの最終回答
+        
+        全イベントの html を連結すると answer と一致する。
+        """
+        logger.info(f"質問を処理中（ストリーミング）: {query}")
+        
+        # キャッシュ確認
+        if self.answer_cache is not None:
+            cached_result = self.answer_cache.get(query)
+            if cached_result is not None:
+                logger.info("キャッシュから回答を返します")
+                yield {'type': 'sources', 'sources': cached_result['sources'], 'confidence': cached_result['confidence']}
+                yield dict(cached_result, type='done', html=cached_result['answer'])
+                return
+        
+        # Step 1: Knowledge Baseから関連情報を取得
+        deadline = deadline or Deadline()
+        retrieved_context = self.retrieve_from_knowledge_base(query, deadline=deadline)
+        
+        if not retrieved_context:
+            result = self._no_information_result(query)
+            yield {'type': 'sources', 'sources': [], 'confidence': 0}
+            yield dict(result, type='done', html=result['answer'])
+            return
+        
+        sources = self._build_sources(retrieved_context)
+        confidence = max([item['score'] for item in retrieved_context])
+        yield {'type': 'sources', 'sources': sources, 'confidence': confidence}
+        
+        # Step 2: 生成されたテキストを逐次フォーマットしながら返す
+        # （テキストを返す前に生成できないと分かった場合は、検索結果の抜粋で応答する）
+        formatter = answer_formatter.IncrementalAnswerFormatter()
+        fragments = []
+        reason = self._generation_skip_reason(deadline)
+        if reason is None:
+            try:
+                for text in self.generate_answer_stream_with_bedrock(query, retrieved_context, deadline):
+                    html = formatter.feed(text)
+                    fragments.append(html)
+                    yield {'type': 'token', 'text': text, 'html': html}
+            except Exception as e:
+                if fragments:
+                    raise
+                logger.error(f"回答生成の最大試行回数に達しました: {str(e)}")
+                reason = 'generation_failed'
+        
+        if reason is not None:
+            result = self._degraded_result(query, retrieved_context, reason)
+            del result['retrieved_context']
+            yield dict(result, type='done', html=result['answer'])
+            return
+        
+        # Step 3: 未確定だった末尾を確定させる
+        html = formatter.finish()
+        fragments.append(html)
+        result = {
+            'answer': ''.join(fragments),
+            'sources': sources,
+            'confidence': confidence
+        }
+        self._add_to_cache(query, result)
+        yield dict(result, type='done', html=html)
+    
+    def _add_to_cache(self, query: str, result: Dict[str, Any], negative: bool = False):
         """キャッシュに結果を追加"""
-        if len(self._query_cache) >= self._cache_max_size:
-            # 最古のエントリを削除
-            oldest_key = next(iter(self._query_cache))
-            del self._query_cache[oldest_key]
+        if self.answer_cache is None:
+            return
         
         # retrieved_contextを除いてキャッシュに保存（メモリ節約）
         cached_result = {
@@ -542,7 +690,7 @@ class BedrockKnowledgeBaseQA:
             'sources': result['sources'],
             'confidence': result['confidence']
         }
-        self._query_cache[query_hash] = cached_result
+        self.answer_cache.set(query, cached_result, negative=negative)
 
 def main():
     # 使用例
@@ -0,0 +1,167 @@
+"""
+回答生成のプロンプトに入れる参考情報の組み立て
+
+検索結果の各チャンクを先頭の一定文字数で切ると、定型文やナビゲーションで枠が埋まり、
+質問に関係する文が切り捨てられることがある。ここではチャンクを文に分け、質問との語の
+重なり（参考情報全体での出現の少ない語ほど重い）と、チャンク内・検索結果内の位置で各文に
+点数を付ける。ほかのチャンクとほぼ同じ文は除き、点数の高い順にトークン数の上限まで詰めた後、
+元の順序に戻して「関連情報 n:」ごとにまとめる。
+
+語の単位はキーワード索引（keyword_index.tokenize）と同じ。質問の英語翻訳の語も使うため、
+英語の文書にも日本語の質問の語が対応する。トークン数は文字種ごとの概算（英数字は4文字、
+それ以外は1文字を1トークン）とする。
+
+文の分割と語の集合は質問によらないため、チャンクの本文ごとにキャッシュする
+（同じ文書は検索結果キャッシュや回答生成のリトライで繰り返し使われる）。
+"""
+
+import math
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple
+
+import term_translator
+from keyword_index import tokenize
+
+# 参考情報のトークン数の上限
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '1500'))
+# これより長い文は分割して扱う（句点のない長い段落への対策）
+SENTENCE_MAX_CHARS = 300
+# ほかの文と語の集合がこの割合以上重なる文は重複として除く
+DUPLICATE_SIMILARITY = 0.8
+# 文の点数の重み（質問との重なりは0〜1、位置の項は先頭ほど大きい）
+POSITION_WEIGHT = 0.15
+RANK_WEIGHT = 0.1
+# 省略した文の位置に入れる記号
+GAP_MARKER = ' … '
+
+SENTENCE_BOUNDARY = re.compile(r'(?<=[。！？!?])|(?<=\.)\s+|\n+')
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（英数字・記号は4文字、日本語などは1文字を1トークンとする）"""
+    # UTF-8 で日本語は3バイトのため、バイト数と文字数の差の半分を日本語の文字数とみなす
+    other_chars = (len(text.encode('utf-8')) - len(text)) // 2
+    return max(1, math.ceil((len(text) - other_chars) / 4 + other_chars))
+
+
+def split_sentences(text: str) -> List[Tuple[int, int]]:
+    """文の範囲（開始位置, 終了位置）の一覧（前後の空白は含めない）"""
+    spans = []
+    start = 0
+    for match in list(SENTENCE_BOUNDARY.finditer(text)) + [None]:
+        end = match.start() if match else len(text)
+        segment = text[start:end]
+        stripped = segment.strip()
+        if stripped:
+            offset = start + segment.index(stripped)
+            for piece in range(0, len(stripped), SENTENCE_MAX_CHARS):
+                spans.append((offset + piece, offset + min(piece + SENTENCE_MAX_CHARS, len(stripped))))
+        if match:
+            start = match.end()
+    return spans
+
+
+@lru_cache(maxsize=1024)
+def _analyze(content: str) -> Tuple[Tuple[int, int, frozenset, int], ...]:
+    """チャンクの各文の（開始位置, 終了位置, 語の集合, トークン数）"""
+    return tuple(
+        (start, end, frozenset(tokenize(content[start:end])), estimate_tokens(content[start:end]))
+        for start, end in split_sentences(content)
+    )
+
+
+def pack_context(query: str, retrieved_context: List[Dict[str, Any]],
+                 token_budget: int = None) -> Tuple[str, List[Dict[str, int]]]:
+    """参考情報のテキストと、チャンクごとに入れた文の記録を返す
+
+    記録は検索結果の順に {'index': 検索結果の位置, 'sentences': 入れた文の数,
+    'total_sentences': 文の数, 'tokens': 入れた文のトークン数} とする（文を入れなかったチャンクも含む）。
+    """
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+
+    # 文ごとの範囲・語の集合・トークン数
+    sentences = []
+    for chunk_index, item in enumerate(retrieved_context):
+        for position, (start, end, terms, tokens) in enumerate(_analyze(item.get('content', ''))):
+            sentences.append({
+                'chunk': chunk_index, 'position': position, 'start': start, 'end': end,
+                'terms': terms, 'tokens': tokens,
+            })
+
+    # 参考情報全体で多くの文に現れる語（「します」など）ほど軽くする
+    document_frequency = Counter(term for sentence in sentences for term in sentence['terms'])
+    weights = {term: math.log(1 + len(sentences) / df) for term, df in document_frequency.items()}
+    query_terms = set(tokenize(query)) | set(tokenize(term_translator.translate_query_to_english(query)))
+    query_terms &= set(weights)
+    query_weight = sum(weights[term] for term in query_terms)
+
+    for sentence in sentences:
+        matched = sum(weights[term] for term in sentence['terms'] & query_terms)
+        relevance = matched / query_weight if query_weight else 0.0
+        sentence['score'] = (relevance + POSITION_WEIGHT / (1 + sentence['position'])
+                             + RANK_WEIGHT / (1 + sentence['chunk']))
+
+    # 点数の高い順に、重複する文を除いて上限まで詰める
+    selected = []
+    seen_terms = set()
+    used_tokens = 0
+    min_tokens = min((sentence['tokens'] for sentence in sentences), default=0)
+    for sentence in sorted(sentences, key=lambda s: s['score'], reverse=True):
+        if used_tokens + min_tokens > token_budget:
+            break
+        if used_tokens + sentence['tokens'] > token_budget or sentence['terms'] in seen_terms:
+            continue
+        if any(_is_near_duplicate(sentence['terms'], other['terms']) for other in selected):
+            continue
+        selected.append(sentence)
+        seen_terms.add(sentence['terms'])
+        used_tokens += sentence['tokens']
+
+    by_chunk: Dict[int, List[Dict[str, Any]]] = {}
+    for sentence in selected:
+        by_chunk.setdefault(sentence['chunk'], []).append(sentence)
+    total_by_chunk = Counter(sentence['chunk'] for sentence in sentences)
+
+    sections = []
+    report = []
+    for chunk_index, item in enumerate(retrieved_context):
+        chosen = sorted(by_chunk.get(chunk_index, []), key=lambda s: s['position'])
+        report.append({
+            'index': chunk_index,
+            'sentences': len(chosen),
+            'total_sentences': total_by_chunk.get(chunk_index, 0),
+            'tokens': sum(sentence['tokens'] for sentence in chosen),
+        })
+        if chosen:
+            text = _join_runs(item.get('content', ''), chosen)
+            sections.append(f"関連情報 {len(sections) + 1}:\n{text}")
+    return "\n\n".join(sections), report
+
+
+def _is_near_duplicate(terms: frozenset, other: frozenset) -> bool:
+    """語の集合の重なり（Jaccard係数）が DUPLICATE_SIMILARITY 以上か（語のない文は重複とみなさない）"""
+    smaller, larger = sorted((len(terms), len(other)))
+    # 集合の大きさの比が閾値未満なら、重なりも閾値に届かない
+    if not smaller or smaller < larger * DUPLICATE_SIMILARITY:
+        return False
+    common = len(terms & other)
+    return common >= DUPLICATE_SIMILARITY * (len(terms) + len(other) - common)
+
+
+def _join_runs(content: str, chosen: List[Dict[str, Any]]) -> str:
+    """連続する文は元のテキストのまま、間を省略した箇所は GAP_MARKER でつなぐ"""
+    runs = []
+    run_start, run_end, last_position = None, None, None
+    for sentence in chosen:
+        if run_start is not None and sentence['position'] == last_position + 1:
+            run_end = sentence['end']
+        else:
+            if run_start is not None:
+                runs.append(content[run_start:run_end])
+            run_start, run_end = sentence['start'], sentence['end']
+        last_position = sentence['position']
+    runs.append(content[run_start:run_end])
+    return GAP_MARKER.join(runs)
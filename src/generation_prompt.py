@@ -0,0 +1,116 @@
+"""
+回答生成のプロンプト
+
+プロンプトは、毎回同じ指示（担当者としての役割・回答ガイドライン・回答形式）と、
+リクエストごとに変わる参考情報と質問に分ける。Claude（Messages API）では指示を system に、
+参考情報と質問を user メッセージに入れ、プロンプトキャッシュに対応するモデルでは system に
+cache_control を付けて、同じ指示の入力処理（prefill）を2回目以降省略させる。
+
+Bedrock のプロンプトキャッシュはキャッシュする部分が一定のトークン数（Claude Sonnet で1,024、
+PROMPT_CACHE_MIN_TOKENS）以上の場合のみ有効になる。現在の SYSTEM_PROMPT は概算で約470トークンで、
+既定のモデル（anthropic.claude-3-5-sonnet-20241022-v2:0）もプロンプトキャッシュに対応していないため、
+既定の設定（PROMPT_CACHE=auto）では cache_control を付けず、キャッシュは働かない。
+対応するモデルに切り替え、毎回同じ指示を PROMPT_CACHE_MIN_TOKENS 以上にした場合にだけ付く。
+使用量の cache_read_input_tokens / cache_creation_input_tokens をリクエストの計測値として記録するため、
+実際にキャッシュされているかはリクエスト要約（EMF）で確認できる。
+"""
+
+import os
+from typing import Any, Dict
+
+from context_packer import estimate_tokens
+from metrics import accumulate
+
+# プロンプトキャッシュ（auto: 対応するモデルのみ / true: Claude では常に付ける / false: 使わない）
+PROMPT_CACHE = os.getenv('PROMPT_CACHE', 'auto').lower()
+# プロンプトキャッシュに対応するモデル（モデルIDまたは推論プロファイルIDに含まれる文字列）
+PROMPT_CACHE_MODELS = ('claude-3-7-sonnet', 'claude-3-5-haiku', 'claude-sonnet-4', 'claude-opus-4')
+# Bedrock がキャッシュする最小のトークン数（これ未満の指示に cache_control を付けても無視される）
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv('PROMPT_CACHE_MIN_TOKENS', '1024'))
+
+SYSTEM_PROMPT = """あなたは多言語化サービスの専門カスタマーサポートAIです。ユーザーのメッセージの【参考情報】（公式ヘルプページ情報）を参考にして、【質問】に正確で詳細な回答を提供してください。
+
+【回答ガイドライン】
+- 必ず日本語で回答する（英語の質問であっても日本語で回答する）
+- 多言語化サービスの機能や設定について正確な情報を提供する
+- 具体的な手順や設定方法がある場合は、ステップバイステップで説明する
+- 技術的な内容も分かりやすく説明する
+- 参考情報に基づいて回答し、推測や憶測は避ける
+- 日本語で自然で読みやすい文章で回答する
+
+【回答形式】
+- 必ず各文章の後に2回改行する（空行を1行入れる）
+- 箇条書きの各項目の後も必ず2回改行する
+- 番号付きリストの各項目の後も必ず2回改行する
+- 見出しは「## 」で始め、見出しの前後に必ず2回改行する
+- 重要なポイントは**太字**で強調する
+- コードブロックは「```」で囲み、前後に必ず2回改行する
+- 注意事項は「**注意**:」で始め、前後に必ず2回改行する
+- 結論や推奨事項は「**推奨**:」で始め、前後に必ず2回改行する
+- 文章が長い場合は適度に改行して読みやすくする"""
+
+# 使用量のキーと、計測値として記録する名前
+USAGE_KEYS = {
+    'input_tokens': 'input_tokens',
+    'output_tokens': 'output_tokens',
+    'cache_read_input_tokens': 'cache_read_input_tokens',
+    'cache_creation_input_tokens': 'cache_write_input_tokens',
+}
+
+
+def build_user_prompt(context_text: str, query: str) -> str:
+    """リクエストごとに変わる部分（参考情報と質問）"""
+    return f"""【参考情報】
+{context_text}
+
+【質問】
+{query}"""
+
+
+def supports_prompt_cache(model_id: str) -> bool:
+    """system に cache_control を付けるか（auto では対応するモデルで、指示がキャッシュされる長さの場合のみ）"""
+    if PROMPT_CACHE == 'false' or 'anthropic.claude' not in model_id:
+        return False
+    if PROMPT_CACHE == 'true':
+        return True
+    return (any(name in model_id for name in PROMPT_CACHE_MODELS)
+            and estimate_tokens(SYSTEM_PROMPT) >= PROMPT_CACHE_MIN_TOKENS)
+
+
+def build_request_body(model_id: str, context_text: str, query: str, max_tokens: int = 1000) -> Dict[str, Any]:
+    """Bedrockモデル呼び出し用のリクエストボディ"""
+    user_prompt = build_user_prompt(context_text, query)
+
+    # Claudeモデル用のMessages API形式
+    if 'anthropic.claude' in model_id:
+        system_block: Dict[str, Any] = {"type": "text", "text": SYSTEM_PROMPT}
+        if supports_prompt_cache(model_id):
+            system_block["cache_control"] = {"type": "ephemeral"}
+        return {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens,
+            "temperature": 0.3,
+            "top_p": 0.9,
+            "system": [system_block],
+            "messages": [
+                {
+                    "role": "user",
+                    "content": user_prompt
+                }
+            ]
+        }
+
+    # Titanモデル用のリクエスト形式（system がないため指示を先頭に付ける）
+    return {
+        "inputText": f"{SYSTEM_PROMPT}\n\n{user_prompt}\n\n【回答】",
+        "textGenerationConfig": {
+            "maxTokenCount": max_tokens,
+            "temperature": 0.3,
+            "topP": 0.9
+        }
+    }
+
+
+def record_usage(usage: Dict[str, Any]) -> None:
+    """Claude の使用量（入出力とプロンプトキャッシュの読み書きのトークン数）を計測中のリクエストに加算する"""
+    accumulate(**{name: usage[key] for key, name in USAGE_KEYS.items() if usage.get(key)})
@@ -0,0 +1,200 @@
+"""
+Bedrock呼び出しのヘッジ（テールレイテンシ対策）
+
+呼び出しが最近の応答時間の指定パーセンタイル（既定はp95）を過ぎても返らない場合に、
+同じ呼び出しをもう1つ発行し、先に成功した方の結果を使う。中央値付近の呼び出しは
+ヘッジ前に終わるため、増えるのは遅い呼び出しの分だけになる。
+
+負荷を増やしすぎないよう、呼び出しの種類（retrieve / invoke_model）ごとに
+予算（通常の呼び出し数に対するヘッジの割合）を設け、スロットリングを検知した後は
+一定時間ヘッジを止める。先に発行した呼び出しは取り消せないため、負けた方も最後まで実行される。
+
+HEDGE_ENABLED=true の場合のみ有効（既定は無効で、呼び出しをそのまま実行する）。
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from resilience import is_throttling
+
+logger = logging.getLogger(__name__)
+
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'false').lower() == 'true'
+# パーセンタイルを計算するまでに必要な応答時間のサンプル数
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+# スロットリングを検知してからヘッジを止めておく時間（秒）
+HEDGE_THROTTLE_COOLDOWN = float(os.getenv('HEDGE_THROTTLE_COOLDOWN', '30'))
+# ヘッジした呼び出しを実行するスレッド数
+HEDGE_MAX_WORKERS = int(os.getenv('HEDGE_MAX_WORKERS', '16'))
+
+
+class LatencyTracker:
+    """直近の応答時間（秒）を保持し、パーセンタイルを返す"""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """直近の応答時間の percentile パーセンタイル（サンプルがなければ None）"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(int(len(samples) * percentile / 100), len(samples) - 1)
+        return samples[index]
+
+
+class Hedger:
+    """1種類の呼び出しのヘッジ（発行の判断と予算・統計の管理）
+
+    通常の呼び出し1回ごとに budget_ratio 分の予算が貯まり（上限は burst）、
+    ヘッジを1回発行するごとに1消費する。ヘッジの発行数は長期的に
+    通常の呼び出し数の budget_ratio 倍を超えない。
+    """
+
+    def __init__(self, name: str, percentile: float = 95, budget_ratio: float = 0.1, burst: float = 5,
+                 enabled: bool = None, min_samples: int = None, throttle_cooldown: float = None,
+                 min_delay: float = 0.01):
+        self.name = name
+        self.percentile = percentile
+        self.budget_ratio = budget_ratio
+        self.burst = burst
+        self.enabled = HEDGE_ENABLED if enabled is None else enabled
+        self.min_samples = HEDGE_MIN_SAMPLES if min_samples is None else min_samples
+        self.throttle_cooldown = HEDGE_THROTTLE_COOLDOWN if throttle_cooldown is None else throttle_cooldown
+        self.min_delay = min_delay
+        self.latency = LatencyTracker()
+
+        self._tokens = 0.0
+        self._throttled_until = 0.0
+        self._lock = threading.Lock()
+        self._counters = {'calls': 0, 'hedged': 0, 'hedge_wins': 0, 'budget_denied': 0, 'throttle_suspended': 0}
+
+    def call(self, func: Callable[[], Any]) -> Any:
+        """func を実行し、遅い場合はヘッジして先に成功した結果を返す"""
+        if not self.enabled:
+            return func()
+
+        with self._lock:
+            self._counters['calls'] += 1
+            self._tokens = min(self._tokens + self.budget_ratio, self.burst)
+
+        delay = self._hedge_delay()
+        if delay is None:
+            return self._timed(func)[0]
+
+        executor = _get_executor()
+        primary = executor.submit(self._timed, func)
+        try:
+            return primary.result(timeout=delay)[0]
+        except TimeoutError:
+            pass
+
+        if not self._take_budget():
+            return primary.result()[0]
+
+        logger.info(f"{self.name} が {delay:.3f}秒（p{self.percentile:g}）を超えたためヘッジします")
+        hedge = executor.submit(self._timed, func)
+        pending = {primary, hedge}
+        first_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()[0]
+                except Exception as e:
+                    first_error = first_error or e
+                    continue
+                if future is hedge:
+                    self._count('hedge_wins')
+                return result
+        raise first_error
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._counters)
+        stats['enabled'] = self.enabled
+        stats['samples'] = len(self.latency)
+        stats['hedge_delay'] = self._hedge_delay()
+        return stats
+
+    def _hedge_delay(self) -> Optional[float]:
+        """ヘッジするまでの待ち時間（ヘッジしない場合は None）"""
+        if self.budget_ratio <= 0 or len(self.latency) < self.min_samples:
+            return None
+        if time.monotonic() < self._throttled_until:
+            return None
+        return max(self.latency.percentile(self.percentile), self.min_delay)
+
+    def _take_budget(self) -> bool:
+        with self._lock:
+            if time.monotonic() < self._throttled_until:
+                self._counters['throttle_suspended'] += 1
+                return False
+            if self._tokens < 1:
+                self._counters['budget_denied'] += 1
+                return False
+            self._tokens -= 1
+            self._counters['hedged'] += 1
+            return True
+
+    def _timed(self, func: Callable[[], Any]) -> Tuple[Any, float]:
+        """func を実行して応答時間を記録する（スロットリングを検知したらヘッジを止める）"""
+        start = time.monotonic()
+        try:
+            result = func()
+        except Exception as e:
+            if is_throttling(e):
+                with self._lock:
+                    self._throttled_until = time.monotonic() + self.throttle_cooldown
+            raise
+        elapsed = time.monotonic() - start
+        self.latency.record(elapsed)
+        return result, elapsed
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """ヘッジ用のスレッドプール（最初にヘッジする時に作成）"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix='kb-hedge')
+        return _executor
+
+
+RETRIEVE_HEDGER = Hedger(
+    'retrieve',
+    percentile=float(os.getenv('HEDGE_RETRIEVE_PERCENTILE', '95')),
+    budget_ratio=float(os.getenv('HEDGE_RETRIEVE_BUDGET', '0.1'))
+)
+INVOKE_MODEL_HEDGER = Hedger(
+    'invoke_model',
+    percentile=float(os.getenv('HEDGE_INVOKE_MODEL_PERCENTILE', '95')),
+    budget_ratio=float(os.getenv('HEDGE_INVOKE_MODEL_BUDGET', '0.05'))
+)
+
+
+def hedge_stats() -> Dict[str, Dict[str, Any]]:
+    """呼び出しの種類ごとのヘッジの統計"""
+    return {hedger.name: hedger.stats() for hedger in (RETRIEVE_HEDGER, INVOKE_MODEL_HEDGER)}
@@ -0,0 +1,241 @@
+"""
+クロール済みヘルプページのキーワード索引（BM25）
+
+Knowledge Base のベクトル検索は意味の近さには強いが、製品名やエラーメッセージなどの
+語の完全一致を取りこぼすことがある。scripts/build_keyword_index.py が crawled_html/ の
+HTMLからタグを除いた本文をチャンクに分けて索引ファイルを作り、実行時はこのモジュールで
+プロセス内検索する。検索結果は retrieve API と同じ形式で返し、retrieval_fanout の
+reciprocal_rank_fusion でベクトル検索の結果と統合する。
+
+語の単位は、英数字は単語、日本語（ひらがな・カタカナ・漢字）は2文字ずつ（bigram）。
+転置リストは文書番号（uint32）と出現回数（uint16）の配列として保持する。
+
+索引ファイルの形式:
+    MAGIC, ヘッダー長（uint32）, ヘッダー（JSON: 文書・語ごとの転置リストの位置と文書頻度）,
+    文書番号の配列, 出現回数の配列, 文書長の配列（いずれもリトルエンディアン）
+"""
+
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import struct
+import sys
+import unicodedata
+from array import array
+from collections import Counter
+from html.parser import HTMLParser
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'KWIDX1\n'
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keyword_index.bin')
+
+# BM25 のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+# チャンクの目安の長さ（文字数）
+DEFAULT_CHUNK_CHARS = 800
+
+WORD_PATTERN = re.compile(r'[a-z0-9_]+')
+CJK_RUN_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff]+')
+# 本文として扱わない要素
+SKIPPED_TAGS = frozenset(['script', 'style', 'noscript', 'nav', 'header', 'footer', 'svg', 'template'])
+BLOCK_TAGS = frozenset(['p', 'div', 'br', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article',
+                        'pre', 'table', 'ul', 'ol', 'dd', 'dt', 'title'])
+
+
+def tokenize(text: str) -> List[str]:
+    """検索語の一覧（英数字は単語、日本語は2文字ずつ。1文字だけの日本語はそのまま）"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    tokens = WORD_PATTERN.findall(text)
+    for run in CJK_RUN_PATTERN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class _TextExtractor(HTMLParser):
+    """HTMLから本文のテキストを取り出す（ナビゲーションやスクリプトは除く）"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+
+
+def html_to_text(html: str) -> str:
+    """HTMLのタグを除いた本文（段落ごとに改行、連続する空白は1つにまとめる）"""
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    lines = (' '.join(line.split()) for line in ''.join(extractor.parts).split('\n'))
+    return '\n'.join(line for line in lines if line)
+
+
+def split_chunks(text: str, chunk_chars: int = DEFAULT_CHUNK_CHARS) -> List[str]:
+    """段落の区切りで chunk_chars 文字程度のチャンクに分ける（長すぎる段落はそのまま分割する）"""
+    chunks = []
+    current = ''
+    for line in text.split('\n'):
+        while len(line) > chunk_chars:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(line[:chunk_chars])
+            line = line[chunk_chars:]
+        if current and len(current) + len(line) + 1 > chunk_chars:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class KeywordIndex:
+    """文書（チャンク）の BM25 索引"""
+
+    def __init__(self, documents: List[Dict[str, Any]], terms: Dict[str, List[int]],
+                 doc_ids: array, term_freqs: array, doc_lengths: array):
+        self.documents = documents
+        self.terms = terms  # 語 -> [転置リストの開始位置, 文書頻度]
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        average_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 1.0
+        # 文書長による正規化の項（検索のたびに計算しないよう先に求めておく）
+        self._length_norms = [BM25_K1 * (1 - BM25_B + BM25_B * length / average_length) for length in doc_lengths]
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    @classmethod
+    def build(cls, documents: Iterable[Dict[str, Any]]) -> 'KeywordIndex':
+        """文書（uri / data_source_id / text）の一覧から索引を作る"""
+        documents = list(documents)
+        postings: Dict[str, List[tuple]] = {}
+        doc_lengths = array('I')
+        for doc_id, doc in enumerate(documents):
+            tokens = tokenize(doc['text'])
+            doc_lengths.append(len(tokens))
+            for term, count in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc_id, min(count, 0xffff)))
+
+        terms = {}
+        doc_ids = array('I')
+        term_freqs = array('H')
+        for term in sorted(postings):
+            terms[term] = [len(doc_ids), len(postings[term])]
+            for doc_id, count in postings[term]:
+                doc_ids.append(doc_id)
+                term_freqs.append(count)
+        return cls(documents, terms, doc_ids, term_freqs, doc_lengths)
+
+    def save(self, path: str) -> None:
+        header = json.dumps({'documents': self.documents, 'terms': self.terms},
+                            ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            for values in (self.doc_ids, self.term_freqs, self.doc_lengths):
+                f.write(_to_little_endian(values).tobytes())
+
+    @classmethod
+    def load(cls, path: str) -> 'KeywordIndex':
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            raise ValueError(f"キーワード索引の形式が正しくありません: {path}")
+        offset = len(MAGIC)
+        (header_length,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+        header = json.loads(data[offset:offset + header_length])
+        offset += header_length
+
+        postings_count = sum(df for _, df in header['terms'].values())
+        arrays = []
+        for typecode, count in (('I', postings_count), ('H', postings_count), ('I', len(header['documents']))):
+            values = array(typecode)
+            end = offset + count * values.itemsize
+            values.frombytes(data[offset:end])
+            arrays.append(_to_little_endian(values))
+            offset = end
+        return cls(header['documents'], header['terms'], *arrays)
+
+    def search(self, query: str, number_of_results: int) -> List[Dict[str, Any]]:
+        """BM25 スコアの高い順に文書を返す（retrieve API の retrievalResults と同じ形式）"""
+        scores: Dict[int, float] = {}
+        total = len(self.documents)
+        doc_ids, term_freqs, norms = self.doc_ids, self.term_freqs, self._length_norms
+        for term, query_count in Counter(tokenize(query)).items():
+            entry = self.terms.get(term)
+            if entry is None:
+                continue
+            start, df = entry
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5)) * query_count
+            for doc_id, tf in zip(doc_ids[start:start + df], term_freqs[start:start + df]):
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norms[doc_id])
+
+        top = heapq.nlargest(number_of_results, scores.items(), key=lambda item: item[1])
+        return [self._result(doc_id, score) for doc_id, score in top]
+
+    def _result(self, doc_id: int, score: float) -> Dict[str, Any]:
+        doc = self.documents[doc_id]
+        return {
+            'content': {'text': doc['text']},
+            'location': {'type': 'S3', 's3Location': {'uri': doc['uri']}},
+            'score': score,
+            'metadata': {
+                'x-amz-bedrock-kb-source-uri': doc['uri'],
+                'x-amz-bedrock-kb-data-source-id': doc.get('data_source_id', ''),
+            },
+        }
+
+
+def _to_little_endian(values: array) -> array:
+    """索引ファイルはリトルエンディアンで保存する（ビッグエンディアン環境では並びを入れ替える）"""
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+def load_keyword_index(path: Optional[str] = None) -> Optional[KeywordIndex]:
+    """KEYWORD_INDEX_PATH（既定はこのモジュールと同じディレクトリの keyword_index.bin）の索引を読み込む
+
+    索引ファイルがない場合や KEYWORD_INDEX_PATH=none の場合は None を返す（キーワード検索を行わない）。
+    """
+    path = path or os.getenv('KEYWORD_INDEX_PATH', DEFAULT_INDEX_PATH)
+    if path.lower() == 'none' or not os.path.exists(path):
+        return None
+    try:
+        index = KeywordIndex.load(path)
+    except Exception as e:
+        logger.error(f"キーワード索引の読み込みに失敗しました（キーワード検索を行いません）: {str(e)}")
+        return None
+    logger.info(f"キーワード索引を読み込みました: {path}（{len(index)}チャンク, {len(index.terms)}語）")
+    return index
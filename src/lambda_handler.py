@@ -5,9 +5,12 @@ AWS Lambda Handler for Bedrock Knowledge Base Q&A API
 
 import json
 import logging
+import os
 import traceback
 from typing import Dict, Any
 from bedrock_qa_system import BedrockKnowledgeBaseQA
+from metrics import RequestMetrics, stage
+from resilience import Deadline
 
 # ログ設定
 logging.basicConfig(level=logging.INFO)
@@ -27,6 +30,21 @@ def initialize_qa_system():
             logger.error(f"Q&Aシステムの初期化に失敗: {e}")
             raise
 
+def is_warmup_event(event: Dict[str, Any]) -> bool:
+    """EventBridgeのスケジュール実行、または {"warmup": true} によるウォームアップ呼び出しか"""
+    return event.get('warmup') is True or (
+        event.get('source') == 'aws.events' and event.get('detail-type') == 'Scheduled Event'
+    )
+
+def initialize_on_cold_start():
+    """Lambda の INIT フェーズで初期化（初回リクエストでクライアント生成や準備処理を待たせない）"""
+    try:
+        initialize_qa_system()
+        qa_system.warm_up(prime_connections=os.getenv('WARMUP_PRIME_CONNECTIONS', 'false').lower() == 'true')
+    except Exception:
+        # 失敗した場合は最初のリクエストで改めて初期化する
+        pass
+
 def create_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
     """API Gateway用のレスポンス形式を作成"""
     return {
@@ -55,7 +73,11 @@ def create_error_response(status_code: int, error_message: str, detail: str = No
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """Lambda関数のメインハンドラー"""
     
-    logger.info(f"Lambda関数が呼び出されました: {event}")
+    # ウォームアップ呼び出しは実行環境を維持するためだけのものなので、すぐに返す
+    if is_warmup_event(event):
+        return {'statusCode': 200, 'body': '{"warmup": true}'}
+    
+    logger.debug(f"Lambda関数が呼び出されました: {event}")
     
     try:
         # Q&Aシステムの初期化
@@ -81,6 +103,10 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         except json.JSONDecodeError:
             return create_error_response(400, '無効なJSON形式です')
         
+        # 複数の質問（{"questions": [...]}）はバッチとして処理
+        if 'questions' in body:
+            return handle_batch(body, Deadline.from_lambda_context(context))
+        
         # 質問の取得
         question = body.get('question', '').strip()
         if not question:
@@ -93,25 +119,39 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         logger.info(f"質問を受信: {question}")
         
-        # Q&Aシステムで回答を生成
+        # Q&Aシステムで回答を生成（各段の処理時間を計測し、EMFと要約ログに出力する）
         logger.info(f"質問処理を開始: {question}")
-        result = qa_system.ask_question(question)
-        
-        if not result or not result.get('answer'):
-            logger.error("回答生成に失敗しました")
-            return create_error_response(500, '回答の生成に失敗しました')
-        
-        # 成功レスポンスを作成
-        response_body = {
-            'success': True,
-            'answer': result['answer'],
-            'confidence': result['confidence'],
-            'sources': result['sources']
-        }
+        request_metrics = RequestMetrics()
+        with request_metrics.activate():
+            result = qa_system.ask_question(question, deadline=Deadline.from_lambda_context(context))
+            
+            if not result or not result.get('answer'):
+                logger.error("回答生成に失敗しました")
+                return create_error_response(500, '回答の生成に失敗しました')
+            
+            # 成功レスポンスを作成
+            response_body = {
+                'success': True,
+                'answer': result['answer'],
+                'confidence': result['confidence'],
+                'sources': result['sources']
+            }
+            if result.get('degraded'):
+                # 回答を生成できず、検索結果の抜粋で応答した場合
+                response_body.update(degraded=True, degraded_reason=result['degraded_reason'])
+            if body.get('debug') is True:
+                # {"debug": true} の場合は各段の処理時間とキャッシュヒットの有無を返す
+                response_body['timings'] = request_metrics.timings()
+                response_body['cache_hit'] = request_metrics.cache_hit
+            
+            logger.info(f"回答を生成: 信頼度={result['confidence']:.3f}, ソース数={len(result['sources'])}")
+            
+            with stage('serialize'):
+                response = create_response(200, response_body)
         
-        logger.info(f"回答を生成: 信頼度={result['confidence']:.3f}, ソース数={len(result['sources'])}")
-        
-        return create_response(200, response_body)
+        request_metrics.properties['sources'] = len(result['sources'])
+        request_metrics.emit()
+        return response
         
     except Exception as e:
         logger.error(f"Lambda実行中にエラーが発生: {e}")
@@ -119,6 +159,31 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         return create_error_response(500, 'サーバー内部エラー', str(e))
 
+def handle_batch(body: Dict[str, Any], deadline: Deadline = None) -> Dict[str, Any]:
+    """複数の質問をまとめて処理（質問ごとの結果とエラーを返す）"""
+    # バッチ処理は通常の質問では使わないため、必要になった時点で読み込む
+    from batch_qa import ask_questions_batch
+    
+    request_metrics = RequestMetrics('batch')
+    with request_metrics.activate():
+        try:
+            batch = ask_questions_batch(qa_system, body['questions'], body.get('max_concurrency'), deadline=deadline)
+        except ValueError as e:
+            return create_error_response(400, str(e))
+        
+        response_body = dict(batch, success=True)
+        if body.get('debug') is True:
+            response_body['timings'] = request_metrics.timings()
+        with stage('serialize'):
+            response = create_response(200, response_body)
+    
+    request_metrics.properties.update(questions=batch['total'], unique=batch['unique'])
+    request_metrics.emit()
+    return response
+
+if os.getenv('AWS_LAMBDA_FUNCTION_NAME'):
+    initialize_on_cold_start()
+
 # ローカルテスト用
 if __name__ == "__main__":
     # テスト用のイベントデータ
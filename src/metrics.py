@@ -0,0 +1,160 @@
+"""
+リクエスト単位の処理時間の計測
+
+lambda_handler はリクエストごとに RequestMetrics を作り、activate() の間に実行された
+各段（翻訳・サブクエリ検索・重複排除と並べ替え・プロンプト組み立て・invoke_model・
+フォーマット・シリアライズ）の処理時間を stage() で記録する。計測中のリクエストは
+ContextVar で参照するため、各段の関数に引数を追加する必要はない（スレッドプールで
+実行する処理には contextvars.copy_context() で引き継ぐ）。計測中でなければ stage() は何もしない。
+
+emit() は CloudWatch Embedded Metric Format（EMF）のレコードを標準出力に書き出し、
+リクエストごとの要約を1行の構造化ログとして出力する。
+"""
+
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# EMF の名前空間と出力の有無（既定ではLambda環境でのみ出力）
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'BedrockKnowledgeBaseQA')
+METRICS_EMF_ENABLED = os.getenv(
+    'METRICS_EMF_ENABLED', 'true' if os.getenv('AWS_LAMBDA_FUNCTION_NAME') else 'false'
+).lower() == 'true'
+
+# プロパティのうち、EMF でメトリクス（単位 Count）としても出力するもの
+COUNT_METRICS = ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_write_input_tokens')
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """1リクエストの段ごとの処理時間（ミリ秒）と属性"""
+
+    def __init__(self, operation: str = 'ask'):
+        self.operation = operation
+        self.cache_hit = False
+        self.fan_out = 0
+        self.model_route: Optional[str] = None
+        self.properties: Dict[str, Any] = {}
+        self._stages: Dict[str, List[float]] = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self) -> Iterator['RequestMetrics']:
+        """この間に実行された stage() をこのリクエストに記録する"""
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def record(self, name: str, milliseconds: float) -> None:
+        with self._lock:
+            self._stages.setdefault(name, []).append(milliseconds)
+
+    def timings(self) -> Dict[str, Any]:
+        """段ごとの合計時間（同じ段を複数回実行した場合は回数と最大値も）"""
+        with self._lock:
+            stages = {name: list(values) for name, values in self._stages.items()}
+        timings: Dict[str, Any] = {}
+        for name, values in stages.items():
+            timings[f'{name}_ms'] = round(sum(values), 2)
+            if len(values) > 1:
+                timings[f'{name}_count'] = len(values)
+                timings[f'{name}_max_ms'] = round(max(values), 2)
+        timings['total_ms'] = round(self.elapsed_ms(), 2)
+        return timings
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._start) * 1000
+
+    def to_emf(self) -> Dict[str, Any]:
+        """CloudWatch Embedded Metric Format のレコード"""
+        with self._lock:
+            stages = {name: [round(v, 2) for v in values] for name, values in self._stages.items()}
+        counts = [name for name in COUNT_METRICS if name in self.properties]
+        dimensions = [['Operation', 'CacheHit', 'FanOut']]
+        if self.model_route:
+            # 回答生成のモデルの振り分け先ごとの処理時間とトークン数
+            dimensions.append(['Operation', 'ModelRoute'])
+        record: Dict[str, Any] = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': dimensions,
+                    'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in list(stages) + ['total']]
+                               + [{'Name': name, 'Unit': 'Count'} for name in counts]
+                }]
+            },
+            'Operation': self.operation,
+            'CacheHit': str(self.cache_hit).lower(),
+            'FanOut': str(self.fan_out),
+            'total': round(self.elapsed_ms(), 2),
+        }
+        if self.model_route:
+            record['ModelRoute'] = self.model_route
+        # 複数回実行した段（サブクエリ検索など）は値の配列として出力する
+        for name, values in stages.items():
+            record[name] = values if len(values) > 1 else values[0]
+        record.update(self.properties)
+        return record
+
+    def emit(self) -> None:
+        """EMF レコードと要約ログを出力する"""
+        if METRICS_EMF_ENABLED:
+            # Lambda のログ形式の接頭辞が付かないよう、ロガーを通さずに1行のJSONとして書き出す
+            print(json.dumps(self.to_emf(), ensure_ascii=False), flush=True)
+        summary = dict(self.properties, operation=self.operation, cache_hit=self.cache_hit, fan_out=self.fan_out,
+                       model_route=self.model_route)
+        summary.update(self.timings())
+        logger.info("リクエスト要約 %s", json.dumps(summary, ensure_ascii=False))
+
+
+def current() -> Optional[RequestMetrics]:
+    """計測中のリクエスト（計測していなければ None）"""
+    return _current.get()
+
+
+def annotate(**values: Any) -> None:
+    """計測中のリクエストに属性を記録する（cache_hit・fan_out・model_route はディメンション、それ以外はプロパティ）"""
+    metrics = _current.get()
+    if metrics is None:
+        return
+    for name, value in values.items():
+        if name in ('cache_hit', 'fan_out', 'model_route'):
+            setattr(metrics, name, value)
+        else:
+            metrics.properties[name] = value
+
+
+def accumulate(**values: Any) -> None:
+    """計測中のリクエストのプロパティに値を加算する（リクエスト内で複数回呼ぶ回答生成のトークン数など）"""
+    metrics = _current.get()
+    if metrics is None:
+        return
+    with metrics._lock:
+        for name, value in values.items():
+            metrics.properties[name] = metrics.properties.get(name, 0) + value
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """with ブロックの処理時間を計測中のリクエストの name 段として記録する"""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.record(name, (time.perf_counter() - start) * 1000)
@@ -0,0 +1,97 @@
+"""
+回答生成に使うモデルの振り分け
+
+あいさつや、検索結果の1件が明らかに合っている短い質問は、小さく速いモデル（FAST_MODEL_ID）で
+出力トークン数の上限も下げて生成する。比較・原因調査などの質問、長い質問、検索結果のスコアが
+低い・拮抗している質問は BEDROCK_MODEL_ID（大きいモデル）で生成する。判定はプロセス内で
+質問の長さ・意図を表す語・検索結果のスコアの分布から行い、モデルは呼び出さない。
+
+小さいモデルの回答が短すぎる・情報がないと答えている場合は、大きいモデルで生成し直す（エスカレーション）。
+振り分け先は計測値の model_route（fast / large / escalated）として記録し、EMF では
+ModelRoute ごとの処理時間とトークン数として集計できる。
+"""
+
+import os
+import re
+import unicodedata
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+# 振り分けの有無と小さいモデルの設定
+MODEL_ROUTING_ENABLED = os.getenv('MODEL_ROUTING_ENABLED', 'true').lower() == 'true'
+FAST_MODEL_ID = os.getenv('FAST_MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
+FAST_MAX_TOKENS = int(os.getenv('FAST_MAX_TOKENS', '600'))
+# 小さいモデルの回答が不十分な場合に大きいモデルで生成し直すか
+MODEL_ESCALATION_ENABLED = os.getenv('MODEL_ESCALATION_ENABLED', 'true').lower() == 'true'
+LARGE_MAX_TOKENS = 1000
+
+# 判定の閾値
+LONG_QUERY_CHARS = 40       # これより長い質問は大きいモデル
+SHORT_QUERY_CHARS = 20      # これ以下の短い質問はスコアが拮抗していても小さいモデル
+MIN_TOP_SCORE = 0.5         # 最上位のスコアがこれ未満なら大きいモデル
+CLEAR_SCORE_MARGIN = 0.1    # 1位と2位のスコアの差がこれ以上なら小さいモデル
+WEAK_ANSWER_CHARS = 40      # これより短い回答は不十分とみなす
+
+SMALL_TALK_PATTERN = re.compile(
+    r'^(こんにちは|こんばんは|おはよう(ございます)?|ありがとう(ございます)?|よろしく(お願いします)?|'
+    r'hello|hi|hey|thanks?( you)?)[\s!！。.、]*$'
+)
+# 複数の情報の統合や原因の推論が必要な質問
+COMPLEX_INTENT_KEYWORDS = (
+    '違い', '比較', 'なぜ', '原因', '理由', '複数', '移行', '組み合わせ', '連携', 'トラブル',
+    'できない', 'されない', 'エラー', '不具合', 'compare', 'difference', 'why', 'troubleshoot', 'error', 'migrat',
+)
+# 回答に情報がないことを表す語
+WEAK_ANSWER_PHRASES = (
+    '見つかりません', '記載がありません', '記載されていません', 'わかりません', '分かりません',
+    '情報がありません', "i don't know", 'not mentioned',
+)
+
+
+class Route(NamedTuple):
+    """振り分け先（名前・モデルID・出力トークン数の上限）"""
+    name: str
+    model_id: str
+    max_tokens: int
+
+
+class ModelRouter:
+    """質問と検索結果から回答生成のモデルを選ぶ"""
+
+    def __init__(self, large_model_id: str, fast_model_id: str = FAST_MODEL_ID,
+                 enabled: bool = MODEL_ROUTING_ENABLED, escalation: bool = MODEL_ESCALATION_ENABLED):
+        self.large = Route('large', large_model_id, LARGE_MAX_TOKENS)
+        self.fast = Route('fast', fast_model_id, FAST_MAX_TOKENS)
+        # 小さいモデルが大きいモデルと同じ場合は振り分けない
+        self.enabled = enabled and fast_model_id != large_model_id
+        self.escalation = escalation
+
+    def choose(self, query: str, retrieved_context: List[Dict[str, Any]]) -> Tuple[Route, str]:
+        """振り分け先とその理由"""
+        if not self.enabled:
+            return self.large, 'disabled'
+        text = unicodedata.normalize('NFKC', query).strip().lower()
+        if SMALL_TALK_PATTERN.match(text):
+            return self.fast, 'small_talk'
+        if any(keyword in text for keyword in COMPLEX_INTENT_KEYWORDS):
+            return self.large, 'complex_intent'
+        if len(text) > LONG_QUERY_CHARS:
+            return self.large, 'long_query'
+
+        scores = sorted((item.get('score', 0) for item in retrieved_context), reverse=True)
+        if not scores or scores[0] < MIN_TOP_SCORE:
+            return self.large, 'low_score'
+        if len(scores) == 1 or scores[0] - scores[1] >= CLEAR_SCORE_MARGIN:
+            return self.fast, 'clear_top_result'
+        if len(text) <= SHORT_QUERY_CHARS:
+            return self.fast, 'short_query'
+        return self.large, 'ambiguous'
+
+    def should_escalate(self, route: Route, reason: str, answer: str) -> bool:
+        """小さいモデルの回答が不十分で、大きいモデルで生成し直すか（あいさつへの短い返答は除く）"""
+        return self.escalation and route is self.fast and reason != 'small_talk' and looks_weak(answer)
+
+
+def looks_weak(answer: str) -> bool:
+    """回答が短すぎる、または情報がないと答えているか"""
+    text = answer.strip().lower()
+    return len(text) < WEAK_ANSWER_CHARS or any(phrase in text for phrase in WEAK_ANSWER_PHRASES)
@@ -0,0 +1,101 @@
+"""
+検索結果の近似重複の除去と多様性を考慮した選択
+
+チャンクの重なりや、見出しだけが異なるヘルプページと Confluence のページのように、
+本文のほとんどが同じ検索結果を除く。各検索結果の本文を正規化した文字3-gram（シングル）の集合から、
+ハッシュ値の小さい順に SKETCH_SIZE 個を残す MinHash（bottom-k）の指紋を作り、
+2つの指紋から共通部分の大きさを推定する。類似度は小さい方の集合に対する共通部分の割合
+（重複係数）で、一方がもう一方をほぼ含む場合も重複とみなす。
+
+選択は Maximal Marginal Relevance（MMR）で行い、スコアが高く、選択済みの結果と似ていないものから選ぶ。
+類似度が NEAR_DUPLICATE_THRESHOLD 以上の結果は選ばない。MMR_LAMBDA を 1.0 にするとスコア順のまま
+近似重複だけを除く。指紋には組み込みの hash を使うため、値はプロセス内でのみ比較できる。
+"""
+
+import heapq
+import logging
+import os
+import re
+import unicodedata
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, List, NamedTuple, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 近似重複とみなす類似度と、MMR での関連度（スコア）の重み（1.0 で多様性を考慮しない）
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', '0.8'))
+MMR_LAMBDA = float(os.getenv('MMR_LAMBDA', '0.7'))
+
+SHINGLE_SIZE = 3
+SKETCH_SIZE = 128
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+class Fingerprint(NamedTuple):
+    """本文の指紋（シングルのハッシュ値の小さい方から SKETCH_SIZE 個と、シングルの種類数）"""
+    sketch: FrozenSet[int]
+    ordered: Tuple[int, ...]
+    size: int
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(text: str) -> Fingerprint:
+    """本文の指紋（同じ本文は何度も比較されるためキャッシュする）"""
+    normalized = WHITESPACE_PATTERN.sub(' ', unicodedata.normalize('NFKC', text).lower()).strip()
+    if not normalized:
+        return Fingerprint(frozenset(), (), 0)
+    shingles = {hash(normalized[i:i + SHINGLE_SIZE])
+                for i in range(max(1, len(normalized) - SHINGLE_SIZE + 1))}
+    ordered = tuple(heapq.nsmallest(SKETCH_SIZE, shingles))
+    return Fingerprint(frozenset(ordered), ordered, len(shingles))
+
+
+def similarity(a: Fingerprint, b: Fingerprint) -> float:
+    """2つの本文の重複係数（共通のシングル数 / 小さい方のシングル数）の推定値"""
+    if not a.size or not b.size:
+        return 0.0
+    common = len(a.sketch & b.sketch)
+    if a.size < SKETCH_SIZE and b.size < SKETCH_SIZE:
+        # 両方ともシングル全体を持っている場合は正確な値
+        jaccard = common / (a.size + b.size - common)
+    else:
+        # 指紋の最大値が小さい方（a とする）の最大値以下のハッシュ値は両方の指紋に漏れなく含まれるため、
+        # その範囲の和集合のうち両方に含まれる割合が Jaccard 係数の推定値になる
+        if a.ordered[-1] > b.ordered[-1]:
+            a, b = b, a
+        jaccard = common / (len(a.ordered) + bisect_right(b.ordered, a.ordered[-1]) - common)
+    intersection = jaccard * (a.size + b.size) / (1 + jaccard)
+    return min(1.0, intersection / min(a.size, b.size))
+
+
+def relevance(item: Dict[str, Any]) -> float:
+    """並べ替えに使う関連度（キーワード索引と統合した結果は rrf_score、それ以外は score）"""
+    return item.get('rrf_score', item.get('score', 0))
+
+
+def select_diverse(candidates: List[Dict[str, Any]], count: int, selected: Sequence[Dict[str, Any]] = (),
+                   threshold: float = NEAR_DUPLICATE_THRESHOLD,
+                   mmr_lambda: float = MMR_LAMBDA) -> List[Dict[str, Any]]:
+    """候補（content と score / rrf_score を持つ検索結果）から、選択済みの結果と近似重複しないものを MMR で count 件まで選ぶ"""
+    chosen = [fingerprint(item['content']) for item in selected]
+    # 候補ごとの選択済みの結果との最大の類似度（選ぶたびに新しく選んだ結果との類似度だけを加える）
+    pool = []
+    for item in candidates:
+        item_fingerprint = fingerprint(item['content'])
+        pool.append([item, item_fingerprint, max((similarity(item_fingerprint, other) for other in chosen), default=0.0)])
+    picked: List[Dict[str, Any]] = []
+    while len(picked) < count:
+        for entry in pool:
+            if entry[2] >= threshold:
+                logger.debug(f"近似重複の検索結果を除外: 記事ID={entry[0].get('article_id')}, 類似度={entry[2]:.2f}")
+        pool = [entry for entry in pool if entry[2] < threshold]
+        if not pool:
+            break
+        best = pool.pop(max(range(len(pool)),
+                            key=lambda i: mmr_lambda * relevance(pool[i][0]) - (1 - mmr_lambda) * pool[i][2]))
+        picked.append(best[0])
+        for entry in pool:
+            entry[2] = max(entry[2], similarity(entry[1], best[1]))
+    return picked
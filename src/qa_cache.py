@@ -0,0 +1,650 @@
+"""
+質問応答結果のキャッシュ
+
+プロセス間で共有できる安定したキー（SHA-256）と、差し替え可能なバックエンド
+（プロセス内メモリ / SQLite / Redisプロトコル）を提供する。SingleFlight は
+キャッシュに載る前の同じ質問の同時実行を1回にまとめる。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# Redisはオプション依存（バックエンドにredisを選んだ場合のみ必要）
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from resilience import Deadline, DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_TTL = 3600
+DEFAULT_NEGATIVE_TTL = 60
+DEFAULT_SQLITE_PATH = '/tmp/qa_answer_cache.sqlite3'
+DEFAULT_RETRIEVAL_TTL = 600
+DEFAULT_PINNED_REFRESH_INTERVAL = 900
+DEFAULT_RETRIEVAL_SQLITE_PATH = '/tmp/qa_retrieval_cache.sqlite3'
+# 他プロセスによる無効化を検知するまでの最大遅延（秒）
+GENERATION_CHECK_INTERVAL = 5
+
+
+def normalize_query(query: str) -> str:
+    """キャッシュ照合用に質問文を正規化（全角/半角・大文字小文字・空白の揺れを吸収）"""
+    normalized = unicodedata.normalize('NFKC', query)
+    return ' '.join(normalized.split()).lower()
+
+
+def make_cache_key(query: str, namespace: str = '') -> str:
+    """プロセスに依存しない安定したキャッシュキーを生成"""
+    digest = hashlib.sha256(f"{namespace}\x00{normalize_query(query)}".encode('utf-8')).hexdigest()
+    return digest
+
+
+class CacheBackend(ABC):
+    """キャッシュバックエンドの基底クラス（値はバイト列で保存する）
+
+    マーカー（get_marker / set_marker）は検索キャッシュの世代など、容量の上限による削除や
+    TTLの対象にしてはならない小さな値を、キャッシュのエントリとは別に保存する。
+    process_local が True のバックエンドは他のプロセスと共有されない。
+    """
+
+    process_local = False
+
+    @abstractmethod
+    def get_marker(self, key: str) -> Optional[bytes]:
+        """マーカーを取得（ない場合はNone）"""
+
+    @abstractmethod
+    def set_marker(self, key: str, value: bytes) -> None:
+        """マーカーを保存（容量の上限による削除・TTLの対象外）"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """値を取得（ない場合・期限切れの場合はNone）"""
+
+    @abstractmethod
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        """値を ttl 秒の有効期限付きで保存"""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """値を削除"""
+
+    @abstractmethod
+    def clear(self) -> None:
+        """すべての値を削除"""
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class InMemoryCacheBackend(CacheBackend):
+    """プロセス内のLRUキャッシュ（合計バイト数で上限を管理）"""
+
+    process_local = True
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._markers: Dict[str, bytes] = {}  # LRUの対象外
+        self._size = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get_marker(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._markers.get(key)
+
+    def set_marker(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self._markers[key] = value
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        entry_size = len(key) + len(value)
+        if entry_size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._size += entry_size
+            # 上限を超えた分を最も古く参照されたエントリから削除
+            while self._size > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self._evictions += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'evictions': self._evictions
+            }
+
+    def _remove(self, key: str) -> None:
+        value, _ = self._entries.pop(key)
+        self._size -= len(key) + len(value)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """SQLiteファイルによるキャッシュ（同一ホストのワーカー間で共有可能）"""
+
+    def __init__(self, path: str = DEFAULT_SQLITE_PATH, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, '
+            'expires_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)')
+        # マーカーは容量の上限による削除の対象外
+        self._conn.execute('CREATE TABLE IF NOT EXISTS markers (key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+
+    def get_marker(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM markers WHERE key = ?', (key,)).fetchone()
+        return bytes(row[0]) if row is not None else None
+
+    def set_marker(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO markers (key, value) VALUES (?, ?)', (key, value))
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, expires_at FROM cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at <= now:
+                self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                return None
+            self._conn.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+            return bytes(value)
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        entry_size = len(key) + len(value)
+        if entry_size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                (key, value, entry_size, now + ttl, now)
+            )
+            self._evict(now)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM cache')
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, total = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache').fetchone()
+        return {
+            'entries': entries,
+            'bytes': total,
+            'max_bytes': self.max_bytes,
+            'evictions': self._evictions
+        }
+
+    def _evict(self, now: float) -> None:
+        """期限切れエントリを削除し、上限を超えていれば参照が古い順に削除"""
+        self._conn.execute('DELETE FROM cache WHERE expires_at <= ?', (now,))
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute('SELECT key, size FROM cache ORDER BY accessed_at').fetchall():
+            self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self._evictions += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+class RedisCacheBackend(CacheBackend):
+    """Redisプロトコル互換ストアによるキャッシュ（Lambdaコンテナ間で共有可能）
+
+    容量の上限とLRU削除はサーバー側の maxmemory / maxmemory-policy に委ねる。
+    マーカーは有効期限なしで保存するため、maxmemory-policy は有効期限付きのキーだけを削除する
+    volatile-lru などにする（allkeys-lru ではマーカーも削除されうる）。
+    テストやローカル開発では client にRedis互換のスタンドインを渡せる。
+    """
+
+    def __init__(self, url: str = 'redis://localhost:6379/0', prefix: str = 'qa:answer:', client: Any = None):
+        if client is None:
+            if redis is None:
+                raise ImportError("Redisバックエンドを使用するには redis パッケージが必要です")
+            client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.prefix = prefix
+        self._client = client
+
+    def get_marker(self, key: str) -> Optional[bytes]:
+        return self._client.get(self.prefix + 'marker:' + key)
+
+    def set_marker(self, key: str, value: bytes) -> None:
+        self._client.set(self.prefix + 'marker:' + key, value)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._client.get(self.prefix + key)
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        self._client.set(self.prefix + key, value, px=max(1, int(ttl * 1000)))
+
+    def delete(self, key: str) -> None:
+        self._client.delete(self.prefix + key)
+
+    def clear(self) -> None:
+        keys = list(self._client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self._client.delete(*keys)
+
+
+class GenerationMarker:
+    """キャッシュの世代マーカー（キーに含め、advance() で世代を進めると既存エントリは参照されなくなる）
+
+    マーカーはバックエンドのマーカー領域（LRUの対象外）に保存し、マーカーがない場合は新しい世代を
+    作って使う（以前の世代で保存したエントリを無効化後に返さないため）。共有バックエンドなら
+    無効化は全プロセスに反映される。
+    """
+
+    def __init__(self, backend: CacheBackend, key: str):
+        self.backend = backend
+        self.key = key
+        self._generation = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def current(self) -> str:
+        """現在の世代（バックエンドへの問い合わせは GENERATION_CHECK_INTERVAL 秒に1回に抑える）"""
+        now = time.monotonic()
+        if self._generation is not None and now - self._checked_at < GENERATION_CHECK_INTERVAL:
+            return self._generation
+        try:
+            value = self.backend.get_marker(self.key)
+            if value is None:
+                # マーカーがない（初回・ストアの再作成後）場合は新しい世代から始める
+                value = self._new_generation().encode('utf-8')
+                self.backend.set_marker(self.key, value)
+            generation = value.decode('utf-8')
+        except Exception as e:
+            logger.warning(f"キャッシュの世代取得エラー: {e}")
+            # 確認できない間は直前の世代を使う（未確認の場合はこのプロセスだけの新しい世代）
+            generation = self._generation if self._generation is not None else self._new_generation()
+        with self._lock:
+            self._generation = generation
+            self._checked_at = now
+        return generation
+
+    def advance(self) -> str:
+        """世代を進める（新しい世代を返す）"""
+        generation = self._new_generation()
+        self.backend.set_marker(self.key, generation.encode('utf-8'))
+        with self._lock:
+            self._generation = generation
+            self._checked_at = time.monotonic()
+        return generation
+
+    @staticmethod
+    def _new_generation() -> str:
+        return str(time.time_ns())
+
+
+class AnswerCache:
+    """質問応答結果のキャッシュ（ヒット/ミス数の集計とネガティブキャッシュ対応）
+
+    knowledge_base_id を指定した場合はキーにナレッジベースの世代マーカーを含め、
+    invalidate()（Knowledge Base の同期完了時）でモデルによらずすべての回答を無効化できる。
+    """
+
+    def __init__(self, backend: CacheBackend, namespace: str = '', ttl: float = DEFAULT_TTL,
+                 negative_ttl: float = DEFAULT_NEGATIVE_TTL, knowledge_base_id: Optional[str] = None):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.marker = (GenerationMarker(backend, f"{knowledge_base_id}:answer:generation")
+                       if knowledge_base_id is not None else None)
+        self._counters = {'hits': 0, 'misses': 0, 'sets': 0, 'negative_sets': 0, 'invalidations': 0, 'errors': 0}
+        self._lock = threading.Lock()
+
+    def get(self, query: str) -> Optional[Dict[str, Any]]:
+        """キャッシュされた結果を取得（見つからない場合はNone）"""
+        key = self._key(query)
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            # キャッシュ障害は質問応答自体を止めないようミスとして扱う
+            logger.warning(f"キャッシュ取得エラー: {e}")
+            self._count('errors')
+            value = None
+        if value is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return json.loads(value)
+
+    def set(self, query: str, result: Dict[str, Any], negative: bool = False) -> None:
+        """結果をキャッシュに保存（negative=Trueの場合は短いTTLで保存）"""
+        key = self._key(query)
+        value = json.dumps(result, ensure_ascii=False).encode('utf-8')
+        try:
+            self.backend.set(key, value, self.negative_ttl if negative else self.ttl)
+        except Exception as e:
+            logger.warning(f"キャッシュ保存エラー: {e}")
+            self._count('errors')
+            return
+        self._count('negative_sets' if negative else 'sets')
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def invalidate(self) -> Optional[str]:
+        """世代を進めてすべての回答を無効化（新しい世代マーカーを返す。knowledge_base_id がない場合は None）"""
+        if self.marker is None:
+            return None
+        generation = self.marker.advance()
+        self._count('invalidations')
+        logger.info(f"回答キャッシュを無効化しました: 世代={generation}")
+        return generation
+
+    def stats(self) -> Dict[str, Any]:
+        """ヒット率などの統計情報を返す"""
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        stats['backend'] = type(self.backend).__name__
+        try:
+            stats.update(self.backend.stats())
+        except Exception as e:
+            logger.warning(f"キャッシュ統計の取得エラー: {e}")
+        return stats
+
+    def _key(self, query: str) -> str:
+        if self.marker is None:
+            return make_cache_key(query, self.namespace)
+        return make_cache_key(query, f"{self.namespace}:{self.marker.current()}")
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+
+class RetrievalCache:
+    """Knowledge Base検索結果のキャッシュ（ナレッジベース・検索テキスト・取得件数単位）
+
+    キーには世代マーカー（GenerationMarker）を含め、invalidate() で世代を進めると既存エントリは
+    参照されなくなる（共有バックエンドなら全プロセスに反映される）。
+    pinned_queries に含まれる固定の拡張クエリはLRUで削除されないプロセス内領域に
+    保持し、refresh_due() が True を返した時点でバックグラウンド更新する。
+    """
+
+    def __init__(self, backend: CacheBackend, knowledge_base_id: str, ttl: float = DEFAULT_RETRIEVAL_TTL,
+                 pinned_queries: Iterable[str] = (),
+                 pinned_refresh_interval: float = DEFAULT_PINNED_REFRESH_INTERVAL):
+        self.backend = backend
+        self.namespace = f"{knowledge_base_id}:retrieve"
+        self.ttl = ttl
+        self.pinned_queries = frozenset(pinned_queries)
+        self.pinned_refresh_interval = pinned_refresh_interval
+        self._pinned = {}  # (text, number_of_results) -> (generation, results, fetched_at)
+        self._refreshing = set()
+        self.marker = GenerationMarker(backend, f"{self.namespace}:generation")
+        self._generation = None
+        self._counters = {'hits': 0, 'pinned_hits': 0, 'misses': 0, 'refreshes': 0, 'invalidations': 0, 'errors': 0}
+        self._lock = threading.Lock()
+
+    def generation(self) -> str:
+        """現在の世代マーカーを取得（世代が変わった場合は常駐させた固定クエリの結果も捨てる）"""
+        generation = self.marker.current()
+        with self._lock:
+            if generation != self._generation:
+                self._pinned.clear()
+            self._generation = generation
+        return generation
+
+    def get(self, text: str, number_of_results: int) -> Optional[List[Dict[str, Any]]]:
+        """キャッシュされた検索結果を取得（見つからない場合はNone）"""
+        generation = self.generation()
+        if text in self.pinned_queries:
+            with self._lock:
+                entry = self._pinned.get((text, number_of_results))
+            if entry is not None and entry[0] == generation:
+                self._count('pinned_hits')
+                return entry[1]
+            self._count('misses')
+            return None
+
+        try:
+            value = self.backend.get(self._key(text, number_of_results, generation))
+        except Exception as e:
+            logger.warning(f"検索キャッシュ取得エラー: {e}")
+            self._count('errors')
+            value = None
+        if value is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return json.loads(value)
+
+    def set(self, text: str, number_of_results: int, results: List[Dict[str, Any]]) -> None:
+        """検索結果をキャッシュに保存"""
+        generation = self.generation()
+        if text in self.pinned_queries:
+            with self._lock:
+                self._pinned[(text, number_of_results)] = (generation, results, time.monotonic())
+            return
+        value = json.dumps(results, ensure_ascii=False).encode('utf-8')
+        try:
+            self.backend.set(self._key(text, number_of_results, generation), value, self.ttl)
+        except Exception as e:
+            logger.warning(f"検索キャッシュ保存エラー: {e}")
+            self._count('errors')
+
+    def refresh_due(self, text: str, number_of_results: int) -> bool:
+        """固定クエリの更新時期であればTrueを返し、更新中として予約する"""
+        if text not in self.pinned_queries:
+            return False
+        with self._lock:
+            entry = self._pinned.get((text, number_of_results))
+            if entry is None or (text, number_of_results) in self._refreshing:
+                return False
+            if time.monotonic() - entry[2] < self.pinned_refresh_interval:
+                return False
+            self._refreshing.add((text, number_of_results))
+            self._counters['refreshes'] += 1
+            return True
+
+    def finish_refresh(self, text: str, number_of_results: int) -> None:
+        with self._lock:
+            self._refreshing.discard((text, number_of_results))
+
+    def invalidate(self) -> str:
+        """世代を進めてすべての検索結果を無効化（新しい世代マーカーを返す）"""
+        generation = self.marker.advance()
+        with self._lock:
+            self._pinned.clear()
+            self._generation = generation
+            self._counters['invalidations'] += 1
+        logger.info(f"検索キャッシュを無効化しました: 世代={generation}")
+        return generation
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._counters)
+            stats['pinned_entries'] = len(self._pinned)
+        lookups = stats['hits'] + stats['pinned_hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['hits'] + stats['pinned_hits']) / lookups if lookups else 0.0
+        stats['backend'] = type(self.backend).__name__
+        return stats
+
+    def _key(self, text: str, number_of_results: int, generation: str) -> str:
+        # 検索テキストは埋め込み結果に影響するため正規化せずにそのまま使う
+        raw = f"{self.namespace}:{generation}\x00{number_of_results}\x00{text}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+
+class CoalescedCallTimeout(DeadlineExceeded):
+    """SingleFlight で待つ側の時間予算内にリーダーの処理が終わらなかった（リーダーの処理は続く）"""
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら新たに実行せず、その結果を待って共有する
+
+    最初の呼び出し（リーダー）だけが func を実行し、完了までに同じキーで
+    呼び出された側は同じ結果（または同じ例外）を受け取る。完了後の呼び出しは
+    改めて実行されるため、結果の保持はキャッシュに任せる。待つ側は自分の deadline の残り時間までしか
+    待たず、それまでにリーダーが終わらない場合は CoalescedCallTimeout を送出する。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Future] = {}
+        self._counters = {'leaders': 0, 'coalesced': 0}
+
+    def do(self, key: str, func: Callable[[], Any], deadline: Deadline = None) -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self._counters['leaders'] += 1
+            else:
+                self._counters['coalesced'] += 1
+
+        if not leader:
+            try:
+                return future.result(timeout=deadline.remaining() if deadline is not None else None)
+            except TimeoutError:
+                raise CoalescedCallTimeout(f"処理中の同じ質問が時間予算内に終わりませんでした: {key}")
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._counters, in_flight=len(self._calls))
+
+
+def _create_backend(backend_name: str, max_bytes: int, sqlite_path: str, redis_url: str,
+                    redis_prefix: str) -> CacheBackend:
+    """バックエンド名からキャッシュバックエンドを作成"""
+    if backend_name == 'sqlite':
+        return SQLiteCacheBackend(sqlite_path, max_bytes)
+    if backend_name == 'redis':
+        return RedisCacheBackend(redis_url, prefix=redis_prefix)
+    if backend_name == 'memory':
+        return InMemoryCacheBackend(max_bytes)
+    raise ValueError(f"未対応のキャッシュバックエンドです: {backend_name}")
+
+
+def create_answer_cache(namespace: str = '', knowledge_base_id: Optional[str] = None) -> Optional[AnswerCache]:
+    """環境変数の設定に従って回答キャッシュを作成（ANSWER_CACHE_BACKEND=noneで無効）"""
+    backend_name = os.getenv('ANSWER_CACHE_BACKEND', 'memory').lower()
+    max_bytes = int(os.getenv('ANSWER_CACHE_MAX_BYTES', str(DEFAULT_MAX_BYTES)))
+
+    if backend_name == 'none':
+        return None
+    backend = _create_backend(
+        backend_name,
+        max_bytes,
+        os.getenv('ANSWER_CACHE_SQLITE_PATH', DEFAULT_SQLITE_PATH),
+        os.getenv('ANSWER_CACHE_REDIS_URL', 'redis://localhost:6379/0'),
+        'qa:answer:'
+    )
+
+    return AnswerCache(
+        backend,
+        namespace=namespace,
+        ttl=float(os.getenv('ANSWER_CACHE_TTL', str(DEFAULT_TTL))),
+        negative_ttl=float(os.getenv('ANSWER_CACHE_NEGATIVE_TTL', str(DEFAULT_NEGATIVE_TTL))),
+        knowledge_base_id=knowledge_base_id
+    )
+
+
+def create_retrieval_cache(knowledge_base_id: str, pinned_queries: Iterable[str] = ()) -> Optional[RetrievalCache]:
+    """環境変数の設定に従って検索結果キャッシュを作成（RETRIEVAL_CACHE_BACKEND=noneで無効）
+
+    常駐させる固定クエリは pinned_queries と RETRIEVAL_CACHE_PINNED_QUERIES（カンマ区切り）を合わせたもの。
+    """
+    backend_name = os.getenv('RETRIEVAL_CACHE_BACKEND', os.getenv('ANSWER_CACHE_BACKEND', 'memory')).lower()
+    if backend_name == 'none':
+        return None
+    configured_pins = {text.strip() for text in os.getenv('RETRIEVAL_CACHE_PINNED_QUERIES', '').split(',') if text.strip()}
+    backend = _create_backend(
+        backend_name,
+        int(os.getenv('RETRIEVAL_CACHE_MAX_BYTES', str(DEFAULT_MAX_BYTES))),
+        os.getenv('RETRIEVAL_CACHE_SQLITE_PATH', DEFAULT_RETRIEVAL_SQLITE_PATH),
+        os.getenv('RETRIEVAL_CACHE_REDIS_URL', os.getenv('ANSWER_CACHE_REDIS_URL', 'redis://localhost:6379/0')),
+        'qa:retrieve:'
+    )
+    return RetrievalCache(
+        backend,
+        knowledge_base_id,
+        ttl=float(os.getenv('RETRIEVAL_CACHE_TTL', str(DEFAULT_RETRIEVAL_TTL))),
+        pinned_queries=set(pinned_queries) | configured_pins,
+        pinned_refresh_interval=float(os.getenv('RETRIEVAL_CACHE_PINNED_REFRESH', str(DEFAULT_PINNED_REFRESH_INTERVAL)))
+    )
@@ -0,0 +1,305 @@
+"""
+Bedrock呼び出しのリトライと時間予算
+
+- Deadline: リクエスト全体の残り時間。各段（検索・生成）に渡して共有する
+- is_retryable: スロットリングと一時的な障害だけをリトライ対象とする（検証エラー等は即座に失敗）
+- call_with_retry: Full Jitter の指数バックオフでリトライし、残り時間を超えて待たない。
+  残り時間がクライアントのタイムアウトより短い場合、各試行は残り時間で打ち切る
+- CircuitBreaker: 失敗が続いた呼び出しを一定時間止める（回答生成の縮退運転に使用）。
+  失敗として数えるのはサービス側の障害（is_service_failure）だけ
+- create_client_config: 並列検索に合わせた接続プール数とタイムアウトを設定した botocore の Config
+
+リトライはこのモジュールで行うため、botocore 自体のリトライは無効にする（二重のリトライで
+待ち時間が積み重ならないようにする）。
+"""
+
+import contextvars
+import functools
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Any, Callable, Dict
+
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, ReadTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# リクエスト全体の時間予算（秒）。Lambdaのタイムアウト（30秒）より短くする
+REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', '25'))
+
+# スロットリングを示すエラーコード
+THROTTLING_ERROR_CODES = {
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'Throttling',
+    'RequestLimitExceeded',
+}
+
+# スロットリング・一時的な障害を示すエラーコード
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {
+    'ServiceUnavailableException',
+    'ServiceUnavailable',
+    'InternalServerException',
+    'InternalFailure',
+    'ModelNotReadyException',
+    'ModelTimeoutException',
+    'RequestTimeout',
+    'RequestTimeoutException',
+}
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Bedrockクライアントの接続・読み取りタイムアウト（秒）
+BEDROCK_CONNECT_TIMEOUT = float(os.getenv('BEDROCK_CONNECT_TIMEOUT', '3'))
+BEDROCK_READ_TIMEOUT = float(os.getenv('BEDROCK_READ_TIMEOUT', '25'))
+# 1回の試行がクライアントのタイムアウトで終わるまでの最長時間
+ATTEMPT_TIMEOUT_SECONDS = BEDROCK_CONNECT_TIMEOUT + BEDROCK_READ_TIMEOUT
+# 残り時間で打ち切る試行を実行するスレッド数の上限
+DEADLINE_CALL_MAX_WORKERS = int(os.getenv('DEADLINE_CALL_MAX_WORKERS', '32'))
+
+
+class DeadlineExceeded(Exception):
+    """リクエストの時間予算を使い切った"""
+
+
+class Deadline:
+    """リクエスト全体の期限（time.monotonic 基準）"""
+
+    def __init__(self, seconds: float = None):
+        self.expires_at = time.monotonic() + (REQUEST_DEADLINE_SECONDS if seconds is None else seconds)
+
+    @classmethod
+    def from_lambda_context(cls, context: Any, reserve_seconds: float = 1.0) -> 'Deadline':
+        """Lambdaの残り実行時間（応答を返す余裕を除く）と REQUEST_DEADLINE_SECONDS の短い方"""
+        seconds = REQUEST_DEADLINE_SECONDS
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            seconds = min(seconds, context.get_remaining_time_in_millis() / 1000 - reserve_seconds)
+        return cls(max(seconds, 0))
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, description: str) -> None:
+        """期限切れなら DeadlineExceeded"""
+        if self.expired():
+            raise DeadlineExceeded(f"{description}の時間予算を使い切りました")
+
+
+class RetryPolicy:
+    """リトライ回数とバックオフの設定"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 4.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        """attempt 回目（1始まり）の失敗後の待ち時間（Full Jitter）"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy(
+    max_attempts=int(os.getenv('RETRY_MAX_ATTEMPTS', '3')),
+    base_delay=float(os.getenv('RETRY_BASE_DELAY', '0.5')),
+    max_delay=float(os.getenv('RETRY_MAX_DELAY', '4'))
+)
+
+
+def is_retryable(error: BaseException) -> bool:
+    """スロットリングまたは一時的な障害によるエラーか"""
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code', '')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        return code in RETRYABLE_ERROR_CODES or status in RETRYABLE_STATUS_CODES
+    # 接続エラー・タイムアウト（EndpointConnectionError, ConnectTimeoutError 等を含む）
+    return isinstance(error, (ConnectionError, ReadTimeoutError))
+
+
+def is_service_failure(error: BaseException) -> bool:
+    """サーキットブレーカーの失敗として数えるエラーか
+
+    スロットリング・5xx・接続エラー・タイムアウトなどサービス側の障害だけを数える。検証エラーや
+    権限エラーはリクエスト側の問題で、時間予算切れ（DeadlineExceeded）はそのリクエストの残り時間の問題のため数えない。
+    """
+    return not isinstance(error, DeadlineExceeded) and is_retryable(error)
+
+
+def is_throttling(error: BaseException) -> bool:
+    """スロットリング（429 を含む）によるエラーか"""
+    if not isinstance(error, ClientError):
+        return False
+    code = error.response.get('Error', {}).get('Code', '')
+    return code in THROTTLING_ERROR_CODES or error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 429
+
+
+def retry_delay(error: BaseException, attempt: int, description: str, deadline: Deadline = None,
+                policy: RetryPolicy = None) -> float:
+    """失敗した attempt 回目の後に待つ秒数を返す。リトライしない場合は error を送出する
+
+    リトライ対象外のエラー、試行回数の上限、待つと期限を過ぎる場合はリトライしない。
+    """
+    policy = policy or DEFAULT_RETRY_POLICY
+    logger.error(f"{description}エラー (試行 {attempt}/{policy.max_attempts}): {str(error)}")
+    if not is_retryable(error):
+        raise error
+    if attempt >= policy.max_attempts:
+        logger.error(f"{description}の最大試行回数に達しました")
+        raise error
+    delay = policy.backoff(attempt)
+    if deadline is not None and delay >= deadline.remaining():
+        logger.error(f"{description}の時間予算が残っていないためリトライしません（残り {deadline.remaining():.2f}秒）")
+        raise error
+    return delay
+
+
+_attempt_executor = None
+_attempt_executor_lock = threading.Lock()
+
+
+def _get_attempt_executor() -> ThreadPoolExecutor:
+    """残り時間で打ち切る試行のスレッドプール（最初に必要になった時に作成）"""
+    global _attempt_executor
+    with _attempt_executor_lock:
+        if _attempt_executor is None:
+            _attempt_executor = ThreadPoolExecutor(max_workers=DEADLINE_CALL_MAX_WORKERS,
+                                                   thread_name_prefix='deadline-call')
+        return _attempt_executor
+
+
+def bounded_by_deadline(deadline: Deadline) -> bool:
+    """試行を残り時間で打ち切る必要があるか（クライアントのタイムアウトの方が先に来る場合は不要）"""
+    return deadline is not None and deadline.remaining() < ATTEMPT_TIMEOUT_SECONDS
+
+
+def _call_within_deadline(func: Callable[[], Any], description: str, deadline: Deadline) -> Any:
+    """func を1回呼び出す。残り時間がクライアントのタイムアウトより短い場合は残り時間で打ち切る
+
+    打ち切った呼び出しはバックグラウンドで続き、クライアントのタイムアウトで終わる。
+    """
+    if not bounded_by_deadline(deadline):
+        return func()
+    future = _get_attempt_executor().submit(contextvars.copy_context().run, func)
+    try:
+        return future.result(timeout=deadline.remaining())
+    except TimeoutError:
+        future.cancel()
+        raise DeadlineExceeded(f"{description}が時間予算内に終わりませんでした")
+
+
+def call_with_retry(func: Callable[[], Any], description: str, deadline: Deadline = None,
+                    policy: RetryPolicy = None) -> Any:
+    """func を呼び出し、スロットリング・一時的な障害の場合のみリトライする"""
+    policy = policy or DEFAULT_RETRY_POLICY
+    attempt = 0
+    while True:
+        if deadline is not None:
+            deadline.check(description)
+        attempt += 1
+        try:
+            return _call_within_deadline(func, description, deadline)
+        except Exception as e:
+            time.sleep(retry_delay(e, attempt, description, deadline, policy))
+
+
+async def call_with_retry_async(func: Callable[[], Any], description: str, deadline: Deadline = None,
+                                policy: RetryPolicy = None, executor: Any = None) -> Any:
+    """call_with_retry の asyncio 版（func は executor で実行し、待ちは asyncio.sleep で行う）"""
+    import asyncio
+
+    policy = policy or DEFAULT_RETRY_POLICY
+    loop = asyncio.get_running_loop()
+    attempt = 0
+    while True:
+        if deadline is not None:
+            deadline.check(description)
+        attempt += 1
+        try:
+            # 同期版と同じく呼び出し元の計測（RequestMetrics）のコンテキストで実行する
+            call = loop.run_in_executor(executor, functools.partial(contextvars.copy_context().run, func))
+            if bounded_by_deadline(deadline):
+                # 残り時間で打ち切る（executor の呼び出しはバックグラウンドで続き、クライアントのタイムアウトで終わる）
+                try:
+                    return await asyncio.wait_for(call, deadline.remaining())
+                except asyncio.TimeoutError:
+                    raise DeadlineExceeded(f"{description}が時間予算内に終わりませんでした")
+            return await call
+        except Exception as e:
+            await asyncio.sleep(retry_delay(e, attempt, description, deadline, policy))
+
+
+class CircuitBreaker:
+    """連続した失敗で開き、一定時間後に1回だけ試して（半開）閉じるかを決める
+
+    - closed: 通常どおり呼び出す
+    - open: 呼び出さない（reset_timeout 秒後に half_open へ）
+    - half_open: 1件だけ試し、成功すれば closed、失敗すれば再び open
+    """
+
+    def __init__(self, name: str, failure_threshold: int = None, reset_timeout: float = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or int(os.getenv('CIRCUIT_BREAKER_FAILURES', '5'))
+        self.reset_timeout = float(os.getenv('CIRCUIT_BREAKER_RESET_SECONDS', '30')) if reset_timeout is None else reset_timeout
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+        self._counters = {'opened': 0, 'rejected': 0}
+
+    def allow(self) -> bool:
+        """呼び出してよいか（half_open では試行中の1件以外を拒否する）"""
+        with self._lock:
+            # 試行した呼び出しの結果が記録されないまま reset_timeout 秒経った場合も改めて試す
+            if self.state != 'closed' and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._opened_at = time.monotonic()
+                logger.info(f"{self.name}のサーキットブレーカーを半開にして試行します")
+                return True
+            if self.state == 'closed':
+                return True
+            self._counters['rejected'] += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != 'closed':
+                logger.info(f"{self.name}のサーキットブレーカーを閉じました")
+            self.state = 'closed'
+            self._failures = 0
+
+    def record_error(self, error: BaseException) -> None:
+        """呼び出しのエラーを記録する（サービス側の障害のみ失敗として数える）"""
+        if is_service_failure(error):
+            self.record_failure()
+        else:
+            logger.info(f"{self.name}のエラーはサービス側の障害ではないため失敗として数えません: {type(error).__name__}")
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self.state == 'half_open' or (self.state == 'closed' and self._failures >= self.failure_threshold):
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+                self._counters['opened'] += 1
+                logger.warning(f"{self.name}のサーキットブレーカーを開きました（{self.reset_timeout:g}秒間停止）")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._counters, state=self.state, failures=self._failures)
+
+
+def create_client_config(max_pool_connections: int = None) -> Config:
+    """Bedrockクライアント用の botocore 設定"""
+    if max_pool_connections is None:
+        max_pool_connections = int(os.getenv('BEDROCK_MAX_POOL_CONNECTIONS', '32'))
+    return Config(
+        max_pool_connections=max_pool_connections,
+        connect_timeout=BEDROCK_CONNECT_TIMEOUT,
+        read_timeout=BEDROCK_READ_TIMEOUT,
+        retries={'total_max_attempts': 1, 'mode': 'standard'}
+    )
@@ -0,0 +1,126 @@
+"""
+検索の深さの調整（確信度の高い検索結果での早期終了）
+
+retrieve_from_knowledge_base は元のクエリ（主クエリ）を先に検索し、その結果の調整後スコア
+（データソースのボーナスを含む）の1位と、1位と2位の差から、英語翻訳・技術用語の文脈検索などの
+追加のサブクエリ（拡張クエリ）をどこまで検索するかを決める。
+
+- early_exit: 1位のスコアが EARLY_EXIT_MIN_SCORE 以上で、2位との差が EARLY_EXIT_MIN_GAP 以上
+  → 拡張クエリは検索しない（検索は1回）
+- reduced: 1位のスコアが REDUCED_DEPTH_MIN_SCORE 以上 → 拡張クエリの取得件数を max_results に減らす
+- full: それ以外 → 拡張クエリを従来どおりの件数で検索する
+
+拡張クエリを主クエリの後に検索するため、確信度の低いクエリでは検索の往復が1回増える。
+検索の順序は RetrievalStages が決め、同期版・asyncio 版・一括処理はその指示どおりに検索するだけにする
+（検索の方法が違っても、どのサブクエリをどの順で検索するかは同じになる）。
+判定の結果と1位のスコア・差は計測値（retrieval_depth / retrieval_top_score / retrieval_score_gap）と
+ログに記録するため、閾値はその分布を見て調整する。
+"""
+
+import logging
+import os
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+
+from metrics import annotate
+from retrieval_fanout import SubQuery
+
+logger = logging.getLogger(__name__)
+
+# 深さの調整の有無と判定の閾値
+ADAPTIVE_RETRIEVAL_ENABLED = os.getenv('ADAPTIVE_RETRIEVAL_ENABLED', 'true').lower() == 'true'
+EARLY_EXIT_MIN_SCORE = float(os.getenv('EARLY_EXIT_MIN_SCORE', '0.7'))
+EARLY_EXIT_MIN_GAP = float(os.getenv('EARLY_EXIT_MIN_GAP', '0.05'))
+REDUCED_DEPTH_MIN_SCORE = float(os.getenv('REDUCED_DEPTH_MIN_SCORE', '0.55'))
+
+
+class DepthDecision(NamedTuple):
+    """判定の結果（early_exit / reduced / full）と、判定に使ったスコア"""
+    name: str
+    top_score: float
+    score_gap: float
+
+
+class RetrievalDepthController:
+    """主クエリの検索結果から、拡張クエリの検索の要否と取得件数を決める"""
+
+    def __init__(self, enabled: bool = ADAPTIVE_RETRIEVAL_ENABLED, min_score: float = EARLY_EXIT_MIN_SCORE,
+                 min_gap: float = EARLY_EXIT_MIN_GAP, reduced_min_score: float = REDUCED_DEPTH_MIN_SCORE):
+        self.enabled = enabled
+        self.min_score = min_score
+        self.min_gap = min_gap
+        self.reduced_min_score = reduced_min_score
+
+    def staged(self, sub_queries: List[SubQuery]) -> bool:
+        """主クエリを先に検索するか（拡張クエリがない場合は1回で済むため分けない）"""
+        return self.enabled and len(sub_queries) > 1
+
+    def stages(self, query: str, sub_queries: List[SubQuery], max_results: int,
+               rank: Callable[[List[Dict[str, Any]], int], List[Dict[str, Any]]]) -> 'RetrievalStages':
+        """サブクエリを検索する順序（rank は主クエリの結果に調整後スコアを付ける _rank_results）"""
+        return RetrievalStages(self, query, sub_queries, max_results, rank)
+
+    def decide(self, ranked_results: List[Dict[str, Any]]) -> DepthDecision:
+        """主クエリの検索結果（_rank_results で調整後スコアを付けたもの）から判定する"""
+        scores = sorted((result.get('score', 0) for result in ranked_results), reverse=True)
+        top_score = scores[0] if scores else 0.0
+        # 1件しかない場合は差を1位のスコアとみなす
+        score_gap = top_score - scores[1] if len(scores) > 1 else top_score
+        if top_score >= self.min_score and score_gap >= self.min_gap:
+            name = 'early_exit'
+        elif top_score >= self.reduced_min_score:
+            name = 'reduced'
+        else:
+            name = 'full'
+        return DepthDecision(name, top_score, score_gap)
+
+    def plan(self, query: str, ranked_results: List[Dict[str, Any]], expansions: List[SubQuery],
+             max_results: int) -> Tuple[DepthDecision, List[SubQuery]]:
+        """判定の結果と、続けて検索する拡張クエリ"""
+        decision = self.decide(ranked_results)
+        if decision.name == 'early_exit':
+            planned: List[SubQuery] = []
+        elif decision.name == 'reduced':
+            planned = [(text, min(number_of_results, max_results)) for text, number_of_results in expansions]
+        else:
+            planned = list(expansions)
+        annotate(retrieval_depth=decision.name, retrieval_top_score=round(decision.top_score, 4),
+                 retrieval_score_gap=round(decision.score_gap, 4))
+        logger.info(f"検索の深さ: '{query}' → {decision.name} (1位={decision.top_score:.4f}, "
+                    f"差={decision.score_gap:.4f}, 拡張クエリ={len(planned)}/{len(expansions)})")
+        return decision, planned
+
+
+class RetrievalStages:
+    """主クエリ → 拡張クエリの順に、次に検索するサブクエリを決める
+
+    next_batch に直前に検索したサブクエリの結果（初回は空）を渡し、返ったサブクエリを検索する。
+    空のリストが返ったら終わりで、issued に検索したサブクエリ、results にその結果が残る。
+    """
+
+    def __init__(self, controller: RetrievalDepthController, query: str, sub_queries: List[SubQuery],
+                 max_results: int, rank: Callable[[List[Dict[str, Any]], int], List[Dict[str, Any]]]):
+        self.controller = controller
+        self.query = query
+        self.sub_queries = sub_queries
+        self.max_results = max_results
+        self.rank = rank
+        self.issued: List[SubQuery] = []
+        self.results: List[Dict[str, Any]] = []
+        self._step = 0
+
+    def next_batch(self, results: List[Dict[str, Any]]) -> List[SubQuery]:
+        """直前の検索結果を受け取り、次に検索するサブクエリを返す（終わった場合は空のリスト）"""
+        self.results = self.results + list(results)
+        staged = self.controller.staged(self.sub_queries)
+        if self._step == 0:
+            batch = self.sub_queries[:1] if staged else list(self.sub_queries)
+        elif self._step == 1 and staged:
+            _, batch = self.controller.plan(self.query, self.rank(self.results, self.max_results),
+                                            self.sub_queries[1:], self.max_results)
+        else:
+            batch = []
+        self._step += 1
+        self.issued = self.issued + batch
+        if not batch:
+            annotate(fan_out=len(self.issued))
+        return batch
@@ -0,0 +1,265 @@
+"""
+Knowledge Base検索のサブクエリ並列実行
+
+retrieve_from_knowledge_base が発行する複数のサブクエリ（元のクエリ、英語翻訳、
+技術用語の文脈検索など）を有界のスレッドプールで同時に実行し、結果をマージする。
+fan_out_retrieve_async は同じ処理を asyncio のイベントループ上で行う（boto3 の呼び出しだけを
+スレッドプールで実行し、リトライ待ちは asyncio.sleep で行う）。asyncio は読み込みに時間が
+かかるため、Lambdaの起動を遅くしないよう非同期版を使う場合にだけ読み込む。
+リトライと時間予算（deadline）は resilience モジュールの共通処理を使う。期限までに
+終わらなかったサブクエリは失敗として扱い、取得できた結果だけで続行する。
+遅い retrieve のヘッジ（hedging モジュール、既定は無効）はリトライの各試行の中で行う。
+reciprocal_rank_fusion はベクトル検索とキーワード索引（keyword_index）の結果を順位で統合する。
+"""
+
+import contextvars
+import functools
+import logging
+import os
+from concurrent.futures import Executor, TimeoutError, as_completed
+from typing import Any, Callable, Dict, List, Tuple
+
+from hedging import RETRIEVE_HEDGER
+from metrics import stage
+from resilience import Deadline, RetryPolicy, call_with_retry, call_with_retry_async
+
+logger = logging.getLogger(__name__)
+
+# (検索テキスト, 取得件数)
+SubQuery = Tuple[str, int]
+
+# Reciprocal Rank Fusion の定数 k（大きいほど下位の結果の寄与が相対的に大きくなる）
+RRF_K = int(os.getenv('RRF_K', '60'))
+
+
+def _retrieve_params(knowledge_base_id: str, text: str, number_of_results: int) -> Dict[str, Any]:
+    """retrieve API の引数"""
+    return {
+        'knowledgeBaseId': knowledge_base_id,
+        'retrievalQuery': {
+            'text': text
+        },
+        'retrievalConfiguration': {
+            'vectorSearchConfiguration': {
+                'numberOfResults': number_of_results
+            }
+        }
+    }
+
+
+def retrieve_single(client: Any, knowledge_base_id: str, text: str, number_of_results: int,
+                    deadline: Deadline = None, policy: RetryPolicy = None) -> List[Dict[str, Any]]:
+    """1つのサブクエリでKnowledge Baseを検索（サブクエリ単位でリトライ）"""
+    params = _retrieve_params(knowledge_base_id, text, number_of_results)
+    with stage('retrieve'):
+        response = call_with_retry(lambda: RETRIEVE_HEDGER.call(lambda: client.retrieve(**params)),
+                                   f"サブクエリ検索 '{text}' ", deadline, policy)
+    return response.get('retrievalResults', [])
+
+
+def _refresh_pinned(client: Any, knowledge_base_id: str, cache: Any, text: str, number_of_results: int) -> None:
+    """固定の拡張クエリの検索結果をバックグラウンドで更新"""
+    try:
+        cache.set(text, number_of_results, retrieve_single(client, knowledge_base_id, text, number_of_results))
+    except Exception as e:
+        logger.warning(f"固定クエリ '{text}' の更新に失敗しました: {str(e)}")
+    finally:
+        cache.finish_refresh(text, number_of_results)
+
+
+def fan_out_retrieve(client: Any, knowledge_base_id: str, sub_queries: List[SubQuery],
+                     executor: Executor = None, cache: Any = None,
+                     deadline: Deadline = None) -> List[Dict[str, Any]]:
+    """サブクエリを並列に実行し、取得できた結果をマージして返す
+
+    結果は到着順に回収するが、重複排除の結果が実行順に依存しないよう
+    マージ時はサブクエリの発行順に並べる。失敗したサブクエリは除外し、
+    成功したサブクエリの結果はそのまま利用する。cache（RetrievalCache）を
+    渡した場合はキャッシュ済みのサブクエリを検索せずに済ませる。deadline を
+    渡した場合、期限までに終わらなかったサブクエリは待たずに失敗として扱う。
+    """
+    if not sub_queries:
+        return []
+    return merge_results(retrieve_sub_queries(client, knowledge_base_id, sub_queries, executor, cache, deadline))
+
+
+def retrieve_sub_queries(client: Any, knowledge_base_id: str, sub_queries: List[SubQuery],
+                         executor: Executor = None, cache: Any = None,
+                         deadline: Deadline = None) -> Dict[int, List[Dict[str, Any]]]:
+    """サブクエリを並列に実行し、サブクエリの番号ごとの結果を返す（失敗したサブクエリは含まない）"""
+    results_by_index, pending = _lookup_cached(client, knowledge_base_id, sub_queries, executor, cache)
+    failed = 0
+
+    if executor is None or len(pending) <= 1:
+        # 実行するサブクエリが1つだけならスレッドを使わずに実行
+        for index in pending:
+            text, number_of_results = sub_queries[index]
+            try:
+                results_by_index[index] = retrieve_single(client, knowledge_base_id, text, number_of_results,
+                                                          deadline=deadline)
+            except Exception as e:
+                logger.error(f"サブクエリ '{text}' の検索に失敗しました: {str(e)}")
+                failed += 1
+    else:
+        # 処理時間の計測（metrics）をスレッドに引き継ぐため、呼び出し元のコンテキストで実行する
+        futures = {
+            executor.submit(contextvars.copy_context().run, retrieve_single, client, knowledge_base_id,
+                            *sub_queries[index], deadline=deadline): index
+            for index in pending
+        }
+        timeout = deadline.remaining() if deadline is not None else None
+        collected = 0
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                index = futures[future]
+                collected += 1
+                try:
+                    results_by_index[index] = future.result()
+                except Exception as e:
+                    logger.error(f"サブクエリ '{sub_queries[index][0]}' の検索に失敗しました: {str(e)}")
+                    failed += 1
+        except TimeoutError:
+            # 期限までに終わらなかったサブクエリは待たない（実行中の呼び出しはバックグラウンドで終わる）
+            for future in futures:
+                future.cancel()
+            logger.error(f"時間予算内に終わらなかったサブクエリ: {len(futures) - collected}件")
+            failed += len(futures) - collected
+
+    _store_results(sub_queries, results_by_index, pending, failed, cache)
+    return results_by_index
+
+
+async def retrieve_single_async(client: Any, knowledge_base_id: str, text: str, number_of_results: int,
+                                executor: Executor = None, deadline: Deadline = None,
+                                policy: RetryPolicy = None) -> List[Dict[str, Any]]:
+    """retrieve_single の asyncio 版（API呼び出しは executor で実行し、イベントループをブロックしない）"""
+    call = functools.partial(
+        RETRIEVE_HEDGER.call,
+        functools.partial(client.retrieve, **_retrieve_params(knowledge_base_id, text, number_of_results))
+    )
+    with stage('retrieve'):
+        response = await call_with_retry_async(call, f"サブクエリ検索 '{text}' ", deadline, policy, executor)
+    return response.get('retrievalResults', [])
+
+
+async def fan_out_retrieve_async(client: Any, knowledge_base_id: str, sub_queries: List[SubQuery],
+                                 executor: Executor = None, cache: Any = None,
+                                 deadline: Deadline = None) -> List[Dict[str, Any]]:
+    """fan_out_retrieve の asyncio 版（サブクエリを asyncio.gather で同時に実行）"""
+    import asyncio
+
+    if not sub_queries:
+        return []
+
+    timeout = deadline.remaining() if deadline is not None else None
+    # キャッシュの参照と保存は Redis・SQLite ではブロックするため executor で実行する
+    results_by_index, pending = await run_blocking(executor, _lookup_cached, client, knowledge_base_id,
+                                                   sub_queries, executor, cache)
+    outcomes = await asyncio.gather(
+        *(asyncio.wait_for(
+            retrieve_single_async(client, knowledge_base_id, *sub_queries[index],
+                                  executor=executor, deadline=deadline),
+            timeout
+        ) for index in pending),
+        return_exceptions=True
+    )
+    failed = 0
+    for index, outcome in zip(pending, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error(f"サブクエリ '{sub_queries[index][0]}' の検索に失敗しました: {str(outcome)}")
+            failed += 1
+        else:
+            results_by_index[index] = outcome
+
+    await run_blocking(executor, _store_results, sub_queries, results_by_index, pending, failed, cache)
+    return merge_results(results_by_index)
+
+
+async def run_blocking(executor: Executor, func: Callable[..., Any], *args: Any) -> Any:
+    """ブロックする処理（キャッシュの入出力・CPU処理）を executor で実行する（計測のコンテキストを引き継ぐ）"""
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(contextvars.copy_context().run, func, *args))
+
+
+def _lookup_cached(client: Any, knowledge_base_id: str, sub_queries: List[SubQuery], executor: Executor,
+                   cache: Any) -> Tuple[Dict[int, List[Dict[str, Any]]], List[int]]:
+    """キャッシュ済みのサブクエリの結果と、検索が必要なサブクエリの番号を返す"""
+    results_by_index: Dict[int, List[Dict[str, Any]]] = {}
+    pending = []
+    for index, (text, number_of_results) in enumerate(sub_queries):
+        cached = cache.get(text, number_of_results) if cache is not None else None
+        if cached is None:
+            pending.append(index)
+            continue
+        results_by_index[index] = cached
+        if executor is not None and cache.refresh_due(text, number_of_results):
+            executor.submit(_refresh_pinned, client, knowledge_base_id, cache, text, number_of_results)
+
+    if cache is not None and len(pending) < len(sub_queries):
+        logger.info(f"検索キャッシュヒット: {len(sub_queries) - len(pending)}/{len(sub_queries)}件のサブクエリ")
+    return results_by_index, pending
+
+
+def _store_results(sub_queries: List[SubQuery], results_by_index: Dict[int, List[Dict[str, Any]]],
+                   pending: List[int], failed: int, cache: Any) -> None:
+    """検索した結果をキャッシュに保存し、失敗したサブクエリの件数を記録する"""
+    if cache is not None:
+        for index in pending:
+            if index in results_by_index:
+                cache.set(sub_queries[index][0], sub_queries[index][1], results_by_index[index])
+
+    if failed == len(sub_queries):
+        logger.error("Knowledge Base検索の最大試行回数に達しました")
+    elif failed:
+        logger.warning(f"{failed}/{len(sub_queries)}件のサブクエリが失敗しました。取得できた結果で続行します")
+
+
+def merge_results(results_by_index: Dict[int, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """サブクエリの番号ごとの結果を発行順にマージする"""
+    all_results = []
+    for index in sorted(results_by_index):
+        all_results.extend(results_by_index[index])
+    return all_results
+
+
+def reciprocal_rank_fusion(rankings: List[List[Dict[str, Any]]], k: int = RRF_K) -> List[Dict[str, Any]]:
+    """複数の検索結果の順位を Reciprocal Rank Fusion で統合する
+
+    文書（URI、なければ本文の先頭）ごとに各ランキングでの最上位の順位 r から 1 / (k + r) を合計し、
+    その降順に並べる。合計は全てのランキングで1位だった場合を 1.0 とした rrf_score として付ける
+    （スコアの尺度が異なるベクトル検索とキーワード検索を順位で比べるため）。score は最初のランキング
+    （ベクトル検索の類似度）の値のまま残し、最初のランキングにない文書は類似度がないため 0 とする。
+    同じ文書が複数のランキングにある場合は、先に渡したランキングの結果を使う。
+    """
+    fused: Dict[str, float] = {}
+    representatives: Dict[str, Dict[str, Any]] = {}
+    for position, ranking in enumerate(rankings):
+        seen = set()
+        for rank, result in enumerate(ranking, start=1):
+            key = _fusion_key(result)
+            if key in seen:
+                continue
+            seen.add(key)
+            fused[key] = fused.get(key, 0.0) + 1 / (k + rank)
+            if key not in representatives:
+                representatives[key] = result if position == 0 else dict(result, score=0.0)
+
+    best_possible = len(rankings) / (k + 1)
+    ordered = sorted(fused, key=lambda key: fused[key], reverse=True)
+    return [dict(representatives[key], rrf_score=fused[key] / best_possible) for key in ordered]
+
+
+def rrf_bonus(bonus: float, k: int = RRF_K) -> float:
+    """類似度の尺度のスコアボーナスを rrf_score の尺度に換算する
+
+    1つのランキングでの1位と2位の rrf_score の差（1 / (k + 2)）を類似度の差 1.0 に対応させる。
+    ボーナスは順位の差1つ分より小さくなり、統合後の値がほぼ同じ結果の並びだけを入れ替える。
+    """
+    return bonus / (k + 2)
+
+
+def _fusion_key(result: Dict[str, Any]) -> str:
+    uri = result.get('location', {}).get('s3Location', {}).get('uri')
+    return uri or result.get('content', {}).get('text', '')[:500]
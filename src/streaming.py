@@ -0,0 +1,28 @@
+"""
+ストリーミング回答のServer-Sent Events（SSE）変換
+"""
+
+import json
+from typing import Any, Dict, Iterable, Iterator
+
+# SSEレスポンスのヘッダー（プロキシによるバッファリングを無効化する）
+SSE_HEADERS = {
+    'Content-Type': 'text/event-stream; charset=utf-8',
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+
+def format_sse_event(event: Dict[str, Any]) -> str:
+    """ask_question_stream のイベントを1件のSSEメッセージに変換"""
+    data = {key: value for key, value in event.items() if key != 'type'}
+    return f"event: {event['type']}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def iter_sse(events: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    """イベント列をSSEメッセージ列に変換（途中で失敗した場合はerrorイベントを送って終了）"""
+    try:
+        for event in events:
+            yield format_sse_event(event)
+    except Exception as e:
+        yield format_sse_event({'type': 'error', 'error': '回答の生成に失敗しました', 'detail': str(e)})
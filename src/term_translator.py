@@ -0,0 +1,137 @@
+"""
+日本語-英語の技術用語変換
+
+対訳辞書（既定は同じディレクトリの translation_terms.tsv）から文字単位のトライ木を
+モジュール読み込み時に一度だけ構築し、クエリを1回走査して最長一致した用語を英語に置き換える。
+走査の計算量はクエリ長×最長用語長に比例し、辞書の用語数には依存しない。
+"""
+
+import logging
+import os
+import re
+from typing import Any, Dict, Iterable, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DICTIONARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'translation_terms.tsv')
+
+# 「Activator」「Widget」などの英語単語
+ENGLISH_WORD_PATTERN = re.compile(r'\b[A-Z][a-z]+(?:[A-Z][a-z]+)*\b')
+# 日本語の文字（ひらがな・カタカナ・漢字・全角の記号と英数字）
+JAPANESE_CHAR_PATTERN = re.compile(r'[\u3000-\u30ff\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+# トライ木のノードで、そこまでの文字列が用語として終わることを示すキー（1文字のキーとは衝突しない）
+_TERMINAL = ''
+
+
+class TermTranslator:
+    """最長一致で用語を置き換える変換器"""
+
+    def __init__(self, terms: Iterable[Tuple[str, str]] = ()):
+        self.terms: Dict[str, str] = {}
+        self._root: Dict[str, Any] = {}
+        for source, target in terms:
+            self.add(source, target)
+
+    @classmethod
+    def from_file(cls, path: str) -> 'TermTranslator':
+        """「用語<TAB>訳語」形式の辞書ファイルから構築（空行と # で始まる行は無視）"""
+        translator = cls()
+        with open(path, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.rstrip('\n')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                source, sep, target = line.partition('\t')
+                if not sep or not source:
+                    logger.warning(f"対訳辞書の形式が不正な行をスキップしました: {path}:{line_number}")
+                    continue
+                translator.add(source, target.strip())
+        return translator
+
+    def add(self, source: str, target: str) -> None:
+        """用語を追加（同じ用語は後から追加したものが優先）"""
+        node = self._root
+        for char in source:
+            node = node.setdefault(char, {})
+        node[_TERMINAL] = target
+        self.terms[source] = target
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def translate(self, text: str) -> str:
+        """各位置で最長一致した用語を訳語に置き換える（置き換えた訳語は再照合しない）"""
+        root = self._root
+        length = len(text)
+        output = []
+        copied = 0
+        i = 0
+        while i < length:
+            node = root.get(text[i])
+            if node is None:
+                i += 1
+                continue
+            match_end = -1
+            replacement = None
+            j = i + 1
+            while True:
+                if _TERMINAL in node:
+                    match_end = j
+                    replacement = node[_TERMINAL]
+                if j >= length:
+                    break
+                node = node.get(text[j])
+                if node is None:
+                    break
+                j += 1
+            if match_end < 0:
+                i += 1
+                continue
+            output.append(text[copied:i])
+            output.append(replacement)
+            copied = i = match_end
+        if not output:
+            return text
+        output.append(text[copied:])
+        return ''.join(output)
+
+
+def load_default_translator() -> TermTranslator:
+    """TRANSLATION_TERMS_PATH（未設定なら同梱の辞書）から変換器を構築"""
+    path = os.getenv('TRANSLATION_TERMS_PATH', DEFAULT_DICTIONARY_PATH)
+    try:
+        translator = TermTranslator.from_file(path)
+    except OSError as e:
+        logger.error(f"対訳辞書を読み込めませんでした（用語変換なしで続行）: {path}: {str(e)}")
+        return TermTranslator()
+    logger.info(f"対訳辞書を読み込みました: {len(translator)}語 ({path})")
+    return translator
+
+
+DEFAULT_TRANSLATOR = load_default_translator()
+
+
+def is_english_query(query: str) -> bool:
+    """日本語の文字を含まないクエリか（英語のクエリは翻訳しても検索テキストが変わらない）"""
+    return JAPANESE_CHAR_PATTERN.search(query) is None
+
+
+def translate_query_to_english(query: str, translator: TermTranslator = None) -> str:
+    """日本語クエリの技術用語を英語に置き換え、クエリ中の英語単語を小文字で補う"""
+    if translator is None:
+        translator = DEFAULT_TRANSLATOR
+
+    # 完全一致での変換
+    if query in translator.terms:
+        return translator.terms[query]
+
+    # 部分一致での変換（最長一致）
+    translated_query = translator.translate(query)
+
+    # 英語単語の検出と処理
+    for word in ENGLISH_WORD_PATTERN.findall(query):
+        if word.lower() not in translated_query.lower():
+            translated_query += f" {word.lower()}"
+
+    return translated_query
@@ -84,6 +84,7 @@ resource "aws_iam_policy" "lambda_bedrock" {
         Effect = "Allow"
         Action = [
           "bedrock:InvokeModel",
+          "bedrock:InvokeModelWithResponseStream",
           "bedrock:GetKnowledgeBase",
           "bedrock:Retrieve",
           "bedrock-agent:GetKnowledgeBase",
@@ -224,6 +225,29 @@ resource "aws_lambda_permission" "api_gateway_lambda" {
   source_arn    = "${aws_api_gateway_rest_api.qa_api.execution_arn}/*/*"
 }
 
+# Warm-up ping (keeps an initialized execution environment available)
+resource "aws_cloudwatch_event_rule" "lambda_warmup" {
+  count               = var.lambda_warmup_schedule == "" ? 0 : 1
+  name                = "${local.project_name}-qa-api-warmup"
+  schedule_expression = var.lambda_warmup_schedule
+  tags                = local.tags
+}
+
+resource "aws_cloudwatch_event_target" "lambda_warmup" {
+  count = var.lambda_warmup_schedule == "" ? 0 : 1
+  rule  = aws_cloudwatch_event_rule.lambda_warmup[0].name
+  arn   = aws_lambda_function.qa_api.arn
+}
+
+resource "aws_lambda_permission" "lambda_warmup" {
+  count         = var.lambda_warmup_schedule == "" ? 0 : 1
+  statement_id  = "AllowExecutionFromEventBridgeWarmup"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.qa_api.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.lambda_warmup[0].arn
+}
+
 # API Gateway Deployment
 resource "aws_api_gateway_deployment" "qa_api_deployment" {
   depends_on = [
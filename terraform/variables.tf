@@ -46,4 +46,9 @@ variable "bedrock_model_id" {
   description = "Bedrock model ID for text generation"
   type        = string
   default     = "anthropic.claude-3-5-sonnet-20241022-v2:0"
-}
\ No newline at end of file
+}
+variable "lambda_warmup_schedule" {
+  description = "Schedule expression for Lambda warm-up pings (empty string disables)"
+  type        = string
+  default     = "rate(5 minutes)"
+}
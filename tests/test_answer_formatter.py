@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+回答フォーマット（answer_formatter）のテスト
+"""
+
+import sys
+import os
+import json
+import random
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from answer_formatter import DEGRADED_NOTICE, IncrementalAnswerFormatter, build_extractive_answer, format_answer
+
+# 変換手順を高速化する前の format_answer で生成した入力と期待値の組
+GOLDEN_CASES_PATH = os.path.join(os.path.dirname(__file__), 'golden', 'format_answer_cases.json')
+
+SAMPLE_ANSWERS = [
+    "## サイト内検索の設定\n\nサイト内検索は管理画面から設定できます。設定方法は以下の通りです。\n\n1. 管理画面にログインする\n2. **検索設定**を開く\n3. 対象ページを選択する\n\n**注意**: 反映には数分かかります。",
+    "ウィジェットの表示位置は変更できます。- 右下\n- 左下\n**推奨**: 右下に配置してください。",
+    "コード例です。```\n<script src=\"widget.js\"></script>\n```続けて説明します。",
+    "とても長い説明文が続きます。" * 12,
+    "**重要**:クローラーの設定。次に## 見出しが途中に入る場合。12. 番号\n###  三つのシャープ\n\n\n\n末尾",
+    "   \n  先頭と末尾の空白  \n\n  ",
+    "**閉じていない太字と*単独のアスタリスク",
+]
+
+# 境界をまたぐと壊れやすい記号を多く含む断片
+FUZZ_TOKENS = [
+    '## ', '##', '#', ' ', '\n', '\n\n', '\n\n\n', '。', 'あ', 'ア', '漢', 'a', '1', '12', '3.', '. ',
+    '-', '- ', '**', '*', '**注意**:', '注意', ':', '```', '`', '\t', '　', '設定方法です', 'x' * 30,
+]
+
+
+def feed_in_chunks(text, rng):
+    """テキストをランダムな長さに区切って逐次フォーマットする"""
+    formatter = IncrementalAnswerFormatter()
+    fragments = []
+    pos = 0
+    while pos < len(text):
+        size = rng.randint(1, 8)
+        fragments.append(formatter.feed(text[pos:pos + size]))
+        pos += size
+    fragments.append(formatter.finish())
+    return fragments
+
+
+def load_golden_cases():
+    with open(GOLDEN_CASES_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_format_answer_matches_golden_cases():
+    """フォーマット結果が変更前の実装とバイト単位で一致すること"""
+    for case in load_golden_cases():
+        assert format_answer(case['input']) == case['expected'], repr(case['input'])
+
+
+def test_incremental_matches_golden_cases():
+    rng = random.Random(2)
+    for case in load_golden_cases():
+        assert ''.join(feed_in_chunks(case['input'], rng)) == case['expected'], repr(case['input'])
+
+
+def test_incremental_matches_format_answer_for_samples():
+    rng = random.Random(0)
+    for answer in SAMPLE_ANSWERS:
+        for _ in range(20):
+            assert ''.join(feed_in_chunks(answer, rng)) == format_answer(answer)
+
+
+def test_incremental_matches_format_answer_for_random_text():
+    """記号の組み合わせをランダムに生成して、区切り方によらず一致することを確認"""
+    rng = random.Random(1)
+    for _ in range(3000):
+        text = ''.join(rng.choice(FUZZ_TOKENS) for _ in range(rng.randint(0, 40)))
+        assert ''.join(feed_in_chunks(text, rng)) == format_answer(text), repr(text)
+
+
+def test_fragments_are_emitted_before_finish():
+    """確定した部分は生成完了を待たずに出力されること"""
+    formatter = IncrementalAnswerFormatter()
+    emitted = formatter.feed("## 概要\n\nサイト内検索は便利です。")
+    emitted += formatter.feed("設定は管理画面から行います。\n\n")
+    assert emitted.startswith('<h3>概要</h3>サイト内検索は便利です。')
+
+
+def test_feed_after_finish_is_rejected():
+    formatter = IncrementalAnswerFormatter()
+    formatter.finish()
+    try:
+        formatter.feed('追加')
+    except RuntimeError:
+        return
+    assert False, 'finish() の後の feed() はエラーになるべき'
+
+
+def test_extractive_answer_cuts_excerpts_at_sentence_end():
+    """抜粋は句点で区切り、注意書きと見出し付きのHTMLになること"""
+    context = [
+        {'content': 'ウィジェットは管理画面から設定できます。' * 30, 'score': 0.6},
+        {'content': '', 'score': 0.5},
+        {'content': 'English only text ' * 30, 'score': 0.4},
+    ]
+    answer = build_extractive_answer(context)
+    assert answer.startswith('<strong>注意</strong>:')
+    assert '<h3>関連情報 1</h3>' in answer and '関連情報 2' not in answer
+    assert answer.count('ウィジェットは管理画面から設定できます。') == 15  # 300文字以内の最後の句点で区切る
+    assert answer.endswith('…')  # 句点がない場合は300文字で切る
+    assert build_extractive_answer([]) == format_answer(DEGRADED_NOTICE)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+asyncio 対応の質問応答（async_qa_system）のテスト
+"""
+
+import sys
+import os
+import asyncio
+import io
+import json
+import threading
+import time
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ['ANSWER_CACHE_BACKEND'] = 'none'
+
+from botocore.exceptions import ClientError
+
+import resilience
+from async_qa_system import AsyncBedrockKnowledgeBaseQA
+from bedrock_qa_system import BedrockKnowledgeBaseQA
+from metrics import RequestMetrics
+from qa_cache import AnswerCache, InMemoryCacheBackend, RetrievalCache
+from resilience import RetryPolicy
+from retrieval_fanout import fan_out_retrieve_async
+
+API_DELAY = 0.2
+
+
+class SlowAgentClient:
+    """応答に時間のかかる retrieve のダミー"""
+
+    def retrieve(self, knowledgeBaseId, retrievalQuery, retrievalConfiguration):
+        time.sleep(API_DELAY)
+        text = retrievalQuery['text']
+        return {'retrievalResults': [{
+            'content': {'text': f'{text}の説明'},
+            'score': 0.5,
+            'location': {'s3Location': {'uri': f's3://bucket/_{len(text)}_{text}.html'}},
+            'metadata': {}
+        }]}
+
+
+class SlowRuntimeClient:
+    """応答に時間のかかる invoke_model のダミー"""
+
+    def invoke_model(self, body, modelId, accept, contentType):
+        time.sleep(API_DELAY)
+        return {'body': io.BytesIO(json.dumps({'content': [{'text': '**回答**です。'}]}).encode())}
+
+
+def create_qa():
+    qa = BedrockKnowledgeBaseQA()
+    qa.bedrock_agent_runtime = SlowAgentClient()
+    qa.bedrock_runtime = SlowRuntimeClient()
+    # 生成の呼び出し回数を数えるため、短い回答による大きいモデルでの再生成は行わない
+    qa.model_router.escalation = False
+    return AsyncBedrockKnowledgeBaseQA(qa)
+
+
+def test_concurrent_questions_do_not_block_each_other():
+    """複数の質問が1件分の待ち時間（検索+生成）程度でまとめて処理されること"""
+    async_qa = create_qa()
+
+    async def ask_all():
+        return await asyncio.gather(*(async_qa.ask_question(f'質問{i}') for i in range(8)))
+
+    start = time.perf_counter()
+    results = asyncio.run(ask_all())
+    elapsed = time.perf_counter() - start
+    async_qa.close()
+
+    assert elapsed < API_DELAY * 2 * 3
+    assert all(result['answer'] == '<strong>回答</strong>です。' for result in results)
+    assert all(result['sources'] for result in results)
+
+
+def test_identical_questions_share_one_computation():
+    """処理中の同じ質問（表記揺れを含む）は検索・生成を1回だけ行うこと"""
+    async_qa = create_qa()
+    calls = []
+    original = async_qa.qa_system._invoke_model
+
+    def invoke(query, retrieved_context, route=None):
+        calls.append(query)
+        return original(query, retrieved_context, route)
+
+    async_qa.qa_system._invoke_model = invoke
+
+    async def ask_all():
+        return await asyncio.gather(*(async_qa.ask_question(q) for q in ['ウィジェット', ' ウィジェット', 'ウィジェット']))
+
+    results = asyncio.run(ask_all())
+    async_qa.close()
+    assert calls == ['ウィジェット']
+    assert results[0] is results[1] is results[2]
+
+
+class FlakyClient:
+    def __init__(self):
+        self.calls = 0
+
+    def retrieve(self, knowledgeBaseId, retrievalQuery, retrievalConfiguration):
+        self.calls += 1
+        if retrievalQuery['text'] == 'broken':
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'throttled'}}, 'Retrieve')
+        if retrievalQuery['text'] == 'invalid':
+            raise ClientError({'Error': {'Code': 'ValidationException', 'Message': 'invalid'}}, 'Retrieve')
+        return {'retrievalResults': [{'content': {'text': retrievalQuery['text']}, 'score': 0.5}]}
+
+
+def test_async_fan_out_keeps_successful_sub_queries(monkeypatch):
+    """失敗したサブクエリのリトライ待ちの間もイベントループが動き続けること"""
+    monkeypatch.setattr(resilience, 'DEFAULT_RETRY_POLICY', RetryPolicy(max_attempts=3, base_delay=0.5, max_delay=1))
+    monkeypatch.setattr(resilience.random, 'uniform', lambda low, high: high)
+    client = FlakyClient()
+    ticks = []
+
+    async def ticker():
+        while True:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.1)
+
+    async def run():
+        task = asyncio.ensure_future(ticker())
+        results = await fan_out_retrieve_async(client, 'KB', [('widget', 6), ('broken', 6), ('invalid', 6)])
+        task.cancel()
+        return results
+
+    results = asyncio.run(run())
+    assert [r['content']['text'] for r in results] == ['widget']
+    assert client.calls == 5  # 成功1回 + スロットリングの3回の試行 + 検証エラーの1回（リトライしない）
+    assert len(ticks) >= 10  # リトライ待ち（0.5秒+1秒）の間もティッカーが動いている
+
+
+class ThreadRecordingBackend(InMemoryCacheBackend):
+    """get / set を呼び出したスレッドを記録するキャッシュバックエンド"""
+
+    def __init__(self):
+        super().__init__()
+        self.threads = set()
+
+    def get(self, key):
+        self.threads.add(threading.get_ident())
+        return super().get(key)
+
+    def set(self, key, value, ttl):
+        self.threads.add(threading.get_ident())
+        super().set(key, value, ttl)
+
+
+def test_cache_io_runs_off_the_event_loop():
+    """Redis・SQLite ではブロックするキャッシュの入出力をイベントループのスレッドで行わないこと"""
+    async_qa = create_qa()
+    qa = async_qa.qa_system
+    qa.answer_cache = AnswerCache(ThreadRecordingBackend())
+    qa.retrieval_cache = RetrievalCache(ThreadRecordingBackend(), 'KB')
+
+    async def ask():
+        loop_thread = threading.get_ident()
+        await async_qa.ask_question('ウィジェット')
+        await async_qa.ask_question('ウィジェット')
+        return loop_thread
+
+    loop_thread = asyncio.run(ask())
+    async_qa.close()
+
+    assert qa.answer_cache.stats()['hits'] == 1
+    for backend in (qa.answer_cache.backend, qa.retrieval_cache.backend):
+        assert backend.threads and loop_thread not in backend.threads
+
+
+def test_generation_is_measured_in_the_request_metrics():
+    """executor で実行する回答生成の段・トークン数が呼び出し元のリクエストの計測に記録されること"""
+    async_qa = create_qa()
+    request_metrics = RequestMetrics()
+
+    async def ask():
+        with request_metrics.activate():
+            await async_qa.ask_question('ウィジェット')
+
+    asyncio.run(ask())
+    async_qa.close()
+
+    timings = request_metrics.timings()
+    assert 'prompt_build_ms' in timings and 'invoke_model_ms' in timings
+    assert request_metrics.properties['context_tokens'] > 0
+    assert request_metrics.fan_out >= 1
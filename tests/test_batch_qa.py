@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+一括質問処理（batch_qa）のテスト
+"""
+
+import sys
+import os
+import io
+import json
+import threading
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ['ANSWER_CACHE_BACKEND'] = 'none'
+
+import pytest
+
+from batch_qa import BATCH_MAX_QUESTIONS, ask_questions_batch
+from bedrock_qa_system import BedrockKnowledgeBaseQA
+
+
+class AgentClient:
+    """retrieve の呼び出しを記録するダミー"""
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def retrieve(self, knowledgeBaseId, retrievalQuery, retrievalConfiguration):
+        text = retrievalQuery['text']
+        with self.lock:
+            self.calls.append(text)
+        return {'retrievalResults': [{
+            'content': {'text': f'{text}の説明'},
+            'score': 0.5,
+            'location': {'s3Location': {'uri': f's3://bucket/_{len(self.calls)}_{text}.html'}},
+            'metadata': {}
+        }]}
+
+
+class RuntimeClient:
+    """invoke_model の呼び出し回数を記録するダミー"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def invoke_model(self, body, modelId, accept, contentType):
+        self.calls += 1
+        return {'body': io.BytesIO(json.dumps({'content': [{'text': '回答です。'}]}).encode())}
+
+
+def create_qa():
+    qa = BedrockKnowledgeBaseQA()
+    qa.bedrock_agent_runtime = AgentClient()
+    qa.bedrock_runtime = RuntimeClient()
+    # 生成の呼び出し回数を数えるため、短い回答による大きいモデルでの再生成は行わない
+    qa.model_router.escalation = False
+    return qa
+
+
+def test_duplicates_are_answered_once():
+    qa = create_qa()
+    batch = ask_questions_batch(qa, ['クローラーの設定', ' クローラーの設定 ', 'ウィジェット', ''], max_concurrency=2)
+
+    assert batch['total'] == 4
+    assert batch['unique'] == 2
+    assert qa.bedrock_runtime.calls == 2
+    assert [r['success'] for r in batch['results']] == [True, True, True, False]
+    assert batch['results'][1]['question'] == ' クローラーの設定 '
+    assert batch['results'][1]['answer'] == batch['results'][0]['answer']
+    assert batch['results'][3]['error'] == '質問が空です'
+
+
+def test_identical_sub_queries_are_retrieved_once():
+    """異なる質問でも同じサブクエリ（英語翻訳）は1回だけ検索されること"""
+    qa = create_qa()
+    ask_questions_batch(qa, ['プロキシ設定', 'proxy settings'])
+    assert qa.bedrock_agent_runtime.calls.count('proxy settings') == 1
+
+
+def test_item_errors_do_not_fail_the_batch():
+    qa = create_qa()
+    original = qa._build_sub_queries
+
+    def build_sub_queries(query, max_results):
+        if '失敗' in query:
+            raise RuntimeError('検索に失敗しました')
+        return original(query, max_results)
+
+    qa._build_sub_queries = build_sub_queries
+    batch = ask_questions_batch(qa, ['失敗する質問', 'ウィジェット'])
+    assert batch['results'][0] == {'question': '失敗する質問', 'success': False, 'error': '検索に失敗しました'}
+    assert batch['results'][1]['success']
+
+
+def test_generation_failure_returns_degraded_item():
+    """回答を生成できない質問は抜粋による縮退応答になり、他の質問には影響しないこと"""
+    qa = create_qa()
+    original = qa.generate_answer_with_bedrock
+
+    def generate(query, retrieved_context, deadline=None):
+        if '失敗' in query:
+            raise RuntimeError('生成に失敗しました')
+        return original(query, retrieved_context, deadline)
+
+    qa.generate_answer_with_bedrock = generate
+    batch = ask_questions_batch(qa, ['失敗する質問', 'ウィジェット'])
+    assert batch['results'][0]['success']
+    assert batch['results'][0]['degraded_reason'] == 'generation_failed'
+    assert 'degraded' not in batch['results'][1]
+
+
+def test_too_many_questions_are_rejected():
+    with pytest.raises(ValueError):
+        ask_questions_batch(create_qa(), ['質問'] * (BATCH_MAX_QUESTIONS + 1))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+回答生成の参考情報の組み立て（context_packer）のテスト
+"""
+
+import sys
+import os
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ['ANSWER_CACHE_BACKEND'] = 'none'
+
+from bedrock_qa_system import BedrockKnowledgeBaseQA
+from context_packer import estimate_tokens, pack_context, split_sentences
+
+BOILERPLATE = 'このページではサービスの概要をご案内しています。ご不明な点はサポートまでお問い合わせください。' * 25
+RELEVANT = 'ウィジェットのスクリプトタグは</body>の直前に貼り付けてください。'
+
+
+def sentences(text):
+    return [text[start:end] for start, end in split_sentences(text)]
+
+
+def test_split_sentences_and_estimate_tokens():
+    assert sentences('設定を開きます。保存してください！\n\nOpen settings. Then save.\nv1.5 is required') == [
+        '設定を開きます。', '保存してください！', 'Open settings.', 'Then save.', 'v1.5 is required']
+    assert estimate_tokens('abcdefgh') == 2
+    assert estimate_tokens('設定を開く') == 5
+
+
+def test_relevant_sentence_past_the_old_cutoff_is_included():
+    context = [{'content': BOILERPLATE + RELEVANT, 'score': 0.6}]
+    assert len(BOILERPLATE) > 1000
+
+    text, report = pack_context('ウィジェットのスクリプトタグはどこに貼り付けますか', context, token_budget=120)
+    assert text.startswith('関連情報 1:\n')
+    assert RELEVANT in text
+    assert report[0]['tokens'] <= 120
+    assert 0 < report[0]['sentences'] < report[0]['total_sentences']
+
+
+def test_duplicate_sentences_across_chunks_are_dropped_and_order_is_kept():
+    first = 'プロキシ方式ではサブドメインで配信します。キャッシュは管理画面から削除できます。'
+    second = 'キャッシュは管理画面から削除できます。削除後は数分で反映されます。'
+    text, report = pack_context('キャッシュの削除方法', [{'content': first}, {'content': second}])
+
+    assert text.count('キャッシュは管理画面から削除できます。') == 1
+    assert text == ('関連情報 1:\nプロキシ方式ではサブドメインで配信します。\n\n'
+                    '関連情報 2:\nキャッシュは管理画面から削除できます。削除後は数分で反映されます。')
+    assert [chunk['sentences'] for chunk in report] == [1, 2]
+
+
+def test_gaps_are_marked_and_empty_chunks_are_skipped():
+    content = 'Activatorの概要です。' + '関係のない説明です。' * 5 + 'Activatorの表示設定です。'
+    text, report = pack_context('Activator', [{'content': content}, {'content': 'ほかの文書です。'}], token_budget=22)
+    assert text == '関連情報 1:\nActivatorの概要です。 … Activatorの表示設定です。'
+    assert report[1] == {'index': 1, 'sentences': 0, 'total_sentences': 1, 'tokens': 0}
+
+
+def test_prompt_uses_packed_context():
+    qa = BedrockKnowledgeBaseQA()
+    context = [{'content': BOILERPLATE + RELEVANT, 'score': 0.6}]
+    body = qa._build_request_body('ウィジェットのスクリプトタグはどこに貼り付けますか', context)
+    prompt = body['messages'][0]['content']
+    assert RELEVANT in prompt
+    assert prompt.count('このページではサービスの概要をご案内しています。') <= 1
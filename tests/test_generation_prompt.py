@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+回答生成のプロンプト（generation_prompt）のテスト
+"""
+
+import sys
+import os
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ['ANSWER_CACHE_BACKEND'] = 'none'
+
+from generation_prompt import SYSTEM_PROMPT, build_request_body, record_usage, supports_prompt_cache
+from metrics import RequestMetrics
+
+CACHING_MODEL = 'us.anthropic.claude-3-7-sonnet-20250219-v1:0'
+
+
+def test_static_instructions_go_to_a_cacheable_system_block(monkeypatch):
+    import generation_prompt
+    monkeypatch.setattr(generation_prompt, 'PROMPT_CACHE_MIN_TOKENS', 100)
+    body = build_request_body(CACHING_MODEL, '関連情報 1:\nウィジェットの概要', 'ウィジェットとは')
+    assert body['system'] == [{'type': 'text', 'text': SYSTEM_PROMPT, 'cache_control': {'type': 'ephemeral'}}]
+    assert body['messages'] == [{'role': 'user', 'content': '【参考情報】\n関連情報 1:\nウィジェットの概要\n\n【質問】\nウィジェットとは'}]
+    # 質問や参考情報が変わっても system は同じ（キャッシュの対象がリクエストによらない）
+    assert build_request_body(CACHING_MODEL, 'ほかの情報', 'ほかの質問')['system'] == body['system']
+
+
+def test_cache_control_is_skipped_below_the_cacheable_length():
+    """既定の設定では、指示がキャッシュされる長さに満たないため cache_control を付けないこと"""
+    assert not supports_prompt_cache(CACHING_MODEL)
+    assert build_request_body(CACHING_MODEL, '参考', '質問')['system'] == [{'type': 'text', 'text': SYSTEM_PROMPT}]
+
+
+def test_cache_control_only_for_supported_models():
+    body = build_request_body('anthropic.claude-3-5-sonnet-20241022-v2:0', '参考', '質問')
+    assert body['system'] == [{'type': 'text', 'text': SYSTEM_PROMPT}]
+    assert not supports_prompt_cache('amazon.titan-text-express-v1')
+
+    titan = build_request_body('amazon.titan-text-express-v1', '参考', '質問')
+    assert titan['inputText'].startswith(SYSTEM_PROMPT)
+    assert titan['inputText'].endswith('【質問】\n質問\n\n【回答】')
+
+
+def test_usage_is_accumulated_and_emitted_as_count_metrics():
+    request_metrics = RequestMetrics()
+    with request_metrics.activate():
+        record_usage({'input_tokens': 120, 'cache_creation_input_tokens': 1100, 'output_tokens': 0})
+        record_usage({'output_tokens': 300})
+    assert request_metrics.properties == {'input_tokens': 120, 'cache_write_input_tokens': 1100, 'output_tokens': 300}
+
+    emf = request_metrics.to_emf()
+    counts = [m['Name'] for m in emf['_aws']['CloudWatchMetrics'][0]['Metrics'] if m['Unit'] == 'Count']
+    assert counts == ['input_tokens', 'output_tokens', 'cache_write_input_tokens']
+    assert emf['cache_write_input_tokens'] == 1100
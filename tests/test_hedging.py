@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Bedrock呼び出しのヘッジ（hedging）のテスト
+"""
+
+import sys
+import os
+import threading
+import time
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pytest
+from botocore.exceptions import ClientError
+
+from hedging import Hedger, LatencyTracker
+
+
+def create_hedger(**kwargs):
+    options = dict(percentile=90, budget_ratio=1.0, burst=5, enabled=True, min_samples=5, throttle_cooldown=30)
+    options.update(kwargs)
+    hedger = Hedger('test', **options)
+    for _ in range(50):
+        hedger.latency.record(0.02)
+    return hedger
+
+
+class SlowFirstCall:
+    """最初の呼び出しだけ遅い API のダミー"""
+
+    def __init__(self, slow_seconds=1.0):
+        self.slow_seconds = slow_seconds
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+        if call == 1:
+            time.sleep(self.slow_seconds)
+            return 'slow'
+        return 'fast'
+
+
+def test_latency_percentile():
+    tracker = LatencyTracker()
+    assert tracker.percentile(95) is None
+    for value in range(1, 101):
+        tracker.record(value / 100)
+    assert tracker.percentile(50) == 0.51
+    assert tracker.percentile(95) == 0.96
+
+
+def test_slow_call_is_hedged_and_first_response_wins():
+    hedger = create_hedger()
+    func = SlowFirstCall()
+    start = time.perf_counter()
+    assert hedger.call(func) == 'fast'
+    assert time.perf_counter() - start < 0.5
+    stats = hedger.stats()
+    assert stats['hedged'] == 1
+    assert stats['hedge_wins'] == 1
+
+
+def test_fast_call_is_not_hedged():
+    hedger = create_hedger()
+    calls = []
+    assert hedger.call(lambda: calls.append(1) or 'ok') == 'ok'
+    assert calls == [1]
+    assert hedger.stats()['hedged'] == 0
+
+
+def test_budget_limits_hedges():
+    """予算を使い切ったらヘッジせずに元の呼び出しを待つこと"""
+    hedger = create_hedger(budget_ratio=0.5, burst=1)
+    results = [hedger.call(SlowFirstCall(slow_seconds=0.1)) for _ in range(4)]
+    stats = hedger.stats()
+    assert stats['hedged'] == 2
+    assert stats['budget_denied'] == 2
+    assert results.count('slow') == 2
+
+
+def test_throttling_suspends_hedging():
+    hedger = create_hedger()
+
+    def throttled():
+        raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'slow down'}}, 'Retrieve')
+
+    with pytest.raises(ClientError):
+        hedger.call(throttled)
+    assert hedger.stats()['hedge_delay'] is None
+    assert hedger.call(SlowFirstCall(slow_seconds=0.1)) == 'slow'
+    assert hedger.stats()['hedged'] == 0
+
+
+def test_disabled_hedger_calls_directly():
+    hedger = create_hedger(enabled=False)
+    thread_names = []
+    hedger.call(lambda: thread_names.append(threading.current_thread().name))
+    assert thread_names == [threading.current_thread().name]
+    assert hedger.stats()['calls'] == 0
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+キーワード索引（keyword_index）と検索結果の統合（Reciprocal Rank Fusion）のテスト
+"""
+
+import sys
+import os
+import io
+import json
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ['ANSWER_CACHE_BACKEND'] = 'none'
+
+from bedrock_qa_system import BedrockKnowledgeBaseQA
+from keyword_index import KeywordIndex, html_to_text, split_chunks, tokenize
+from retrieval_fanout import reciprocal_rank_fusion
+
+DOCUMENTS = [
+    {'uri': 's3://bucket/html/_101-activator.html', 'data_source_id': 'VO92FYFPG6',
+     'text': 'Activator はChrome拡張機能です。ツールバーから翻訳を編集できます。'},
+    {'uri': 's3://bucket/html/_102-proxy.html', 'data_source_id': 'VO92FYFPG6',
+     'text': 'プロキシ方式ではサブドメインで翻訳ページを配信します。キャッシュの削除は管理画面から行います。'},
+    {'uri': 's3://bucket/html/_103-error.html', 'data_source_id': 'VO92FYFPG6',
+     'text': 'ERR_TOO_MANY_REDIRECTS が表示される場合はSSLの設定を確認してください。'},
+]
+
+
+def result(uri, score=0.5, text=None):
+    return {'content': {'text': text or uri}, 'score': score,
+            'location': {'s3Location': {'uri': uri}}, 'metadata': {}}
+
+
+def test_tokenize_uses_words_and_japanese_bigrams():
+    assert tokenize('Activator の設定') == ['activator', 'の設', '設定']
+    assert tokenize('API と SDK') == ['api', 'sdk', 'と']
+    assert tokenize('ｷｬｯｼｭ削除') == ['キャ', 'ャッ', 'ッシ', 'シュ', 'ュ削', '削除']
+
+
+def test_html_to_text_drops_markup_and_navigation():
+    html = ('<html><head><title>設定</title><script>var a = 1;</script></head>'
+            '<body><nav>メニュー</nav><h1>ウィジェット</h1><p>設置方法&amp;手順</p></body></html>')
+    assert html_to_text(html) == '設定\nウィジェット\n設置方法&手順'
+
+
+def test_split_chunks_respects_length():
+    chunks = split_chunks('\n'.join(['あ' * 300] * 5) + '\n' + 'い' * 1000, 800)
+    assert all(len(chunk) <= 800 for chunk in chunks)
+    assert ''.join(chunks).replace('\n', '') == 'あ' * 1500 + 'い' * 1000
+
+
+def test_exact_term_search_and_round_trip(tmp_path):
+    path = str(tmp_path / 'keyword_index.bin')
+    KeywordIndex.build(DOCUMENTS).save(path)
+    index = KeywordIndex.load(path)
+
+    results = index.search('ERR_TOO_MANY_REDIRECTS', 3)
+    assert [r['location']['s3Location']['uri'] for r in results] == ['s3://bucket/html/_103-error.html']
+    assert index.search('activator', 3)[0]['metadata']['x-amz-bedrock-kb-data-source-id'] == 'VO92FYFPG6'
+    assert index.search('キャッシュを削除したい', 3)[0]['content']['text'].startswith('プロキシ方式')
+    assert index.search('unknownterm', 3) == []
+
+
+def test_reciprocal_rank_fusion_prefers_results_in_both_rankings():
+    vector = [result('a', 0.9), result('b', 0.8), result('c', 0.7)]
+    keyword = [result('c', 12.0, text='keyword chunk'), result('d', 8.0)]
+    fused = reciprocal_rank_fusion([vector, keyword])
+    assert [r['location']['s3Location']['uri'] for r in fused] == ['c', 'a', 'b', 'd']
+    # 同じ文書はベクトル検索の結果を使い、統合後の値は0〜1に正規化した rrf_score に付ける
+    assert fused[0]['content']['text'] == 'c'
+    assert all(0 < r['rrf_score'] <= 1 for r in fused)
+    assert reciprocal_rank_fusion([[result('a')], [result('a')]])[0]['rrf_score'] == 1.0
+    # score はベクトル検索の類似度のまま（キーワード検索だけの文書は0）
+    assert [r['score'] for r in fused] == [0.7, 0.9, 0.8, 0.0]
+
+
+def sourced(article_id, data_source_id, text):
+    return {'content': {'text': text}, 'score': 0.5, 'location': {'s3Location': {'uri': f's3://bucket/_{article_id}-page.html'}},
+            'metadata': {'x-amz-bedrock-kb-data-source-id': data_source_id}}
+
+
+def test_data_source_bonus_only_breaks_near_ties_after_fusion():
+    """統合後の順位が離れた Confluence の結果はボーナスで上位のヘルプページを追い越さないこと"""
+    texts = [''.join(chr(0x4e00 + seed * 30 + j) for j in range(30)) for seed in range(13)]
+    help_pages = [sourced(100 + i, 'VO92FYFPG6', texts[i]) for i in range(11)]
+    confluence = sourced(200, 'BCI4SYCYPF', texts[11])
+    qa = BedrockKnowledgeBaseQA()
+
+    ranked = qa._rank_results(reciprocal_rank_fusion([help_pages + [confluence], []]), 3)
+    assert [r['article_id'] for r in ranked] == ['100', '101', '102']
+
+    # 順位を入れ替えた2つのランキングで統合後の値が同じ場合は Confluence を先にする
+    tied_help = sourced(300, 'VO92FYFPG6', texts[12])
+    ranked = qa._rank_results(reciprocal_rank_fusion([[tied_help, confluence], [confluence, tied_help]]), 2)
+    assert [r['article_id'] for r in ranked] == ['200', '300']
+
+
+class AgentClient:
+    def retrieve(self, knowledgeBaseId, retrievalQuery, retrievalConfiguration):
+        return {'retrievalResults': [
+            result('s3://bucket/html/_102-proxy.html', 0.6, text='プロキシの概要'),
+            result('s3://bucket/html/_104-widget.html', 0.55, text='ウィジェットの概要'),
+        ]}
+
+
+class RuntimeClient:
+    def invoke_model(self, body, modelId, accept, contentType):
+        return {'body': io.BytesIO(json.dumps({'content': [{'text': '回答です。'}]}).encode())}
+
+
+def test_keyword_only_match_is_fused_into_context():
+    """ベクトル検索で見つからない完全一致の文書が検索結果に加わること"""
+    qa = BedrockKnowledgeBaseQA()
+    qa.bedrock_agent_runtime = AgentClient()
+    qa.bedrock_runtime = RuntimeClient()
+    qa.keyword_index = KeywordIndex.build(DOCUMENTS)
+
+    context = qa.retrieve_from_knowledge_base('ERR_TOO_MANY_REDIRECTS が出る', max_results=3)
+    uris = [item['location']['s3Location']['uri'] for item in context]
+    assert 's3://bucket/html/_103-error.html' in uris
+    assert len(uris) == 3
+    # 回答の信頼度とモデルの振り分けに使う score はベクトル検索の類似度のまま
+    scores = {item['location']['s3Location']['uri']: item['score'] for item in context}
+    assert scores['s3://bucket/html/_102-proxy.html'] == 0.6
+    assert scores['s3://bucket/html/_103-error.html'] == 0.0
+
+
+def test_batch_questions_use_fused_ranking():
+    """一括処理でも単独の質問と同じくキーワード索引の結果が統合されること"""
+    from batch_qa import ask_questions_batch
+
+    qa = BedrockKnowledgeBaseQA()
+    qa.bedrock_agent_runtime = AgentClient()
+    qa.bedrock_runtime = RuntimeClient()
+    qa.keyword_index = KeywordIndex.build(DOCUMENTS)
+
+    batch = ask_questions_batch(qa, ['ERR_TOO_MANY_REDIRECTS が出る'])
+    expected = [item['location']['s3Location']['uri']
+                for item in qa.retrieve_from_knowledge_base('ERR_TOO_MANY_REDIRECTS が出る', max_results=3)]
+    assert [source['uri'] for source in batch['results'][0]['sources']] == expected
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""
+Lambdaハンドラー（lambda_handler）のテスト
+"""
+
+import sys
+import os
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import lambda_handler
+
+
+def test_warmup_events_return_without_initializing(monkeypatch):
+    """ウォームアップ呼び出しではQ&Aシステムの初期化も検索も行わないこと"""
+    def fail():
+        raise AssertionError('ウォームアップで初期化すべきではない')
+
+    monkeypatch.setattr(lambda_handler, 'initialize_qa_system', fail)
+    for event in [{'source': 'aws.events', 'detail-type': 'Scheduled Event'}, {'warmup': True}]:
+        response = lambda_handler.lambda_handler(event, None)
+        assert response == {'statusCode': 200, 'body': '{"warmup": true}'}
+
+
+def test_regular_events_are_not_warmups():
+    assert not lambda_handler.is_warmup_event({'httpMethod': 'POST', 'body': '{"warmup": true}'})
+    assert not lambda_handler.is_warmup_event({'source': 'aws.s3', 'detail-type': 'Scheduled Event'})
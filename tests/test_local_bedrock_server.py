@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Bedrockのローカル代替サーバー（scripts/local_bedrock_server.py）のテスト
+"""
+
+import sys
+import os
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ['ANSWER_CACHE_BACKEND'] = 'none'
+
+import pytest
+from botocore.exceptions import ClientError
+
+from bedrock_qa_system import BedrockKnowledgeBaseQA
+from local_bedrock_server import start_server
+from metrics import RequestMetrics
+from model_router import ModelRouter
+from resilience import RetryPolicy, call_with_retry
+
+FAST_CONFIG = {
+    'retrieve': {'latency_ms': 1, 'latency_sigma': 0},
+    'invoke_model': {'latency_ms': 1, 'latency_sigma': 0, 'tokens_per_second': 100000},
+}
+
+
+@pytest.fixture
+def server():
+    server = start_server(config=FAST_CONFIG, seed=1)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def create_qa(server):
+    qa = BedrockKnowledgeBaseQA(endpoint_url=f"http://127.0.0.1:{server.server_port}")
+    qa.knowledge_base_id = 'LOCAL'
+    return qa
+
+
+def test_ask_question_through_stand_in(server):
+    qa = create_qa(server)
+    result = qa.ask_question('ウィジェットの設置方法を教えてください')
+    assert not result.get('degraded')
+    assert 'ウィジェットの設置方法' in result['retrieved_context'][0]['content']
+    assert result['sources'][0]['uri'].endswith('_1001-widget-installation.html')
+    assert 'これはローカルの代替サーバーが生成した回答です。' in result['answer']
+
+    stats = server.state.stats()
+    # 主クエリの検索結果の確信度が高いため、英語翻訳での検索は省かれる
+    assert stats['retrieve'] == 1 and stats['invoke_model'] == 1
+
+
+def test_stream_uses_event_stream_framing(server):
+    qa = create_qa(server)
+    events = list(qa.ask_question_stream('クローラーを再実行したい'))
+    tokens = [event for event in events if event['type'] == 'token']
+    assert len(tokens) > 10
+    assert events[-1]['type'] == 'done' and not events[-1].get('degraded')
+    assert 'ローカルの代替サーバー' in ''.join(event['text'] for event in tokens)
+    assert events[-1]['answer'] == ''.join(event['html'] for event in events[1:])
+    assert server.state.stats()['invoke_model_stream'] == 1
+
+
+def test_injected_throttling_is_a_throttling_exception(server):
+    server.state.update_config({'retrieve': {'throttle_rate': 1.0}})
+    qa = create_qa(server)
+    with pytest.raises(ClientError) as error:
+        call_with_retry(lambda: qa.bedrock_agent_runtime.retrieve(
+            knowledgeBaseId='LOCAL', retrievalQuery={'text': 'proxy'},
+            retrievalConfiguration={'vectorSearchConfiguration': {'numberOfResults': 3}}
+        ), 'テスト', policy=RetryPolicy(max_attempts=2, base_delay=0.01, max_delay=0.01))
+    assert error.value.response['Error']['Code'] == 'ThrottlingException'
+    assert server.state.stats()['throttled'] == 2
+
+
+def test_injected_errors_degrade_the_answer(server):
+    server.state.update_config({'invoke_model': {'error_rate': 1.0}})
+    qa = create_qa(server)
+    result = qa.ask_question('プロキシのキャッシュを削除する方法')
+    assert result['degraded'] and result['degraded_reason'] == 'generation_failed'
+    assert server.state.stats()['errors'] >= 1
+
+
+def test_prompt_cache_usage_is_recorded(server, monkeypatch):
+    """cache_control を付けた system は2回目以降キャッシュから読まれ、使用量が計測値に加算されること"""
+    import generation_prompt
+    # 既定の指示はキャッシュされる長さに満たないため、閾値を下げて cache_control を付ける
+    monkeypatch.setattr(generation_prompt, 'PROMPT_CACHE_MIN_TOKENS', 100)
+    qa = create_qa(server)
+    qa.model_router = ModelRouter('us.anthropic.claude-3-7-sonnet-20250219-v1:0', enabled=False)
+    context = qa.retrieve_from_knowledge_base('ウィジェットの設置方法')
+
+    usages = []
+    for query in ['ウィジェットの設置方法', 'ウィジェットの表示位置']:
+        request_metrics = RequestMetrics()
+        with request_metrics.activate():
+            qa.generate_answer_with_bedrock(query, context)
+        usages.append(request_metrics.properties)
+
+    assert usages[0]['cache_write_input_tokens'] > 0 and 'cache_read_input_tokens' not in usages[0]
+    assert usages[1]['cache_read_input_tokens'] == usages[0]['cache_write_input_tokens']
+    assert usages[1]['input_tokens'] > 0 and usages[1]['output_tokens'] > 0
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+処理時間の計測（metrics）のテスト
+"""
+
+import sys
+import os
+import io
+import json
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ['ANSWER_CACHE_BACKEND'] = 'none'
+
+import lambda_handler
+import metrics
+from bedrock_qa_system import BedrockKnowledgeBaseQA
+from metrics import RequestMetrics, annotate, stage
+
+
+class AgentClient:
+    def retrieve(self, knowledgeBaseId, retrievalQuery, retrievalConfiguration):
+        text = retrievalQuery['text']
+        return {'retrievalResults': [{
+            'content': {'text': f'{text}の説明です。'},
+            'score': 0.5,
+            'location': {'s3Location': {'uri': f's3://bucket/_{len(text)}_{text}.html'}},
+            'metadata': {}
+        }]}
+
+
+class RuntimeClient:
+    def invoke_model(self, body, modelId, accept, contentType):
+        return {'body': io.BytesIO(json.dumps({'content': [{'text': '**回答**です。'}]}).encode())}
+
+
+def test_stage_is_noop_without_active_request():
+    with stage('translate'):
+        pass
+    annotate(cache_hit=True)
+    assert metrics.current() is None
+
+
+def test_emf_record_lists_stages_with_dimensions():
+    request_metrics = RequestMetrics()
+    with request_metrics.activate():
+        for _ in range(2):
+            with stage('retrieve'):
+                pass
+        with stage('invoke_model'):
+            pass
+        annotate(fan_out=2, degraded_reason='deadline')
+
+    record = request_metrics.to_emf()
+    definition = record['_aws']['CloudWatchMetrics'][0]
+    assert definition['Dimensions'] == [['Operation', 'CacheHit', 'FanOut']]
+    assert {m['Name'] for m in definition['Metrics']} == {'retrieve', 'invoke_model', 'total'}
+    assert len(record['retrieve']) == 2 and isinstance(record['invoke_model'], float)
+    assert record['FanOut'] == '2' and record['CacheHit'] == 'false'
+    assert record['degraded_reason'] == 'deadline'
+
+
+def test_handler_returns_stage_timings_in_debug_mode(monkeypatch, capsys):
+    qa = BedrockKnowledgeBaseQA()
+    qa.bedrock_agent_runtime = AgentClient()
+    qa.bedrock_runtime = RuntimeClient()
+    monkeypatch.setattr(lambda_handler, 'qa_system', qa)
+    monkeypatch.setattr(metrics, 'METRICS_EMF_ENABLED', True)
+
+    event = {'httpMethod': 'POST', 'body': json.dumps({'question': 'ウィジェットの設定', 'debug': True})}
+    response = lambda_handler.lambda_handler(event, None)
+    body = json.loads(response['body'])
+    for name in ['translate', 'retrieve', 'fan_out', 'rerank', 'prompt_build', 'invoke_model', 'format_answer']:
+        assert f'{name}_ms' in body['timings']
+    assert body['timings']['retrieve_count'] == 2  # 元のクエリと英語翻訳
+    assert body['cache_hit'] is False
+
+    emf = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert emf['Operation'] == 'ask' and emf['FanOut'] == '2'
+    assert 'serialize' in emf
+
+    # debug を指定しない場合は処理時間を返さない
+    event['body'] = json.dumps({'question': 'ウィジェットの設定'})
+    assert 'timings' not in json.loads(lambda_handler.lambda_handler(event, None)['body'])
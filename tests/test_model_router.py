@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+回答生成のモデルの振り分け（model_router）のテスト
+"""
+
+import sys
+import os
+import io
+import json
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ['ANSWER_CACHE_BACKEND'] = 'none'
+
+from bedrock_qa_system import BedrockKnowledgeBaseQA
+from metrics import RequestMetrics
+from model_router import ModelRouter, looks_weak
+
+LARGE_MODEL = 'anthropic.claude-3-5-sonnet-20241022-v2:0'
+FAST_MODEL = 'anthropic.claude-3-haiku-20240307-v1:0'
+LONG_ANSWER = 'ウィジェットは管理画面の「設定」から設置できます。スクリプトタグを</body>の直前に貼り付けてください。'
+
+
+def context(*scores):
+    return [{'content': f'情報{i}', 'score': score} for i, score in enumerate(scores)]
+
+
+def route_of(query, retrieved_context):
+    route, reason = ModelRouter(LARGE_MODEL, FAST_MODEL, enabled=True).choose(query, retrieved_context)
+    return route.name, reason
+
+
+def test_choose_route():
+    assert route_of('こんにちは', []) == ('fast', 'small_talk')
+    assert route_of('Thank you!', []) == ('fast', 'small_talk')
+    assert route_of('ウィジェットの設置方法', context(0.9, 0.6)) == ('fast', 'clear_top_result')
+    assert route_of('ウィジェットの設置方法', context(0.7, 0.68)) == ('fast', 'short_query')
+    assert route_of('プロキシ方式とJavaScript方式の違い', context(0.9, 0.6)) == ('large', 'complex_intent')
+    assert route_of('翻訳ページが表示されない', context(0.9)) == ('large', 'complex_intent')
+    assert route_of('ウィジェットの設置方法', context(0.45, 0.3)) == ('large', 'low_score')
+    assert route_of('サイト内検索で翻訳後のページも検索対象にしたいのですが、設定画面のどこで指定できますか',
+                    context(0.9)) == ('large', 'long_query')
+    assert route_of('サイト内検索で翻訳後のページも検索対象にする方法', context(0.7, 0.68)) == ('large', 'ambiguous')
+    # 小さいモデルが大きいモデルと同じ場合は振り分けない
+    assert ModelRouter(LARGE_MODEL, LARGE_MODEL, enabled=True).choose('こんにちは', [])[1] == 'disabled'
+
+
+def test_looks_weak():
+    assert looks_weak('回答です。')
+    assert looks_weak(LONG_ANSWER + '参考情報には料金についての記載がありません。')
+    assert not looks_weak(LONG_ANSWER)
+
+
+class RuntimeClient:
+    """モデルごとの回答を返す bedrock-runtime の代わり（呼び出されたモデルを記録する）"""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.models = []
+
+    def invoke_model(self, body, modelId, accept, contentType):
+        self.models.append((modelId, json.loads(body)['max_tokens']))
+        text = self.answers[modelId]
+        return {'body': io.BytesIO(json.dumps({
+            'content': [{'text': text}], 'usage': {'input_tokens': 100, 'output_tokens': len(text)},
+        }).encode())}
+
+
+def create_qa(answers):
+    qa = BedrockKnowledgeBaseQA()
+    qa.model_router = ModelRouter(LARGE_MODEL, FAST_MODEL, enabled=True, escalation=True)
+    qa.bedrock_runtime = RuntimeClient(answers)
+    return qa
+
+
+def test_easy_question_uses_fast_model_with_lower_max_tokens():
+    qa = create_qa({FAST_MODEL: LONG_ANSWER})
+    request_metrics = RequestMetrics()
+    with request_metrics.activate():
+        assert qa.generate_answer_with_bedrock('ウィジェットの設置方法', context(0.9, 0.6)) == LONG_ANSWER
+
+    assert qa.bedrock_runtime.models == [(FAST_MODEL, qa.model_router.fast.max_tokens)]
+    assert qa.model_router.fast.max_tokens < qa.model_router.large.max_tokens
+    emf = request_metrics.to_emf()
+    assert emf['ModelRoute'] == 'fast'
+    assert ['Operation', 'ModelRoute'] in emf['_aws']['CloudWatchMetrics'][0]['Dimensions']
+    assert emf['output_tokens'] == len(LONG_ANSWER)
+
+
+def test_weak_fast_answer_is_escalated_to_large_model():
+    qa = create_qa({FAST_MODEL: '情報が見つかりません。', LARGE_MODEL: LONG_ANSWER})
+    request_metrics = RequestMetrics()
+    with request_metrics.activate():
+        assert qa.generate_answer_with_bedrock('ウィジェットの設置方法', context(0.9, 0.6)) == LONG_ANSWER
+
+    assert [model for model, _ in qa.bedrock_runtime.models] == [FAST_MODEL, LARGE_MODEL]
+    assert request_metrics.model_route == 'escalated'
+    assert request_metrics.timings()['invoke_model_count'] == 2
+
+
+def test_hard_question_goes_straight_to_large_model():
+    qa = create_qa({LARGE_MODEL: LONG_ANSWER})
+    qa.generate_answer_with_bedrock('プロキシ方式とJavaScript方式の違い', context(0.9, 0.6))
+    assert qa.bedrock_runtime.models == [(LARGE_MODEL, 1000)]
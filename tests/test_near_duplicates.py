@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+検索結果の近似重複の除去（near_duplicates）のテスト
+"""
+
+import sys
+import os
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ['ANSWER_CACHE_BACKEND'] = 'none'
+
+from bedrock_qa_system import BedrockKnowledgeBaseQA
+from near_duplicates import fingerprint, select_diverse, similarity
+
+BODY = ('ウィジェットを設置するには、管理画面の「設定」から埋め込みコードをコピーし、'
+        'サイトの全ページの</body>の直前に貼り付けてください。貼り付け後、公開中のページを再読み込みすると'
+        '言語切り替えボタンが表示されます。表示されない場合はブラウザのキャッシュを削除してください。') * 3
+OTHER = ('クローラーは公開中のページを巡回して翻訳対象の文章を収集します。巡回の対象外にしたいページは、'
+         '除外設定にURLのパターンを追加してください。設定の変更は次回の巡回から反映されます。') * 3
+
+
+def item(content, score, article_id):
+    return {'content': content, 'score': score, 'article_id': article_id}
+
+
+def test_similarity():
+    assert similarity(fingerprint(BODY), fingerprint(BODY)) == 1.0
+    # 見出しだけが異なる本文・一方がもう一方に含まれる本文は重複とみなす
+    assert similarity(fingerprint('## ウィジェットの設置\n' + BODY), fingerprint('ヘルプ | ' + BODY)) >= 0.8
+    assert similarity(fingerprint(BODY), fingerprint(BODY[:len(BODY) // 2])) >= 0.8
+    assert similarity(fingerprint(BODY), fingerprint(OTHER)) < 0.3
+    assert similarity(fingerprint(''), fingerprint(BODY)) == 0.0
+
+
+def test_select_diverse_drops_near_duplicates():
+    candidates = [item(BODY, 0.9, '1'), item('ヘルプ | ' + BODY, 0.85, '2'), item(OTHER, 0.5, '3')]
+    assert [c['article_id'] for c in select_diverse(candidates, 3)] == ['1', '3']
+    # 選択済みの結果と重複する候補も除く
+    assert [c['article_id'] for c in select_diverse(candidates[1:], 2, selected=candidates[:1])] == ['3']
+
+
+def test_mmr_prefers_diverse_results():
+    # 前半が BODY、後半が OTHER の一部と同じ本文
+    half = BODY[:len(BODY) // 6] + OTHER[:len(OTHER) // 6]
+    candidates = [item(BODY, 0.9, '1'), item(half, 0.8, '2'), item(OTHER, 0.75, '3')]
+    assert [c['article_id'] for c in select_diverse(candidates, 2, mmr_lambda=1.0)] == ['1', '2']
+    assert [c['article_id'] for c in select_diverse(candidates, 2, mmr_lambda=0.5)] == ['1', '3']
+
+
+def result(content, score, uri, data_source_id='VO92FYFPG6'):
+    return {'content': {'text': content}, 'score': score, 'location': {'s3Location': {'uri': uri}},
+            'metadata': {'x-amz-bedrock-kb-data-source-id': data_source_id}}
+
+
+def test_rank_results_keeps_best_copy_across_data_sources():
+    qa = BedrockKnowledgeBaseQA()
+    results = qa._rank_results([
+        result('ヘルプセンター\n' + BODY, 0.8, 's3://bucket/_1001-widget.html'),
+        result('Confluence\n' + BODY, 0.75, 's3://bucket/_2001-widget.html', 'BCI4SYCYPF'),
+        result(OTHER, 0.6, 's3://bucket/_1002-crawler.html'),
+    ], 3)
+    assert [r['article_id'] for r in results] == ['2001', '1002']
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+回答キャッシュ（qa_cache）のテスト
+"""
+
+import sys
+import os
+import threading
+import time
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from qa_cache import (
+    AnswerCache,
+    CacheBackend,
+    CoalescedCallTimeout,
+    InMemoryCacheBackend,
+    RetrievalCache,
+    SingleFlight,
+    SQLiteCacheBackend,
+    create_retrieval_cache,
+    make_cache_key,
+)
+from resilience import Deadline
+from retrieval_fanout import fan_out_retrieve
+
+RESULT = {'answer': '回答です', 'sources': [{'uri': 's3://bucket/a.html', 'score': 0.8}], 'confidence': 0.8}
+
+
+def test_cache_key_is_stable_and_normalized():
+    """キーがプロセスに依存せず、表記揺れを吸収すること"""
+    key = make_cache_key('サイト内検索について教えて', 'KB:model')
+    assert key == make_cache_key('  サイト内検索について教えて ', 'KB:model')
+    assert make_cache_key('ＡＰＩ  Key', 'ns') == make_cache_key('api key', 'ns')
+    assert key != make_cache_key('サイト内検索について教えて', 'OTHER:model')
+    assert len(key) == 64
+
+
+def test_memory_backend_lru_eviction_by_bytes():
+    """バイト数の上限を超えたら最も古く参照されたエントリから削除されること"""
+    backend = InMemoryCacheBackend(max_bytes=300)
+    backend.set('a', b'x' * 100, 60)
+    backend.set('b', b'x' * 100, 60)
+    assert backend.get('a') is not None  # aを最近参照済みにする
+    backend.set('c', b'x' * 100, 60)
+    assert backend.get('b') is None
+    assert backend.get('a') is not None
+    assert backend.get('c') is not None
+    assert backend.stats()['evictions'] == 1
+
+
+def test_memory_backend_ttl():
+    backend = InMemoryCacheBackend()
+    backend.set('a', b'value', 0.01)
+    time.sleep(0.02)
+    assert backend.get('a') is None
+
+
+def test_answer_cache_counters_and_negative_ttl():
+    cache = AnswerCache(InMemoryCacheBackend(), namespace='KB', ttl=60, negative_ttl=0.01)
+    assert cache.get('質問') is None
+    cache.set('質問', RESULT)
+    assert cache.get('質問') == RESULT
+    cache.set('情報なし', {'answer': 'なし', 'sources': [], 'confidence': 0}, negative=True)
+    time.sleep(0.02)
+    assert cache.get('情報なし') is None
+
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+    assert stats['negative_sets'] == 1
+    assert stats['hit_ratio'] == 1 / 3
+
+
+def test_sqlite_backend_shared_between_instances(tmp_path):
+    """同じファイルを使う別インスタンス（別ワーカー相当）でキャッシュを共有できること"""
+    path = str(tmp_path / 'cache.sqlite3')
+    writer = AnswerCache(SQLiteCacheBackend(path), namespace='KB')
+    reader = AnswerCache(SQLiteCacheBackend(path), namespace='KB')
+    writer.set('サイト内検索について教えて', RESULT)
+    assert reader.get('サイト内検索について教えて') == RESULT
+
+
+def test_sqlite_backend_eviction(tmp_path):
+    backend = SQLiteCacheBackend(str(tmp_path / 'cache.sqlite3'), max_bytes=300)
+    backend.set('a', b'x' * 100, 60)
+    backend.set('b', b'x' * 100, 60)
+    backend.set('c', b'x' * 100, 60)
+    assert backend.get('a') is None
+    assert backend.stats()['bytes'] <= 300
+
+
+def test_thread_safe_access():
+    cache = AnswerCache(InMemoryCacheBackend(max_bytes=4096))
+
+    def worker(n):
+        for i in range(200):
+            cache.set(f'質問{n}-{i % 20}', RESULT)
+            cache.get(f'質問{n}-{i % 20}')
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == 1600
+    assert stats['bytes'] <= 4096
+
+
+class CountingClient:
+    """retrieveの呼び出し回数を記録するダミークライアント"""
+
+    def __init__(self):
+        self.calls = []
+
+    def retrieve(self, knowledgeBaseId, retrievalQuery, retrievalConfiguration):
+        self.calls.append(retrievalQuery['text'])
+        return {'retrievalResults': [{'content': {'text': retrievalQuery['text']}, 'score': 0.5}]}
+
+
+def test_retrieval_cache_skips_cached_sub_queries():
+    client = CountingClient()
+    cache = RetrievalCache(InMemoryCacheBackend(), 'KB', pinned_queries=['crawler trigger'])
+    sub_queries = [('クローラーの設定', 6), ('crawler trigger', 9)]
+
+    first = fan_out_retrieve(client, 'KB', sub_queries, cache=cache)
+    second = fan_out_retrieve(client, 'KB', [('別の質問', 6), ('crawler trigger', 9)], cache=cache)
+
+    assert client.calls == ['クローラーの設定', 'crawler trigger', '別の質問']
+    assert [r['content']['text'] for r in first] == ['クローラーの設定', 'crawler trigger']
+    assert [r['content']['text'] for r in second] == ['別の質問', 'crawler trigger']
+    assert cache.stats()['pinned_hits'] == 1
+
+
+def test_retrieval_cache_depth_is_part_of_key():
+    cache = RetrievalCache(InMemoryCacheBackend(), 'KB')
+    cache.set('widget', 6, [{'score': 1}])
+    assert cache.get('widget', 6) == [{'score': 1}]
+    assert cache.get('widget', 9) is None
+
+
+def test_retrieval_cache_invalidation_is_shared(tmp_path):
+    """同期完了時の無効化が同じバックエンドを使う他プロセスにも反映されること"""
+    path = str(tmp_path / 'retrieval.sqlite3')
+    worker = RetrievalCache(SQLiteCacheBackend(path), 'KB', pinned_queries=['crawler trigger'])
+    worker.set('widget', 6, [{'score': 1}])
+    worker.set('crawler trigger', 9, [{'score': 2}])
+
+    RetrievalCache(SQLiteCacheBackend(path), 'KB').invalidate()
+    worker.marker._checked_at = float('-inf')  # 世代確認の間隔を待たずに再確認させる
+
+    assert worker.get('widget', 6) is None
+    assert worker.get('crawler trigger', 9) is None
+
+
+def test_retrieval_cache_generation_survives_eviction(tmp_path):
+    """エントリがLRUで削除されても世代マーカーは残り、無効化前のエントリが再び返らないこと"""
+    for backend in (InMemoryCacheBackend(max_bytes=400), SQLiteCacheBackend(str(tmp_path / 'r.sqlite3'), max_bytes=400)):
+        cache = RetrievalCache(backend, 'KB')
+        cache.set('widget', 6, [{'score': 1}])
+        cache.invalidate()
+        generation = cache.generation()
+        for i in range(20):
+            cache.set(f'query {i}', 6, [{'score': i}])
+        cache.marker._checked_at = float('-inf')
+        assert cache.generation() == generation
+        assert cache.get('widget', 6) is None
+
+
+def test_retrieval_cache_missing_marker_starts_new_generation(tmp_path):
+    """世代マーカーがない場合は既定の世代ではなく新しい世代を使うこと"""
+    path = str(tmp_path / 'retrieval.sqlite3')
+    backend = SQLiteCacheBackend(path)
+    cache = RetrievalCache(backend, 'KB')
+    old_generation = cache.generation()
+    cache.set('widget', 6, [{'score': 1}])
+    backend._conn.execute('DELETE FROM markers')
+
+    worker = RetrievalCache(SQLiteCacheBackend(path), 'KB')
+    assert worker.generation() not in ('0', old_generation)
+    assert worker.get('widget', 6) is None
+
+
+def test_pinned_refresh_due_once():
+    cache = RetrievalCache(InMemoryCacheBackend(), 'KB', pinned_queries=['proxy configuration'],
+                           pinned_refresh_interval=0)
+    cache.set('proxy configuration', 6, [])
+    assert cache.refresh_due('proxy configuration', 6)
+    assert not cache.refresh_due('proxy configuration', 6)
+    cache.finish_refresh('proxy configuration', 6)
+    assert cache.refresh_due('proxy configuration', 6)
+
+
+def test_backend_missing_a_method_fails_at_construction():
+    class IncompleteBackend(CacheBackend):
+        def get(self, key):
+            return None
+
+        def set(self, key, value, ttl):
+            pass
+
+    try:
+        IncompleteBackend()
+    except TypeError:
+        pass
+    else:
+        assert False, 'マーカー・削除の実装がないバックエンドは作成時に失敗するべき'
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    """同じキーの同時呼び出しは1回だけ実行され、結果を共有すること"""
+    flight = SingleFlight()
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return RESULT
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('質問', compute))) for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while flight.stats()['coalesced'] < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [RESULT] * 5
+    assert flight.stats() == {'leaders': 1, 'coalesced': 4, 'in_flight': 0}
+
+    # 完了後の呼び出しは改めて実行される
+    flight.do('質問', compute)
+    assert len(calls) == 2
+
+
+def test_single_flight_shares_exceptions():
+    flight = SingleFlight()
+
+    def fail():
+        raise RuntimeError('throttled')
+
+    try:
+        flight.do('質問', fail)
+    except RuntimeError:
+        pass
+    else:
+        assert False, '例外が呼び出し元に伝わるべき'
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_single_flight_follower_waits_only_for_its_deadline():
+    """リーダーが終わらない場合、待つ側は自分の時間予算で打ち切られること"""
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    leader = threading.Thread(target=lambda: flight.do('質問', lambda: started.set() or release.wait(5)))
+    leader.start()
+    started.wait(5)
+
+    start = time.perf_counter()
+    try:
+        flight.do('質問', lambda: RESULT, Deadline(0.1))
+    except CoalescedCallTimeout:
+        pass
+    else:
+        assert False, '時間予算を過ぎたら待つのをやめるべき'
+    assert time.perf_counter() - start < 1
+    release.set()
+    leader.join()
+
+
+def test_answer_cache_invalidation_is_shared(tmp_path):
+    """Knowledge Base の同期完了時の無効化が、同じバックエンドを使う他プロセスの回答キャッシュにも反映されること"""
+    path = str(tmp_path / 'answer.sqlite3')
+    worker = AnswerCache(SQLiteCacheBackend(path), namespace='KB:model', knowledge_base_id='KB')
+    worker.set('ウィジェットとは', {'answer': '古い回答'})
+    assert worker.get('ウィジェットとは') == {'answer': '古い回答'}
+
+    assert AnswerCache(SQLiteCacheBackend(path), knowledge_base_id='KB').invalidate() is not None
+    worker.marker._checked_at = float('-inf')
+    assert worker.get('ウィジェットとは') is None
+
+
+def test_pinned_queries_can_be_configured(monkeypatch):
+    """拡張クエリが固定でない bedrock_qa_system でも、環境変数で常駐させる検索を指定できること"""
+    monkeypatch.setenv('RETRIEVAL_CACHE_BACKEND', 'memory')
+    monkeypatch.setenv('RETRIEVAL_CACHE_PINNED_QUERIES', 'widget settings, crawler trigger ,')
+    cache = create_retrieval_cache('KB', pinned_queries=['proxy configuration'])
+    assert cache.pinned_queries == {'widget settings', 'crawler trigger', 'proxy configuration'}
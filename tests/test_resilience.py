@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+リトライと時間予算（resilience）のテスト
+"""
+
+import sys
+import os
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ['ANSWER_CACHE_BACKEND'] = 'none'
+
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from bedrock_qa_system import BedrockKnowledgeBaseQA
+from qa_cache import AnswerCache, InMemoryCacheBackend
+from resilience import CircuitBreaker, Deadline, DeadlineExceeded, RetryPolicy, call_with_retry, is_retryable
+from retrieval_fanout import fan_out_retrieve
+
+FAST_POLICY = RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.02)
+
+
+def client_error(code, status=400):
+    return ClientError({'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}},
+                       'InvokeModel')
+
+
+def test_only_throttling_and_transient_errors_are_retryable():
+    """スロットリング・一時的な障害だけをリトライ対象とすること"""
+    assert is_retryable(client_error('ThrottlingException', 429))
+    assert is_retryable(client_error('ServiceUnavailableException', 503))
+    assert is_retryable(client_error('SomethingNew', 500))
+    assert is_retryable(EndpointConnectionError(endpoint_url='https://bedrock'))
+    assert not is_retryable(client_error('ValidationException'))
+    assert not is_retryable(client_error('AccessDeniedException', 403))
+    assert not is_retryable(ValueError('bad'))
+
+
+def test_call_with_retry_retries_until_success():
+    attempts = []
+
+    def func():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise client_error('ThrottlingException', 429)
+        return 'ok'
+
+    assert call_with_retry(func, 'テスト', policy=FAST_POLICY) == 'ok'
+    assert len(attempts) == 3
+
+
+def test_call_with_retry_does_not_retry_validation_errors():
+    attempts = []
+
+    def func():
+        attempts.append(1)
+        raise client_error('ValidationException')
+
+    with pytest.raises(ClientError):
+        call_with_retry(func, 'テスト', policy=FAST_POLICY)
+    assert len(attempts) == 1
+
+
+def test_call_with_retry_stops_at_max_attempts():
+    attempts = []
+
+    def func():
+        attempts.append(1)
+        raise client_error('ThrottlingException', 429)
+
+    with pytest.raises(ClientError):
+        call_with_retry(func, 'テスト', policy=FAST_POLICY)
+    assert len(attempts) == 3
+
+
+def test_call_with_retry_does_not_sleep_past_deadline(monkeypatch):
+    """待つと期限を過ぎる場合はリトライせずにすぐ失敗すること"""
+    import resilience
+    monkeypatch.setattr(resilience.random, 'uniform', lambda low, high: high)
+    attempts = []
+
+    def func():
+        attempts.append(1)
+        raise client_error('ThrottlingException', 429)
+
+    start = time.perf_counter()
+    with pytest.raises(ClientError):
+        call_with_retry(func, 'テスト', deadline=Deadline(0.2), policy=RetryPolicy(max_attempts=5, base_delay=10, max_delay=10))
+    assert time.perf_counter() - start < 0.1
+    assert len(attempts) == 1
+
+
+def test_expired_deadline_skips_the_call():
+    with pytest.raises(DeadlineExceeded):
+        call_with_retry(lambda: 'ok', 'テスト', deadline=Deadline(0))
+
+
+def test_slow_attempt_is_cut_at_deadline():
+    """1回の試行がクライアントのタイムアウトより前に時間予算で打ち切られること（同期・非同期）"""
+    import asyncio
+    from resilience import call_with_retry_async
+
+    release = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def hang():
+        release.wait(5)
+        return 'late'
+
+    try:
+        start = time.perf_counter()
+        with pytest.raises(DeadlineExceeded):
+            call_with_retry(hang, '遅い呼び出し', Deadline(0.2))
+        with pytest.raises(DeadlineExceeded):
+            asyncio.run(call_with_retry_async(hang, '遅い呼び出し', Deadline(0.2), executor=executor))
+        assert time.perf_counter() - start < 1.0
+    finally:
+        release.set()
+        executor.shutdown(wait=False)
+    assert call_with_retry(lambda: 'ok', '速い呼び出し', Deadline(0.2)) == 'ok'
+
+
+def test_deadline_from_lambda_context_keeps_reserve():
+    class Context:
+        def get_remaining_time_in_millis(self):
+            return 5000
+
+    assert 3.5 < Deadline.from_lambda_context(Context()).remaining() <= 4.0
+    assert Deadline.from_lambda_context(None).remaining() > 4.0
+
+
+class HangingClient:
+    """1つのサブクエリだけ応答が返らない retrieve のダミー"""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def retrieve(self, knowledgeBaseId, retrievalQuery, retrievalConfiguration):
+        text = retrievalQuery['text']
+        if text == 'slow':
+            self.release.wait(5)
+        return {'retrievalResults': [{'content': {'text': text}, 'score': 0.5}]}
+
+
+def test_fan_out_returns_partial_results_at_deadline():
+    """期限までに終わらなかったサブクエリを待たずに、取得できた結果を返すこと"""
+    client = HangingClient()
+    executor = ThreadPoolExecutor(max_workers=2)
+    start = time.perf_counter()
+    results = fan_out_retrieve(client, 'KB', [('fast', 6), ('slow', 6)], executor=executor, deadline=Deadline(0.3))
+    elapsed = time.perf_counter() - start
+    client.release.set()
+    executor.shutdown()
+
+    assert [r['content']['text'] for r in results] == ['fast']
+    assert elapsed < 1
+
+
+class RejectingRuntimeClient:
+    def __init__(self):
+        self.calls = 0
+
+    def invoke_model(self, body, modelId, accept, contentType):
+        self.calls += 1
+        raise client_error('ValidationException')
+
+
+class ThrottledOnceRuntimeClient:
+    def __init__(self):
+        self.calls = 0
+
+    def invoke_model(self, body, modelId, accept, contentType):
+        self.calls += 1
+        if self.calls == 1:
+            raise client_error('ThrottlingException', 429)
+        return {'body': io.BytesIO(json.dumps({'content': [{'text': '回答です。'}]}).encode())}
+
+
+def test_generation_fails_fast_on_validation_error():
+    qa = BedrockKnowledgeBaseQA()
+    qa.bedrock_runtime = RejectingRuntimeClient()
+    with pytest.raises(ClientError):
+        qa.generate_answer_with_bedrock('質問', [{'content': '情報'}])
+    assert qa.bedrock_runtime.calls == 1
+
+
+def test_generation_retries_throttling(monkeypatch):
+    import resilience
+    monkeypatch.setattr(resilience, 'DEFAULT_RETRY_POLICY', FAST_POLICY)
+    qa = BedrockKnowledgeBaseQA()
+    qa.bedrock_runtime = ThrottledOnceRuntimeClient()
+    assert qa.generate_answer_with_bedrock('質問', [{'content': '情報'}]) == '回答です。'
+    assert qa.bedrock_runtime.calls == 2
+
+
+def test_circuit_breaker_opens_after_failures_and_half_opens():
+    breaker = CircuitBreaker('テスト', failure_threshold=2, reset_timeout=0.1)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+    time.sleep(0.1)
+    assert breaker.allow()  # 半開で1件だけ試す
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_duplicate_question_falls_back_when_the_leader_hangs():
+    """処理中の同じ質問のリーダーが終わらない場合、時間予算の短い呼び出しは縮退応答を返すこと"""
+    qa = BedrockKnowledgeBaseQA()
+    started = threading.Event()
+    release = threading.Event()
+
+    def hang(query, deadline):
+        started.set()
+        release.wait(5)
+        return {'answer': '回答です。', 'sources': [], 'confidence': 0.9}
+
+    qa._answer_question = hang
+    leader = threading.Thread(target=lambda: qa.ask_question('ウィジェットとは', Deadline(10)))
+    leader.start()
+    started.wait(5)
+
+    start = time.perf_counter()
+    result = qa.ask_question('ウィジェットとは', Deadline(0.2))
+    assert time.perf_counter() - start < 1
+    assert result['degraded'] and result['degraded_reason'] == 'deadline'
+    assert result['sources'] == [] and result['confidence'] == 0
+    release.set()
+    leader.join()
+
+
+def test_circuit_breaker_counts_only_service_failures():
+    breaker = CircuitBreaker('テスト', failure_threshold=1, reset_timeout=60)
+    for error in (client_error('ValidationException'), client_error('AccessDeniedException', 403),
+                  DeadlineExceeded('時間予算切れ')):
+        breaker.record_error(error)
+    assert breaker.state == 'closed'
+
+    breaker.record_error(client_error('ServiceUnavailableException', 503))
+    assert breaker.state == 'open'
+
+
+def test_validation_error_does_not_open_generation_breaker():
+    qa = BedrockKnowledgeBaseQA()
+    qa.bedrock_runtime = RejectingRuntimeClient()
+    qa.generation_breaker = CircuitBreaker('回答生成', failure_threshold=1, reset_timeout=60)
+    with pytest.raises(ClientError):
+        qa.generate_answer_with_bedrock('質問', [{'content': '情報'}])
+    assert qa.generation_breaker.state == 'closed'
+
+
+class AgentClient:
+    def retrieve(self, knowledgeBaseId, retrievalQuery, retrievalConfiguration):
+        return {'retrievalResults': [{
+            'content': {'text': 'ウィジェットは管理画面の「設定」から有効にできます。   詳しくはヘルプを参照してください。'},
+            'score': 0.6,
+            'location': {'s3Location': {'uri': 's3://bucket/_123_widget.html'}},
+            'metadata': {}
+        }]}
+
+
+class UnavailableRuntimeClient:
+    def __init__(self):
+        self.calls = 0
+
+    def invoke_model(self, body, modelId, accept, contentType):
+        self.calls += 1
+        raise client_error('ServiceUnavailableException', 503)
+
+
+def create_degrading_qa(monkeypatch):
+    import resilience
+    monkeypatch.setattr(resilience, 'DEFAULT_RETRY_POLICY', FAST_POLICY)
+    qa = BedrockKnowledgeBaseQA()
+    qa.bedrock_agent_runtime = AgentClient()
+    qa.bedrock_runtime = UnavailableRuntimeClient()
+    qa.answer_cache = AnswerCache(InMemoryCacheBackend(), namespace='KB')
+    qa.generation_breaker = CircuitBreaker('回答生成', failure_threshold=1, reset_timeout=60)
+    return qa
+
+
+def test_generation_failure_returns_uncached_extractive_answer(monkeypatch):
+    """生成に失敗した場合は検索結果の抜粋で応答し、キャッシュしないこと"""
+    qa = create_degrading_qa(monkeypatch)
+    result = qa.ask_question('ウィジェットの設定')
+    assert result['degraded'] and result['degraded_reason'] == 'generation_failed'
+    assert 'ウィジェットは管理画面の「設定」から有効にできます。' in result['answer']
+    assert result['sources'] and result['confidence'] == 0.6
+    assert qa.answer_cache.get('ウィジェットの設定') is None
+
+    # ブレーカーが開いた後は生成を呼び出さずにすぐ応答する
+    calls = qa.bedrock_runtime.calls
+    start = time.perf_counter()
+    result = qa.ask_question('ウィジェットの設定')
+    assert time.perf_counter() - start < 0.5
+    assert result['degraded_reason'] == 'circuit_open'
+    assert qa.bedrock_runtime.calls == calls
+
+
+def test_short_deadline_skips_generation(monkeypatch):
+    qa = create_degrading_qa(monkeypatch)
+    result = qa.ask_question('ウィジェットの設定', deadline=Deadline(1))
+    assert result['degraded_reason'] == 'deadline'
+    assert qa.bedrock_runtime.calls == 0
+
+
+def test_stream_falls_back_to_extractive_answer(monkeypatch):
+    qa = create_degrading_qa(monkeypatch)
+    events = list(qa.ask_question_stream('ウィジェットの設定'))
+    assert [event['type'] for event in events] == ['sources', 'done']
+    assert events[-1]['degraded'] and events[-1]['html'] == events[-1]['answer']
+    assert 'retrieved_context' not in events[-1]
+    assert qa.answer_cache.get('ウィジェットの設定') is None
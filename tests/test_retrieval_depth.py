@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+検索の深さの調整（retrieval_depth）のテスト
+"""
+
+import sys
+import os
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ['ANSWER_CACHE_BACKEND'] = 'none'
+
+from bedrock_qa_system import BedrockKnowledgeBaseQA
+from metrics import RequestMetrics
+from retrieval_depth import RetrievalDepthController
+from term_translator import is_english_query
+
+
+def ranked(*scores):
+    return [{'content': f'情報{i}', 'score': score} for i, score in enumerate(scores)]
+
+
+def test_decide():
+    controller = RetrievalDepthController(enabled=True, min_score=0.7, min_gap=0.05, reduced_min_score=0.55)
+    assert controller.decide(ranked(0.8, 0.6)).name == 'early_exit'
+    assert controller.decide(ranked(0.8)).name == 'early_exit'
+    assert controller.decide(ranked(0.8, 0.78)).name == 'reduced'
+    assert controller.decide(ranked(0.6, 0.5)).name == 'reduced'
+    assert controller.decide(ranked(0.5, 0.2)).name == 'full'
+    assert controller.decide([]).name == 'full'
+
+
+def test_is_english_query():
+    assert is_english_query('How do I install the widget?')
+    assert not is_english_query('Widget を表示したい')
+    assert not is_english_query('ＡＰＩキー')
+
+
+def distinct_text(seed):
+    """ほかの検索結果と近似重複しない本文"""
+    return ''.join(chr(0x4e00 + seed * 30 + j) for j in range(30))
+
+
+class AgentClient:
+    """検索テキストごとに決めたスコアの結果を返す bedrock-agent-runtime の代わり（呼び出しを記録する）"""
+
+    def __init__(self, scores):
+        self.scores = scores
+        self.calls = []
+
+    def retrieve(self, knowledgeBaseId, retrievalQuery, retrievalConfiguration):
+        text = retrievalQuery['text']
+        self.calls.append((text, retrievalConfiguration['vectorSearchConfiguration']['numberOfResults']))
+        return {'retrievalResults': [{
+            'content': {'text': f'{text}の説明' + distinct_text(len(self.calls) * 10 + i)},
+            'score': score,
+            'location': {'s3Location': {'uri': f's3://bucket/_{len(self.calls)}{i}_{text}.html'}},
+            'metadata': {}
+        } for i, score in enumerate(self.scores[text])]}
+
+
+def create_qa(scores):
+    qa = BedrockKnowledgeBaseQA()
+    qa.bedrock_agent_runtime = AgentClient(scores)
+    qa.retrieval_depth = RetrievalDepthController(enabled=True, min_score=0.7, min_gap=0.05, reduced_min_score=0.55)
+    return qa
+
+
+def test_confident_primary_query_skips_expansion():
+    qa = create_qa({'プロキシ設定': [0.85, 0.6], 'proxy settings': [0.9]})
+    request_metrics = RequestMetrics()
+    with request_metrics.activate():
+        results = qa.retrieve_from_knowledge_base('プロキシ設定', 3)
+
+    assert qa.bedrock_agent_runtime.calls == [('プロキシ設定', 6)]
+    assert [result['score'] for result in results] == [0.85, 0.6]
+    assert request_metrics.fan_out == 1
+    assert request_metrics.properties['retrieval_depth'] == 'early_exit'
+    assert request_metrics.properties['retrieval_top_score'] == 0.85
+
+
+def test_expansion_depth_follows_confidence():
+    qa = create_qa({'プロキシ設定': [0.6, 0.58], 'proxy settings': [0.9]})
+    qa.retrieve_from_knowledge_base('プロキシ設定', 3)
+    assert qa.bedrock_agent_runtime.calls == [('プロキシ設定', 6), ('proxy settings', 3)]
+
+    qa = create_qa({'プロキシ設定': [0.4], 'proxy settings': [0.9]})
+    results = qa.retrieve_from_knowledge_base('プロキシ設定', 3)
+    assert qa.bedrock_agent_runtime.calls == [('プロキシ設定', 6), ('proxy settings', 6)]
+    assert results[0]['score'] == 0.9
+
+
+def test_english_query_is_not_translated():
+    qa = create_qa({'proxy settings': [0.4]})
+    request_metrics = RequestMetrics()
+    with request_metrics.activate():
+        qa.retrieve_from_knowledge_base('proxy settings', 3)
+
+    assert qa.bedrock_agent_runtime.calls == [('proxy settings', 6)]
+    assert 'translate_ms' not in request_metrics.timings()
+
+
+def test_batch_questions_skip_expansion_on_confident_results():
+    from batch_qa import ask_questions_batch
+
+    qa = create_qa({'プロキシ設定': [0.85, 0.6], 'proxy settings': [0.9], 'クローラー': [0.4], 'crawler': [0.5]})
+    qa.generate_answer_with_bedrock = lambda query, retrieved_context, deadline=None: '回答です。'
+    request_metrics = RequestMetrics()
+    with request_metrics.activate():
+        ask_questions_batch(qa, ['プロキシ設定', 'クローラー'], max_concurrency=1)
+
+    assert sorted(qa.bedrock_agent_runtime.calls) == [('crawler', 6), ('クローラー', 6), ('プロキシ設定', 6)]
+
+
+def test_async_retrieval_follows_the_same_stages():
+    import asyncio
+    from async_qa_system import AsyncBedrockKnowledgeBaseQA
+
+    for scores, expected in [
+        ({'プロキシ設定': [0.85, 0.6], 'proxy settings': [0.9]}, [('プロキシ設定', 6)]),
+        ({'プロキシ設定': [0.6, 0.58], 'proxy settings': [0.9]}, [('プロキシ設定', 6), ('proxy settings', 3)]),
+    ]:
+        async_qa = AsyncBedrockKnowledgeBaseQA(create_qa(scores))
+        asyncio.run(async_qa.retrieve_from_knowledge_base('プロキシ設定', 3))
+        async_qa.close()
+        assert async_qa.qa_system.bedrock_agent_runtime.calls == expected
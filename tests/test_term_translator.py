@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+用語変換（term_translator）のテスト
+"""
+
+import sys
+import os
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from term_translator import DEFAULT_TRANSLATOR, TermTranslator, translate_query_to_english
+
+
+def test_longest_match_wins():
+    """短い用語が先に置き換えられて長い用語が一致しなくなることがないこと"""
+    assert translate_query_to_english('クローラートリガーの使い方') == 'crawler triggerの使い方'
+    assert translate_query_to_english('ログインできない') == 'loginできない'
+    assert translate_query_to_english('ウィジェット設定とプロキシ') == 'widget settingsとproxy'
+
+
+def test_exact_match_and_english_words():
+    assert translate_query_to_english('プロキシ設定') == 'proxy settings'
+    assert translate_query_to_english('Activatorのエラー') == 'Activatorのerror'
+    assert translate_query_to_english('Widget を表示したい') == 'Widget を表示したい'
+
+
+def test_translations_are_not_rescanned():
+    translator = TermTranslator([('あ', 'い'), ('い', 'う')])
+    assert translator.translate('ああい') == 'いいう'
+
+
+def test_default_dictionary_is_loaded_from_file(tmp_path):
+    assert len(DEFAULT_TRANSLATOR) >= 37
+
+    path = tmp_path / 'terms.tsv'
+    path.write_text('# コメント\n\nサイト内検索\tsite search\n不正な行\n', encoding='utf-8')
+    translator = TermTranslator.from_file(str(path))
+    assert translator.terms == {'サイト内検索': 'site search'}
+
+
+def test_large_dictionary():
+    """数万語の辞書（接頭辞を共有する用語を含む）でも、各位置で最長一致した用語だけを置き換えること
+
+    変換時間は scripts/benchmark_pipeline.py の translate_large_dictionary で計測する。
+    """
+    translator = TermTranslator((f'用語{i:05d}', f'term{i}') for i in range(50000))
+    translator.add('用語', 'term')
+    translator.add('用語0004', 'term-prefix')
+    translator.add('クローラー', 'crawler')
+    query = 'クローラーの用語00042と用語49999と用語0004xと用語について教えてください'
+    assert translator.translate(query * 10) == (
+        'crawlerのterm42とterm49999とterm-prefixxとtermについて教えてください' * 10
+    )
+    assert len(translator) == 50003
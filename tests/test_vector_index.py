@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+ローカルのベクトル索引（vector_index）のテスト
+"""
+
+import sys
+import os
+import io
+import json
+import pytest
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ['ANSWER_CACHE_BACKEND'] = 'none'
+
+np = pytest.importorskip('numpy')
+
+from bedrock_qa_system import BedrockKnowledgeBaseQA
+from vector_index import LocalVectorRetriever, TitanEmbedder, VectorIndex, create_local_retriever, write_vector_index
+
+DOCUMENTS = [
+    {'uri': 's3://bucket/html/_101-activator.html', 'data_source_id': 'VO92FYFPG6', 'text': 'Activator'},
+    {'uri': 's3://bucket/html/_102-proxy.html', 'data_source_id': 'VO92FYFPG6', 'text': 'プロキシ'},
+    {'uri': 's3://bucket/html/_103-widget.html', 'data_source_id': '9JIZ7NR5GM', 'text': 'ウィジェット'},
+]
+EMBEDDINGS = [[1.0, 0.0, 0.0, 0.0], [0.6, 0.8, 0.0, 0.0], [0.0, 0.0, 2.0, 1.0]]
+QUERY_EMBEDDINGS = {'activator': [1.0, 0.1, 0.0, 0.0], 'widget': [0.0, 0.0, 1.0, 0.5]}
+
+
+class EmbeddingClient:
+    """Titan の埋め込みを返す bedrock-runtime の代わり（呼び出された入力を記録する）"""
+
+    def __init__(self):
+        self.inputs = []
+
+    def invoke_model(self, body, modelId, accept, contentType):
+        text = json.loads(body)['inputText']
+        self.inputs.append(text)
+        embedding = QUERY_EMBEDDINGS.get(text.lower(), [0.0, 0.0, 0.0, 1.0])
+        return {'body': io.BytesIO(json.dumps({'embedding': embedding}).encode())}
+
+
+def uris(results):
+    return [r['location']['s3Location']['uri'] for r in results]
+
+
+@pytest.mark.parametrize('dtype', ['float16', 'int8'])
+def test_round_trip_and_cosine_top_k(tmp_path, dtype):
+    path = str(tmp_path / 'vector_index.bin')
+    write_vector_index(path, DOCUMENTS, EMBEDDINGS, dtype=dtype)
+    index = VectorIndex(path)
+    assert (len(index), index.dimension, index.dtype) == (3, 4, dtype)
+
+    results = index.search([1.0, 0.0, 0.0, 0.0], 2)
+    assert uris(results) == ['s3://bucket/html/_101-activator.html', 's3://bucket/html/_102-proxy.html']
+    assert results[0]['score'] == pytest.approx(1.0, abs=0.01)
+    assert results[1]['score'] == pytest.approx(0.6, abs=0.01)
+    assert results[0]['metadata']['x-amz-bedrock-kb-data-source-id'] == 'VO92FYFPG6'
+    assert len(index.search([0.0, 0.0, 1.0, 0.0], 10)) == 3
+
+
+@pytest.mark.parametrize('dtype', ['float16', 'int8'])
+def test_blockwise_scores_match_full_product(tmp_path, dtype):
+    """行列を float32 で保持せず、ブロックごとに求めたスコアが全件の内積と一致すること"""
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((10, 8)).astype(np.float32)
+    path = str(tmp_path / 'vector_index.bin')
+    write_vector_index(path, [dict(DOCUMENTS[0], text=str(i)) for i in range(10)], embeddings, dtype=dtype)
+    index = VectorIndex(path, block_rows=3)
+    assert isinstance(index._matrix, np.memmap)
+
+    query = rng.standard_normal(8).astype(np.float32)
+    query /= np.linalg.norm(query)
+    expected = (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)) @ query
+    np.testing.assert_allclose(index.scores(query), expected, atol=0.02)
+    results = index.search(query, 4)
+    assert [r['content']['text'] for r in results] == [str(i) for i in np.argsort(-expected)[:4]]
+
+
+def test_query_embeddings_are_cached_by_normalized_query():
+    client = EmbeddingClient()
+    embed = TitanEmbedder(client, cache_size=1)
+    assert embed('Activator') == embed('  activator ') == QUERY_EMBEDDINGS['activator']
+    assert len(client.inputs) == 1
+    embed('widget')
+    embed('Activator')
+    assert len(client.inputs) == 3
+
+
+def test_local_retriever_replaces_knowledge_base(tmp_path, monkeypatch):
+    """RETRIEVAL_ENGINE=local の場合は retrieve_from_knowledge_base がローカルの索引で検索すること"""
+    path = str(tmp_path / 'vector_index.bin')
+    write_vector_index(path, DOCUMENTS, EMBEDDINGS)
+    monkeypatch.setenv('RETRIEVAL_ENGINE', 'local')
+    monkeypatch.setenv('VECTOR_INDEX_PATH', path)
+    monkeypatch.setenv('KEYWORD_INDEX_PATH', 'none')
+
+    qa = BedrockKnowledgeBaseQA()
+    assert isinstance(qa.bedrock_agent_runtime, LocalVectorRetriever)
+    client = EmbeddingClient()
+    qa.bedrock_agent_runtime.embed.runtime_client = client
+
+    context = qa.retrieve_from_knowledge_base('widget', max_results=1)
+    assert uris(context) == ['s3://bucket/html/_103-widget.html']
+    assert client.inputs == ['widget']
+
+
+def test_missing_index_falls_back_to_knowledge_base(tmp_path):
+    assert create_local_retriever(EmbeddingClient(), str(tmp_path / 'missing.bin')) is None